@@ -16,6 +16,12 @@ module kb_PRINSEQ {
     typedef string data_obj_ref;
     typedef string data_obj_name;
 
+    /*
+        A boolean - 0 for false, 1 for true.
+        @range (0, 1)
+    */
+    typedef int boolean;
+
     /* 
         exec PRINSEQ section
     */
@@ -27,11 +33,37 @@ module kb_PRINSEQ {
         output_ws : workspace to write to 
         output_reads_name : obj_name to create
 
-        lc_method : Low complexity method - value must be "dust" or "entropy"
+        lc_method : Low complexity method - value must be "dust", "entropy" or "both"
+                    (DUST and entropy scored in one pass by the native engine, using
+                    both thresholds)
         lc_entropy_threshold : Low complexity threshold - Value must be an integer between 0 and 100. 
                                Note a higher lc_entropy_threshold in entropy is more stringent. 
         lc_dust_threshold : Low complexity threshold - Value must be an integer between 0 and 100.                        
                              Note a lower lc_entropy_threshold is less stringent with dust
+        lc_combine : For lc_method "both", "and" (default) keeps the reads passing both
+                     thresholds, "or" the reads passing either
+        engine : Filtering engine - "prinseq" (default) runs prinseq-lite.pl,
+                 "native" scores the reads in process with NumPy
+        num_threads : Number of parallel processes (default 1); prinseq filters that
+                      many shards, the native engine scores the reads on that many
+                      workers fed through shared memory
+        compress_io : 1 to download the reads gzipped, decompress them on the fly
+                      and upload gzipped results (default 0)
+        mode : "filter" (default) or "stats_only" to only score the reads and return
+               the counts, without writing reads, objects or a report, or "sweep"
+               to return the reads kept at every threshold from 0 to 100 instead of
+               filtering (lc_*_threshold are ignored)
+        keep_bad_reads : 1 to keep the reads removed by the filter, gzipped and attached
+                         to the report (default 0, they are only counted)
+
+        min_len : remove reads shorter than this
+        min_qual_mean : remove reads with a lower mean quality (Phred+33)
+        ns_max_p : remove reads with more than this percentage of Ns
+        These are applied before lc_method, in the same pass, and a read is
+        counted against the first filter it fails.
+        derep : "exact" to remove duplicate reads (pairs for paired end input),
+                "revcomp" to also remove reverse complement duplicates; only the
+                first copy is kept and derep runs right before lc_method
     */
     typedef structure {
         data_obj_ref input_reads_ref;
@@ -40,13 +72,86 @@ module kb_PRINSEQ {
         string lc_method;
         int lc_entropy_threshold;
         int lc_dust_threshold; 
+        string lc_combine;
+        string engine;
+        int num_threads;
+        boolean compress_io;
+        string mode;
+        boolean keep_bad_reads;
+        int min_len;
+        int min_qual_mean;
+        int ns_max_p;
+        string derep;
     } inputPRINSEQ;
 
+    /*
+        Counts parsed from the PRINSEQ "Input and filter stats:" block.
+
+        input_reads, input_bases : both files of a pair added up
+        good_reads : all reads kept
+        good_pairs : pairs where both mates were kept
+        singletons_fwd, singletons_rev : reads kept without their mate
+        lc_method_removed : reads removed by the low complexity filter
+        removed_by : reads removed per filter line of the stats
+        score_memo_lookups, score_memo_hits, score_memo_hit_rate : reads scored
+            by the native engine and the share of them whose score came from
+            the memo of repeated sequences (missing for prinseq and cached scores)
+        precheck_reads, precheck_settled, precheck_settled_fraction : reads
+            scored through the entropy precheck and the share of them settled
+            by its first tier (entropy and both with the native engine)
+    */
+    typedef structure {
+        int input_reads;
+        int input_bases;
+        int good_reads;
+        int good_pairs;
+        int singletons_fwd;
+        int singletons_rev;
+        int lc_method_removed;
+        mapping<string, int> removed_by;
+        int score_memo_lookups;
+        int score_memo_hits;
+        float score_memo_hit_rate;
+        int precheck_reads;
+        int precheck_settled;
+        float precheck_settled_fraction;
+    } filterStats;
+
+    /*
+        Reads kept at one threshold of a sweep.
+
+        reads, bases : all reads kept, both mates of a pair counted
+        pairs, singletons_fwd, singletons_rev : paired end input only
+    */
+    typedef structure {
+        int threshold;
+        int reads;
+        int bases;
+        int pairs;
+        int singletons_fwd;
+        int singletons_rev;
+    } sweepPoint;
+
+    /*
+        output_filtered_ref : filtered reads (pairs for paired end input)
+        output_unpaired_fwd_ref / output_unpaired_rev_ref : reads kept without their mate
+        report : text of the report
+        stats : counts parsed from the PRINSEQ stats
+        sweep : reads kept at every threshold, for mode "sweep"
+        stage_seconds : wall time of every stage of the run (download, filter,
+                        compress, upload, report) and of the whole run (total);
+                        compress and upload overlap
+    */
     typedef structure {
         data_obj_ref output_filtered_ref;
 	    data_obj_ref output_unpaired_fwd_ref;
 	    data_obj_ref output_unpaired_rev_ref;
 	    string report;
+        string report_name;
+        string report_ref;
+        filterStats stats;
+        list<sweepPoint> sweep;
+        mapping<string, float> stage_seconds;
     } outputReadLibraryExecPRINSEQ;
 
     funcdef execReadLibraryPRINSEQ(inputPRINSEQ input_params)
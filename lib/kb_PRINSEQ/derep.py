@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+Dereplication on 64-bit sequence fingerprints.
+
+Every read is reduced to a 64-bit fingerprint: a polynomial hash of its
+(upper cased) bases, computed for a whole block at once, mixed with its
+length. For reverse complement dereplication the fingerprint of the
+reverse complement is computed in the same pass and the smaller of the
+two is used, so a read and its reverse complement get the same one. The
+pair of a paired end library is fingerprinted from the fingerprints of
+its mates; a pair read from the other strand has its mates swapped.
+
+A read is a duplicate when an earlier read has the same fingerprint, so
+the first copy is the one kept. Two different reads only collide with a
+probability of about n^2 / 2^65 for n reads.
+
+The fingerprints seen so far are held in memory, 8 bytes per unique read.
+For libraries too large for that, spilled_dereplicator() finds the
+duplicates beforehand in external memory: the fingerprints are
+partitioned on disk by their top bits and every partition is sorted on its
+own, so that only one partition is ever held in memory.
+"""
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from kb_PRINSEQ import packed
+
+DEREP_MODES = ['exact', 'revcomp']
+
+# the prinseq-lite -derep values of the same modes
+PRINSEQ_DEREP = {'exact': 1, 'revcomp': 14}
+
+SPILL_PARTITIONS = 64
+
+# inputs of this many bytes or more are dereplicated in the spilled mode
+DEFAULT_SPILL_BYTES = 8 * 1024 * 1024 * 1024
+
+_PRIME = np.uint64(0x100000001b3)
+_GOLDEN = np.uint64(0x9e3779b97f4a7c15)
+_MIX1 = np.uint64(0xbf58476d1ce4e5b9)
+_MIX2 = np.uint64(0x94d049bb133111eb)
+
+_UPPER = np.arange(256, dtype=np.uint64)
+_UPPER[ord('a'):ord('z') + 1] -= np.uint64(32)
+_COMPLEMENT = _UPPER.copy()
+for _base, _mate in zip(b'ACGTacgt', b'TGCATGCA'):
+    _COMPLEMENT[_base] = _mate
+
+_powers = np.ones(1, dtype=np.uint64)
+
+
+def _power_table(length):
+    # _PRIME ** k modulo 2^64 for every k below length
+    global _powers
+    if len(_powers) < length:
+        factors = np.full(length, _PRIME, dtype=np.uint64)
+        factors[0] = 1
+        _powers = np.cumprod(factors, dtype=np.uint64)
+    return _powers
+
+
+def _mix(values):
+    # splitmix64 finalizer, spreads every input bit over the whole word
+    values = values ^ (values >> np.uint64(30))
+    values = values * _MIX1
+    values = values ^ (values >> np.uint64(27))
+    values = values * _MIX2
+    return values ^ (values >> np.uint64(31))
+
+
+def _segment_sums(values, starts, lengths):
+    prefix = np.concatenate((np.zeros(1, dtype=np.uint64), np.cumsum(values, dtype=np.uint64)))
+    return prefix[starts + lengths] - prefix[starts]
+
+
+def fingerprints(block, revcomp=False):
+    """
+    Fingerprints of the sequences of a fastq.RecordBlock, canonical over
+    both strands with revcomp.
+    """
+    bases, starts, lengths = packed.gather(block)
+    # offset of every base within its read
+    within = np.arange(len(bases), dtype=np.int64) - np.repeat(starts, lengths)
+    powers = _power_table(int(lengths.max()) if len(lengths) else 0)
+    size = _mix(lengths.astype(np.uint64) * _GOLDEN)
+    forward = _segment_sums(_UPPER[bases] * powers[np.repeat(lengths - 1, lengths) - within],
+                            starts, lengths)
+    result = _mix(forward ^ size)
+    if revcomp:
+        reverse = _segment_sums(_COMPLEMENT[bases] * powers[within], starts, lengths)
+        result = np.minimum(result, _mix(reverse ^ size))
+    return result
+
+
+def _pair(first, second):
+    return _mix(first + _mix(second ^ _GOLDEN))
+
+
+def pair_fingerprints(fwd_block, rev_block, revcomp=False):
+    """
+    Fingerprints of the pairs of two blocks holding the mates in the same
+    order, the same for a pair and its swapped mates with revcomp.
+    """
+    fwd = fingerprints(fwd_block)
+    rev = fingerprints(rev_block)
+    if revcomp:
+        return np.minimum(_pair(fwd, rev), _pair(rev, fwd))
+    return _pair(fwd, rev)
+
+
+class FingerprintSet(object):
+    """
+    Set of fingerprints kept as a few sorted arrays of doubling sizes, so
+    that adding a batch costs amortized O(log n) per fingerprint.
+    """
+
+    def __init__(self):
+        self.levels = []
+
+    def __len__(self):
+        return sum(len(level) for level in self.levels)
+
+    def _contains(self, values):
+        found = np.zeros(len(values), dtype=bool)
+        for level in self.levels:
+            positions = np.minimum(np.searchsorted(level, values), len(level) - 1)
+            found |= level[positions] == values
+        return found
+
+    def add_new(self, values):
+        """
+        Add a batch of fingerprints. Returns which of them are duplicates
+        of a fingerprint added before, or earlier in the batch.
+        """
+        unique, first = np.unique(values, return_index=True)
+        new = ~self._contains(unique)
+        duplicates = np.ones(len(values), dtype=bool)
+        duplicates[first[new]] = False
+        if new.any():
+            self.levels.append(unique[new])
+            while len(self.levels) > 1 and len(self.levels[-2]) <= 2 * len(self.levels[-1]):
+                last = self.levels.pop()
+                self.levels[-1] = np.sort(np.concatenate((self.levels[-1], last)),
+                                          kind='mergesort')
+        return duplicates
+
+
+class Dereplicator(object):
+    """
+    Tells which reads, or pairs, of a batch repeat an earlier one.
+
+    duplicates() has to be called on every block of the input in file
+    order. Only the candidates (the reads that passed the filters before
+    derep) are compared, the others are never duplicates. With spilled, the
+    sorted indices of the duplicates found by spilled_dereplicator(), the
+    fingerprints are not held in memory.
+    """
+
+    def __init__(self, mode, spilled=None):
+        self.mode = mode
+        self.revcomp = mode == 'revcomp'
+        self.spilled = spilled
+        self.seen = FingerprintSet() if spilled is None else None
+        self.offset = 0
+
+    def fingerprints(self, blocks):
+        if len(blocks) == 2:
+            return pair_fingerprints(blocks[0], blocks[1], self.revcomp)
+        return fingerprints(blocks[0], self.revcomp)
+
+    def duplicates(self, blocks, candidates):
+        start = self.offset
+        self.offset += len(candidates)
+        duplicates = np.zeros(len(candidates), dtype=bool)
+        if self.spilled is not None:
+            low, high = np.searchsorted(self.spilled, [start, start + len(candidates)])
+            duplicates[(self.spilled[low:high] - start).astype(np.intp)] = True
+        elif candidates.any():
+            duplicates[candidates] = self.seen.add_new(self.fingerprints(blocks)[candidates])
+        return duplicates
+
+
+def _spill(dereplicator, batches, partition_paths):
+    shift = np.uint64(64 - int(np.log2(len(partition_paths))))
+    partitions = [open(path, 'wb') for path in partition_paths]
+    try:
+        offset = 0
+        for blocks, candidates in batches:
+            indices = offset + np.flatnonzero(candidates).astype(np.uint64)
+            offset += len(candidates)
+            if not len(indices):
+                continue
+            values = dereplicator.fingerprints(blocks)[candidates]
+            parts = (values >> shift).astype(np.intp)
+            order = np.argsort(parts, kind='mergesort')
+            bounds = np.concatenate(([0], np.cumsum(np.bincount(parts,
+                                                                minlength=len(partitions)))))
+            records = np.column_stack((values, indices))[order]
+            for part, handle in enumerate(partitions):
+                if bounds[part] < bounds[part + 1]:
+                    records[bounds[part]:bounds[part + 1]].tofile(handle)
+    finally:
+        for handle in partitions:
+            handle.close()
+
+
+def _partition_duplicates(partition_path):
+    records = np.fromfile(partition_path, dtype=np.uint64).reshape(-1, 2)
+    # a stable sort keeps the copies of a fingerprint in file order
+    order = np.argsort(records[:, 0], kind='mergesort')
+    values = records[order, 0]
+    repeated = np.zeros(len(values), dtype=bool)
+    repeated[1:] = values[1:] == values[:-1]
+    return records[order[repeated], 1]
+
+
+def spilled_dereplicator(mode, batches, work_dir, partitions=SPILL_PARTITIONS):
+    """
+    Dereplicator for inputs too large to hold every fingerprint in memory.
+
+    batches yields (blocks, candidates) for every block of the input in
+    file order, as later given to Dereplicator.duplicates(). partitions has
+    to be a power of two, at least 2.
+    """
+    dereplicator = Dereplicator(mode, spilled=np.zeros(0, dtype=np.uint64))
+    spill_dir = tempfile.mkdtemp(dir=work_dir)
+    try:
+        partition_paths = [os.path.join(spill_dir, 'part{}'.format(index))
+                           for index in range(partitions)]
+        _spill(dereplicator, batches, partition_paths)
+        duplicates = [_partition_duplicates(path) for path in partition_paths]
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+    dereplicator.spilled = np.sort(np.concatenate(duplicates))
+    return dereplicator
@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming FASTQ reading and writing for the in-process filters.
+
+Files are read in large blocks. Every block holds only complete 4 line
+records and keeps the byte positions of its records and sequences in NumPy
+arrays, so records can be handed around as memoryview slices of the block
+without creating a Python object per line. Kept records are written back
+in large batched writes, adjacent records of a block going out as a single
+slice. Memory use is bounded by the block size whatever the size of the
+file.
+
+The native engine reads plain files through map_blocks, which parses
+blocks straight out of a read only memory map of the file (or of a byte
+range of it, one shard) instead of copying them into Python bytes, and
+drops the pages behind the reader from the page cache as it goes.
+Processes mapping the same file share its pages.
+
+gzip compressed input is detected and decompressed on the fly. Output can
+be compressed with BlockGzipWriter, which deflates independent blocks on a
+thread pool and writes them as consecutive gzip members (a valid gzip file,
+as produced by pigz or bgzip).
+"""
+import gzip
+import mmap
+import os
+import shutil
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+BLOCK_SIZE = 4 * 1024 * 1024
+WRITE_BUFFER_SIZE = 8 * 1024 * 1024
+
+GZIP_MAGIC = b'\x1f\x8b'
+GZIP_BLOCK_SIZE = 1024 * 1024
+GZIP_LEVEL = 6
+GZIP_THREADS = 4
+
+_NEWLINE = ord('\n')
+_CARRIAGE_RETURN = ord('\r')
+_AT = ord('@')
+_PLUS = ord('+')
+_WHITESPACE = frozenset(b' \t\n\r\x0b\x0c')
+
+
+class RecordBlock(object):
+    """
+    A run of complete FASTQ records sharing one buffer.
+
+    Record i spans data[bounds[i]:bounds[i + 1]], its sequence
+    data[seq_starts[i]:seq_ends[i]] and its quality string, as long as the
+    sequence, starts at qual_starts[i].
+    """
+
+    def __init__(self, data, bounds, seq_starts, seq_ends, qual_starts):
+        self.data = data
+        self.view = memoryview(data)
+        self.bounds = bounds
+        self.seq_starts = seq_starts
+        self.seq_ends = seq_ends
+        self.qual_starts = qual_starts
+
+    def __len__(self):
+        return len(self.seq_starts)
+
+    def __getitem__(self, index):
+        # only slices are supported, they share the buffer of the block
+        start, stop, _ = index.indices(len(self))
+        return RecordBlock(self.data, self.bounds[start:stop + 1],
+                           self.seq_starts[start:stop], self.seq_ends[start:stop],
+                           self.qual_starts[start:stop])
+
+    def seq_lengths(self):
+        return self.seq_ends - self.seq_starts
+
+    def record(self, i):
+        return self.view[self.bounds[i]:self.bounds[i + 1]]
+
+    def header(self, i):
+        # without the leading @ and the line break
+        end = self.seq_starts[i] - 1
+        if self.data[end - 1] == _CARRIAGE_RETURN:
+            end -= 1
+        return self.view[self.bounds[i] + 1:end]
+
+    def seq(self, i):
+        return self.view[self.seq_starts[i]:self.seq_ends[i]]
+
+    def raw(self):
+        return np.frombuffer(self.data, dtype=np.uint8)
+
+    def seqs(self):
+        view = self.view
+        return [view[start:end] for start, end in zip(self.seq_starts.tolist(),
+                                                      self.seq_ends.tolist())]
+
+
+def _parse_block(data, path, newlines=None):
+    raw = np.frombuffer(data, dtype=np.uint8)
+    if newlines is None:
+        newlines = np.flatnonzero(raw == _NEWLINE)
+    line_starts = np.concatenate(([0], newlines[:-1] + 1))
+    headers = line_starts[0::4]
+    pluses = line_starts[2::4]
+    if (raw[headers] != _AT).any() or (raw[pluses] != _PLUS).any():
+        bad = headers[raw[headers] != _AT]
+        position = bad[0] if len(bad) else pluses[raw[pluses] != _PLUS][0]
+        raise ValueError('Malformed FASTQ record in {}: {}'.format(
+            path, bytes(data[position:position + 80])))
+    seq_starts = line_starts[1::4]
+    seq_ends = newlines[1::4].copy()
+    seq_ends -= raw[seq_ends - 1] == _CARRIAGE_RETURN
+    bounds = np.concatenate((headers, [newlines[-1] + 1]))
+    return RecordBlock(data, bounds, seq_starts, seq_ends, line_starts[3::4])
+
+
+def is_gzipped(path):
+    with open(path, 'rb') as handle:
+        return handle.read(2) == GZIP_MAGIC
+
+
+def open_fastq(path, mode='rb'):
+    """
+    Open a FASTQ file for reading, decompressing it if it is gzipped.
+    """
+    if is_gzipped(path):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def gunzip_in_place(path):
+    """
+    Replace a gzipped file by its uncompressed content, for tools that
+    cannot read gzip.
+    """
+    if not is_gzipped(path):
+        return
+    with gzip.open(path, 'rb') as compressed, open(path + '.tmp', 'wb') as plain:
+        shutil.copyfileobj(compressed, plain, BLOCK_SIZE)
+    os.rename(path + '.tmp', path)
+
+
+def gzip_file(path):
+    """
+    Compress path to path.gz with BlockGzipWriter and remove path.
+
+    Returns the path of the compressed file.
+    """
+    with open(path, 'rb') as plain, BlockGzipWriter(path + '.gz') as compressed:
+        shutil.copyfileobj(plain, compressed, BLOCK_SIZE)
+    os.remove(path)
+    return path + '.gz'
+
+
+def read_blocks(path, block_size=BLOCK_SIZE, opener=open_fastq):
+    """
+    Yield the records of a FASTQ file as RecordBlocks.
+
+    Trailing blank lines are ignored and a missing final newline is
+    tolerated.
+    """
+    with opener(path, 'rb') as fastq:
+        pending = b''
+        while True:
+            chunk = fastq.read(block_size)
+            at_end = not chunk
+            data = pending + chunk if pending else chunk
+            if at_end:
+                data = data.rstrip()
+                if not data:
+                    return
+                data += b'\n'
+                if data.count(b'\n') % 4:
+                    raise ValueError('Truncated FASTQ record in {}'.format(path))
+                yield _parse_block(data, path)
+                return
+            # cut after the last newline that closes a whole record
+            end = len(data)
+            lines = data.count(b'\n')
+            if lines < 4:
+                pending = data
+                continue
+            for _ in range(lines % 4 + 1):
+                end = data.rindex(b'\n', 0, end)
+            end += 1
+            pending = data[end:]
+            yield _parse_block(data[:end], path)
+
+
+def _release(mapped, fd, start, end):
+    # drop pages already read from the map and from the page cache
+    if end <= start:
+        return
+    if hasattr(mapped, 'madvise'):
+        mapped.madvise(mmap.MADV_DONTNEED, start, end - start)
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, start, end - start, os.POSIX_FADV_DONTNEED)
+
+
+def map_blocks(path, start=0, end=None, block_size=BLOCK_SIZE):
+    """
+    Yield the records of a FASTQ file as RecordBlocks over a memory map of
+    the file, without copying them into Python buffers. start and end, a
+    record aligned byte range (see fastqindex), restrict the records to
+    the ones in that range. Gzipped files are read with read_blocks().
+
+    The map is advised as read sequentially and the pages a block behind
+    the reader are released, from the map and from the page cache, so
+    that large inputs do not fill the page cache of a shared node. Blocks
+    still held afterwards stay valid, their pages are read again when used.
+    Other processes mapping the same file share its pages.
+    """
+    if is_gzipped(path):
+        for block in read_blocks(path, block_size):
+            yield block
+        return
+    size = os.path.getsize(path)
+    end = size if end is None else min(end, size)
+    if start >= end:
+        return
+    with open(path, 'rb') as handle:
+        mapped = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(mapped, 'madvise'):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        raw = np.frombuffer(mapped, dtype=np.uint8)
+        view = memoryview(mapped)
+        try:
+            # trailing blank lines are ignored as by read_blocks
+            while end == size and end > start and raw[end - 1] in _WHITESPACE:
+                end -= 1
+                size -= 1
+            released = start - start % mmap.PAGESIZE
+            previous = position = start
+            window = block_size
+            while position < end:
+                stop = min(position + window, end)
+                newlines = np.flatnonzero(raw[position:stop] == _NEWLINE)
+                closed = len(newlines) // 4 * 4
+                if not closed and stop < end:
+                    # a record longer than the block
+                    window *= 2
+                    continue
+                if not closed:
+                    # the last record has lost its final newline
+                    data = bytes(view[position:end]) + b'\n'
+                    if data.count(b'\n') % 4:
+                        raise ValueError('Truncated FASTQ record in {}'.format(path))
+                    yield _parse_block(data, path)
+                    break
+                cut = position + int(newlines[closed - 1]) + 1
+                yield _parse_block(view[position:cut], path, newlines[:closed])
+                behind = previous - previous % mmap.PAGESIZE
+                _release(mapped, handle.fileno(), released, behind)
+                released = max(released, behind)
+                previous, position = position, cut
+                window = block_size
+        finally:
+            del raw, view
+            try:
+                mapped.close()
+            except BufferError:
+                # blocks still use the map, it goes away with them
+                pass
+
+
+class UnevenPairs(ValueError):
+    pass
+
+
+def paired_blocks(fwd_blocks, rev_blocks):
+    """
+    Walk two block streams in lockstep.
+
+    Yields (fwd, rev) block slices holding the same number of records.
+    Raises UnevenPairs when one file runs out of records before the other.
+    """
+    fwd = rev = None
+    while True:
+        if fwd is None or len(fwd) == 0:
+            fwd = next(fwd_blocks, None)
+        if rev is None or len(rev) == 0:
+            rev = next(rev_blocks, None)
+        if fwd is None and rev is None:
+            return
+        if fwd is None or rev is None:
+            raise UnevenPairs('Paired end files do not have the same number of reads')
+        count = min(len(fwd), len(rev))
+        yield fwd[:count], rev[:count]
+        fwd = fwd[count:]
+        rev = rev[count:]
+
+
+class FastqWriter(object):
+    """
+    Buffered FASTQ writer taking memoryview records.
+
+    Records are collected and written in batches of about buffer_size
+    bytes, records that follow each other in the same block are merged into
+    one slice first.
+    """
+
+    def __init__(self, path, buffer_size=WRITE_BUFFER_SIZE, opener=open):
+        self.path = path
+        self.handle = opener(path, 'wb')
+        self.buffer_size = buffer_size
+        self.pending = []
+        self.pending_size = 0
+
+    def write(self, record):
+        self.pending.append(record)
+        self.pending_size += len(record)
+        if self.pending_size >= self.buffer_size:
+            self.flush()
+
+    def write_block(self, block, keep):
+        """
+        Write the records of a RecordBlock selected by the boolean mask keep.
+        """
+        keep = np.asarray(keep, dtype=bool)
+        if not keep.any():
+            return
+        # runs of consecutive kept records are contiguous in the buffer
+        edges = np.flatnonzero(np.diff(np.concatenate(([False], keep, [False]))))
+        bounds = block.bounds
+        for start, stop in zip(edges[0::2].tolist(), edges[1::2].tolist()):
+            self.write(block.view[bounds[start]:bounds[stop]])
+
+    def flush(self):
+        if self.pending:
+            self.handle.write(b''.join(self.pending))
+            self.pending = []
+            self.pending_size = 0
+
+    def close(self):
+        self.flush()
+        self.handle.close()
+
+
+def _gzip_member(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class BlockGzipWriter(object):
+    """
+    Multi-threaded gzip writer.
+
+    Data is cut into blocks of block_size bytes that are compressed
+    concurrently (zlib releases the GIL) and written in order as separate
+    gzip members. At most two blocks per thread are in flight.
+    """
+
+    def __init__(self, path, mode='wb', block_size=GZIP_BLOCK_SIZE, threads=GZIP_THREADS,
+                 level=GZIP_LEVEL):
+        self.path = path
+        self.handle = open(path, mode)
+        self.block_size = block_size
+        self.threads = threads
+        self.level = level
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.in_flight = deque()
+        self.buffer = bytearray()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _submit(self, data):
+        self.in_flight.append(self.pool.submit(_gzip_member, data, self.level))
+        while len(self.in_flight) > 2 * self.threads:
+            self.handle.write(self.in_flight.popleft().result())
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def close(self):
+        if self.handle.closed:
+            return
+        try:
+            if self.buffer:
+                self._submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            while self.in_flight:
+                self.handle.write(self.in_flight.popleft().result())
+        finally:
+            self.pool.shutdown()
+            self.handle.close()
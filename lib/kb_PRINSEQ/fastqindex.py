@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Record aligned offset index of a FASTQ file.
+
+The index holds the byte offset of every INDEX_INTERVAL-th record (records
+0, N, 2N, ...) and the number of records, so that a file can be cut at
+record boundaries, and its records counted, without parsing it again. It
+is built in one pass over the memory mapped file, finding the newlines of
+large chunks at once with NumPy, and stored with the size of the file it
+was built from. fastq_index() reuses a stored index as long as it still
+matches the file.
+
+By default the index is stored next to the file (INDEX_SUFFIX) and also
+holds the modification time of the file. Downloads land in a new
+directory every run, so to reuse indexes across runs and retries they are
+stored in an index directory instead, under a key naming the input, such
+as its object reference with the version and the read direction: the
+same key and size then give the same index whatever file it was
+downloaded to.
+
+Indexes of the two files of a paired end library built with the same
+interval have their entries at the same record numbers: cutting both at
+the same entries gives shards holding the same pairs.
+
+Only uncompressed files can be indexed, and records have to be 4 lines as
+for fastq.read_blocks.
+"""
+import hashlib
+import mmap
+import os
+import uuid
+
+import numpy as np
+
+INDEX_INTERVAL = 4096
+INDEX_SUFFIX = '.fqidx.npz'
+
+# bytes searched for newlines at once
+SCAN_SIZE = 64 * 1024 * 1024
+
+_NEWLINE = ord('\n')
+_WHITESPACE = b' \t\n\r\x0b\x0c'
+
+
+class FastqIndex(object):
+    """
+    offsets[j] is the byte offset of record j * interval, for every such
+    record of the file.
+    """
+
+    def __init__(self, offsets, num_records, interval, size):
+        self.offsets = offsets
+        self.num_records = num_records
+        self.interval = interval
+        self.size = size
+
+    def __len__(self):
+        return self.num_records
+
+    def shard_ranges(self, num_shards):
+        """
+        Cut the file into at most num_shards consecutive byte ranges of
+        about the same number of records, at indexed records.
+
+        Returns (start, end) byte ranges, at least one. The ranges of two
+        indexes with the same interval and number of records hold the same
+        record numbers.
+        """
+        per_shard = -(-self.num_records // max(1, num_shards))
+        # shards start at indexed records only
+        step = max(1, -(-per_shard // self.interval))
+        starts = [int(offset) for offset in self.offsets[::step]] or [0]
+        return list(zip(starts, starts[1:] + [self.size]))
+
+
+def _keyed(index_dir, key):
+    return index_dir is not None and key is not None
+
+
+def index_path(fastq_path, index_dir=None, key=None):
+    """
+    Where the index of fastq_path is stored: next to it, or under key in
+    index_dir when both are given.
+    """
+    if not _keyed(index_dir, key):
+        return fastq_path + INDEX_SUFFIX
+    return os.path.join(index_dir, hashlib.sha1(key.encode()).hexdigest() + INDEX_SUFFIX)
+
+
+def _content_end(mapped, size):
+    # end of the file without the trailing whitespace read_blocks ignores
+    end = size
+    while end and mapped[end - 1:end] in _WHITESPACE:
+        end -= 1
+    return end
+
+
+def build_index(fastq_path, interval=INDEX_INTERVAL):
+    """
+    Scan a FASTQ file for its record offsets.
+    """
+    size = os.path.getsize(fastq_path)
+    if size == 0:
+        return FastqIndex(np.zeros(0, dtype=np.int64), 0, interval, 0)
+    record_lines = 4 * interval
+    found = [np.zeros(1, dtype=np.int64)]
+    with open(fastq_path, 'rb') as handle:
+        mapped = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        data = np.frombuffer(mapped, dtype=np.uint8)
+        try:
+            end = _content_end(mapped, size)
+            lines = 0
+            for start in range(0, end, SCAN_SIZE):
+                newlines = start + np.flatnonzero(data[start:min(start + SCAN_SIZE, end)] ==
+                                                  _NEWLINE)
+                # newline n (counted from 0) ends record (n + 1) / 4 - 1
+                first = -(lines + 1) % record_lines
+                found.append(newlines[first::record_lines] + 1)
+                lines += len(newlines)
+        finally:
+            # the map cannot be closed while an array still uses it
+            del data
+            mapped.close()
+    # the last line has no newline before the trailing whitespace
+    lines += 1 if end else 0
+    if lines % 4:
+        raise ValueError('Truncated FASTQ record in {}'.format(fastq_path))
+    num_records = lines // 4
+    offsets = np.concatenate(found)[:-(-num_records // interval)]
+    return FastqIndex(offsets, num_records, interval, size)
+
+
+def _stamp(fastq_path, interval, keyed=False):
+    # a keyed index outlives the download it was built from, so it cannot
+    # hold the modification time
+    stat = os.stat(fastq_path)
+    return np.array([stat.st_size, 0 if keyed else stat.st_mtime_ns, interval],
+                    dtype=np.int64)
+
+
+def load_index(fastq_path, interval=INDEX_INTERVAL, index_dir=None, key=None):
+    """
+    The stored index of fastq_path, None when there is none or the file
+    changed since it was built.
+    """
+    try:
+        with np.load(index_path(fastq_path, index_dir, key)) as stored:
+            stamp = stored['stamp']
+            offsets = stored['offsets']
+            num_records = int(stored['num_records'])
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+    if not np.array_equal(stamp, _stamp(fastq_path, interval, _keyed(index_dir, key))):
+        return None
+    return FastqIndex(offsets, num_records, interval, int(stamp[0]))
+
+
+def store_index(fastq_path, index, index_dir=None, key=None):
+    path = index_path(fastq_path, index_dir, key)
+    stamp = _stamp(fastq_path, index.interval, _keyed(index_dir, key))
+    if _keyed(index_dir, key) and not os.path.exists(index_dir):
+        os.makedirs(index_dir)
+    temp_path = '{}.{}.tmp.npz'.format(path, uuid.uuid4().hex)
+    np.savez(temp_path, stamp=stamp, offsets=index.offsets,
+             num_records=np.int64(index.num_records))
+    os.rename(temp_path, path)
+
+
+def fastq_index(fastq_path, interval=INDEX_INTERVAL, index_dir=None, key=None):
+    """
+    The index of fastq_path, built and stored (see index_path) unless a
+    stored one is still valid.
+    """
+    index = load_index(fastq_path, interval, index_dir, key)
+    if index is None:
+        index = build_index(fastq_path, interval)
+        try:
+            store_index(fastq_path, index, index_dir, key)
+        except (IOError, OSError):
+            # a read only directory only costs the next scan
+            pass
+    return index
@@ -0,0 +1,402 @@
+# -*- coding: utf-8 -*-
+"""
+In-process replacement for the prinseq-lite.pl low complexity filter.
+
+Output files are named the way prinseq names them
+(<input>_prinseq_good_XXXX.fastq, <input>_prinseq_good_singletons_XXXX.fastq
+and <input>_prinseq_bad_XXXX.fastq, with a .gz suffix when compressed) and
+empty outputs are removed, so the files can be picked up exactly like the
+ones written by prinseq. Bad reads are only counted unless keep_bad is set,
+in which case they are written gzipped. With stats_only set nothing is
+written, as with prinseq -out_good null -out_bad null. The returned stats
+text follows the "Input and filter stats:" block that prinseq prints.
+
+Besides the prinseq methods, lc_method "both" filters on the DUST and the
+entropy score at once and breaks the removed reads down by the score(s)
+they failed.
+
+The prinseq min_len, min_qual_mean and ns_max_p filters can be chained in
+front of the low complexity filter. As in prinseq, a removed read is
+counted against the first filter of the chain it fails. Dereplication
+(see derep) runs after them, right before lc_method, so that duplicates
+are dropped before they are filtered again.
+"""
+import os
+import uuid
+
+import numpy as np
+
+from kb_PRINSEQ import derep
+from kb_PRINSEQ import fastq
+from kb_PRINSEQ import lowcomplexity
+from kb_PRINSEQ import pairing
+from kb_PRINSEQ.scorecache import Scorer
+from kb_PRINSEQ.stats import format_stats
+
+NATIVE_LC_METHODS = ['dust', 'entropy', 'both']
+BOTH_RULES = ['and', 'or']
+
+# filters that can run before lc_method, in the order prinseq applies them
+CHAIN_FILTERS = ['min_len', 'min_qual_mean', 'ns_max_p']
+
+PHRED_OFFSET = 33
+_N = ord('N')
+_LOWER_N = ord('n')
+
+
+def _range_sums(values, starts, lengths):
+    # sums of values[start:start + length] through one prefix sum
+    prefix = np.concatenate(([0], np.cumsum(values, dtype=np.int64)))
+    return prefix[starts + lengths] - prefix[starts]
+
+
+def _fails_min_len(block, min_len):
+    return block.seq_lengths() < min_len
+
+
+def _fails_min_qual_mean(block, min_qual_mean):
+    lengths = block.seq_lengths()
+    quality = _range_sums(block.raw(), block.qual_starts, lengths) - PHRED_OFFSET * lengths
+    return quality < min_qual_mean * lengths
+
+
+def _fails_ns_max_p(block, ns_max_p):
+    raw = block.raw()
+    lengths = block.seq_lengths()
+    ns = _range_sums((raw == _N) | (raw == _LOWER_N), block.seq_starts, lengths)
+    return ns * 100 > ns_max_p * lengths
+
+
+_CHECKS = {'min_len': _fails_min_len,
+           'min_qual_mean': _fails_min_qual_mean,
+           'ns_max_p': _fails_ns_max_p}
+
+
+class FilterChain(object):
+    """
+    Decides which reads are removed and counts why.
+
+    filters maps the names in CHAIN_FILTERS to their prinseq values, None
+    or missing filters are not applied. dereplicator (a derep.Dereplicator)
+    removes the duplicates among the reads passing them. lc_threshold is an
+    integer, except for lc_method "both" where it is a dict holding the
+    'dust' and 'entropy' thresholds and the 'rule' combining them: with
+    'and' a read has to pass both, with 'or' passing one of them is enough.
+    """
+
+    def __init__(self, lc_method, lc_threshold, filters=None, dereplicator=None):
+        self.lc_method = lc_method
+        self.lc_threshold = lc_threshold
+        self.filters = [(name, filters[name]) for name in CHAIN_FILTERS
+                        if filters and filters.get(name) is not None]
+        self.dereplicator = dereplicator
+        if lc_method == 'both':
+            lc_reasons = ['lc_method (dust)', 'lc_method (entropy)',
+                          'lc_method (dust and entropy)']
+        else:
+            lc_reasons = ['lc_method']
+        self.reasons = ([name for name, _ in self.filters] +
+                        (['derep'] if dereplicator is not None else []) + lc_reasons)
+        self.removed = dict.fromkeys(self.reasons, 0)
+
+    def passed(self, block):
+        """
+        Which reads of a block pass the filters before derep, uncounted.
+        """
+        removed = np.zeros(len(block), dtype=bool)
+        for name, value in self.filters:
+            removed |= _CHECKS[name](block, value)
+        return ~removed
+
+    def _remove(self, reason, removed, failed):
+        failed = failed & ~removed
+        self.removed[reason] += int(failed.sum())
+        return removed | failed
+
+    def _low_complexity(self, keys):
+        # reads removed by lc_method and the (reason, failed) breakdown
+        if self.lc_method != 'both':
+            removed = ~lowcomplexity.keep_keys(keys, self.lc_method, self.lc_threshold)
+            return removed, [('lc_method', removed)]
+        dust = ~lowcomplexity.keep_keys(keys[:, 0], 'dust', self.lc_threshold['dust'])
+        entropy = ~lowcomplexity.keep_keys(keys[:, 1], 'entropy',
+                                           self.lc_threshold['entropy'])
+        if self.lc_threshold['rule'] == 'and':
+            removed = dust | entropy
+        else:
+            removed = dust & entropy
+        return removed, [('lc_method (dust)', dust & ~entropy),
+                         ('lc_method (entropy)', entropy & ~dust),
+                         ('lc_method (dust and entropy)', dust & entropy)]
+
+    def _keep(self, blocks, keys, dereplicate):
+        removed = []
+        for block in blocks:
+            block_removed = np.zeros(len(block), dtype=bool)
+            for name, value in self.filters:
+                block_removed = self._remove(name, block_removed, _CHECKS[name](block, value))
+            removed.append(block_removed)
+        if dereplicate and self.dereplicator is not None:
+            # a pair is only compared to other pairs when both mates passed
+            candidates = ~np.logical_or.reduce(removed)
+            duplicates = self.dereplicator.duplicates(blocks, candidates)
+            removed = [self._remove('derep', block_removed, duplicates)
+                       for block_removed in removed]
+        kept = []
+        for block_removed, block_keys in zip(removed, keys):
+            lc_removed, breakdown = self._low_complexity(block_keys)
+            lc_removed &= ~block_removed
+            for reason, failed in breakdown:
+                self.removed[reason] += int((lc_removed & failed).sum())
+            kept.append(~(block_removed | lc_removed))
+        return kept
+
+    def keep(self, block, keys):
+        """
+        Which reads of a block, with their score keys, are kept.
+        """
+        return self._keep([block], [keys], True)[0]
+
+    def keep_pairs(self, blocks, keys):
+        """
+        Which reads of the (fwd, rev) blocks of a pair of files are kept.
+        """
+        return self._keep(blocks, keys, True)
+
+    def keep_orphans(self, block, keys):
+        """
+        Which reads whose mate is missing are kept, they are not
+        dereplicated.
+        """
+        return self._keep([block], [keys], False)[0]
+
+    def filtered(self):
+        """
+        The (reason, number of reads removed) lines of the stats.
+        """
+        return [(reason, self.removed[reason]) for reason in self.reasons]
+
+
+def _dereplicator(chain, derep_mode, spill, walk, work_dir):
+    # the spilled mode finds the duplicates among the reads passing the
+    # filters before derep in a first pass over the input
+    if derep_mode is None:
+        return None
+    if not spill:
+        return derep.Dereplicator(derep_mode)
+    batches = ((blocks, np.logical_and.reduce([chain.passed(block) for block in blocks]))
+               for blocks in walk())
+    return derep.spilled_dereplicator(derep_mode, batches, work_dir)
+
+
+def output_path(fastq_path, kind, tag, compress=False):
+    """
+    prinseq output file name, kind is good, good_singletons or bad.
+    """
+    return '{}_prinseq_{}_{}.fastq{}'.format(fastq_path, kind, tag, '.gz' if compress else '')
+
+
+class _Counter(object):
+
+    def __init__(self):
+        self.sequences = 0
+        self.bases = 0
+
+    def add(self, block, selected=None):
+        lengths = block.seq_lengths()
+        if selected is not None:
+            lengths = lengths[selected]
+        self.sequences += len(lengths)
+        self.bases += int(lengths.sum())
+
+
+class _Output(_Counter):
+    """
+    Counts the records sent to an output and writes them to path, records
+    are only counted when path is None.
+    """
+
+    def __init__(self, path, compress=False):
+        super(_Output, self).__init__()
+        self.writer = None
+        if path is not None:
+            opener = fastq.BlockGzipWriter if compress else open
+            self.writer = fastq.FastqWriter(path, opener=opener)
+
+    def write(self, block, selected):
+        if self.writer is not None:
+            self.writer.write_block(block, selected)
+        self.add(block, selected)
+
+    def flush(self):
+        if self.writer is not None:
+            self.writer.flush()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            if self.sequences == 0:
+                os.remove(self.writer.path)
+
+    def discard(self):
+        if self.writer is not None:
+            self.writer.close()
+            os.remove(self.writer.path)
+
+
+def _outputs(fastq_paths, kind, tag, compress, write):
+    return [_Output(output_path(path, kind, tag, compress) if write else None, compress)
+            for path in fastq_paths]
+
+
+def filter_single_end(fastq_path, lc_method, lc_threshold, compress=False, stats_only=False,
+                      keep_bad=False, scorer=None, filters=None, derep_mode=None,
+                      derep_spill=False, source=None, pipeline=None):
+    """
+    Low complexity filter a single end FASTQ file, gzipped or not.
+
+    Outputs are gzipped when compress is set and not written at all when
+    stats_only is set. Bad reads are written (gzipped) only with keep_bad.
+    scorer (a scorecache.Scorer) can provide cached scores and filters the
+    values of the CHAIN_FILTERS applied first. derep_mode (one of
+    derep.DEREP_MODES) removes duplicate reads, with derep_spill their
+    fingerprints are not kept in memory. source, a (path, start, end) byte
+    range, is read instead of fastq_path, which then only names the
+    outputs. pipeline (a shmpipe.Pipeline) scores the reads on several
+    processes, scorer then only gives the scoring options.
+    Returns the prinseq style stats text.
+    """
+    scorer = scorer or Scorer(lc_method, precheck=lc_threshold)
+    source = source or (fastq_path, 0, None)
+    work_dir = os.path.dirname(os.path.abspath(fastq_path))
+    dereplicator = _dereplicator(FilterChain(lc_method, lc_threshold, filters), derep_mode,
+                                 derep_spill,
+                                 lambda: ([block] for block in fastq.map_blocks(*source)),
+                                 work_dir)
+    chain = FilterChain(lc_method, lc_threshold, filters, dereplicator)
+    tag = uuid.uuid4().hex[:4]
+    total = _Counter()
+    good, = _outputs([fastq_path], 'good', tag, compress, not stats_only)
+    bad, = _outputs([fastq_path], 'bad', tag, True, keep_bad and not stats_only)
+    if pipeline is None:
+        kept = (([block], [chain.keep(block, scorer.keys(0, block))])
+                for block in fastq.map_blocks(*source))
+    else:
+        kept = pipeline.kept([source], chain, scorer)
+    try:
+        for (block,), (keep,) in kept:
+            total.add(block)
+            good.write(block, keep)
+            bad.write(block, ~keep)
+            if pipeline is not None:
+                # the block goes back to the pipeline with the next one
+                good.flush()
+                bad.flush()
+                del block, keep
+    finally:
+        kept.close()
+        good.close()
+        bad.close()
+    return format_stats([('', total, None)],
+                        [('', good, total.sequences)],
+                        [('', bad, total.sequences)],
+                        chain.filtered(), scorer.memo_counts(),
+                        scorer.precheck_counts())
+
+
+def _filter_pairs(fastq_paths, tag, scorer, chain, compress, stats_only, keep_bad,
+                  kept_pairs, orphan_paths, transient=False):
+    # kept_pairs yields the paired blocks with their keep masks, transient
+    # blocks have to be written out before the next ones are asked for
+    totals = [_Counter(), _Counter()]
+    goods = _outputs(fastq_paths, 'good', tag, compress, not stats_only)
+    singletons = _outputs(fastq_paths, 'good_singletons', tag, compress, not stats_only)
+    bads = _outputs(fastq_paths, 'bad', tag, True, keep_bad and not stats_only)
+    outputs = goods + singletons + bads
+    try:
+        for blocks, keeps in kept_pairs:
+            paired = np.logical_and(*keeps)
+            for i, block in enumerate(blocks):
+                totals[i].add(block)
+                goods[i].write(block, paired)
+                singletons[i].write(block, keeps[i] & ~paired)
+                bads[i].write(block, ~keeps[i])
+            if transient:
+                for output in outputs:
+                    output.flush()
+                del blocks, keeps, block
+        # reads whose mate is missing can only be singletons
+        for i, orphan_path in enumerate(orphan_paths):
+            for block in fastq.map_blocks(orphan_path):
+                keep = chain.keep_orphans(block, scorer.keys(i, block))
+                totals[i].add(block)
+                singletons[i].write(block, keep)
+                bads[i].write(block, ~keep)
+    except Exception:
+        for output in outputs:
+            output.discard()
+        raise
+    finally:
+        kept_pairs.close()
+    for output in outputs:
+        output.close()
+
+    good_pairs = _Counter()
+    good_pairs.sequences = goods[0].sequences
+    good_pairs.bases = goods[0].bases + goods[1].bases
+    return format_stats([(' (file 1)', totals[0], None), (' (file 2)', totals[1], None)],
+                        [(' (pairs)', good_pairs, totals[0].sequences),
+                         (' (singletons file 1)', singletons[0], totals[0].sequences),
+                         (' (singletons file 2)', singletons[1], totals[1].sequences)],
+                        [(' (file 1)', bads[0], totals[0].sequences),
+                         (' (file 2)', bads[1], totals[1].sequences)],
+                        chain.filtered(), scorer.memo_counts(),
+                        scorer.precheck_counts())
+
+
+def filter_paired_end(fwd_path, rev_path, lc_method, lc_threshold, compress=False,
+                      stats_only=False, keep_bad=False, scorer=None, filters=None,
+                      derep_mode=None, derep_spill=False, sources=None, pipeline=None,
+                      resync=True):
+    """
+    Low complexity filter the two files of a paired end library, gzipped or
+    not. Outputs are gzipped when compress is set and not written at all
+    when stats_only is set. Bad reads are written (gzipped) only with
+    keep_bad.
+
+    Pairs where both reads pass go to the good files, pairs where only one
+    read passes go to the singletons file of that direction.
+    The files are walked in lockstep; if the mates turn out not to be in the
+    same order they are paired by identifier in external memory instead.
+    scorer (a scorecache.Scorer) can provide cached scores and filters the
+    values of the CHAIN_FILTERS applied first. derep_mode (one of
+    derep.DEREP_MODES) removes duplicate pairs, with derep_spill their
+    fingerprints are not kept in memory. sources, (path, start, end) byte
+    ranges, are read instead of the two files, which then only name the
+    outputs. pipeline (a shmpipe.Pipeline) scores the pairs on several
+    processes, scorer then only gives the scoring options. Without resync,
+    files out of sync raise pairing.OutOfSync instead of being paired by
+    identifier.
+    Returns the prinseq style stats text.
+    """
+    scorer = scorer or Scorer(lc_method, precheck=lc_threshold)
+    tag = uuid.uuid4().hex[:4]
+    work_dir = os.path.dirname(os.path.abspath(fwd_path))
+
+    def process(walk, orphan_paths):
+        # only the lockstep walk sees the reads in file order
+        pair_scorer = scorer.unordered() if orphan_paths else scorer
+        dereplicator = _dereplicator(FilterChain(lc_method, lc_threshold, filters), derep_mode,
+                                     derep_spill, walk, work_dir)
+        chain = FilterChain(lc_method, lc_threshold, filters, dereplicator)
+        if pipeline is None:
+            kept_pairs = ((blocks, chain.keep_pairs(blocks, [pair_scorer.keys(i, block)
+                                                             for i, block in enumerate(blocks)]))
+                          for blocks in walk())
+        else:
+            kept_pairs = pipeline.kept(walk.sources, chain, pair_scorer)
+        return _filter_pairs([fwd_path, rev_path], tag, pair_scorer, chain, compress,
+                             stats_only, keep_bad, kept_pairs, orphan_paths,
+                             pipeline is not None)
+
+    return pairing.process_pairs(fwd_path, rev_path, process, sources, resync)
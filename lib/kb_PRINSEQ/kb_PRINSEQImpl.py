@@ -2,15 +2,25 @@
 #BEGIN_HEADER
 import os
 import re
-import shlex
 import shutil
-import subprocess
 import sys
 import tempfile
 
 from installed_clients.KBaseReportClient import KBaseReport
 from installed_clients.ReadsUtilsClient import ReadsUtils
 from installed_clients.WorkspaceClient import Workspace as workspaceService
+from kb_PRINSEQ import derep
+from kb_PRINSEQ import fastq
+from kb_PRINSEQ import filtering
+from kb_PRINSEQ import parallel
+from kb_PRINSEQ import prinseq
+from kb_PRINSEQ import shmpipe
+from kb_PRINSEQ import sweep
+from kb_PRINSEQ.stages import UPLOAD_THREADS, StageTimes, run_stages
+from kb_PRINSEQ.memo import ResultMemo
+from kb_PRINSEQ.scorecache import (DEFAULT_MAX_BYTES, DEFAULT_MEMO_ENTRIES, ScoreCache,
+                                   ScoreMemo, Scorer)
+from kb_PRINSEQ.stats import summarize_stats
 #END_HEADER
 
 
@@ -50,6 +60,144 @@ execReadLibraryPRINSEQ() to run PRINSEQ low complexity filtering on a single Rea
         print(message)
         sys.stdout.flush()
 
+    def _prinseq_log(self, message):
+        self._log(None, message)
+
+    def _compress_prinseq_outputs(self, export_dir, kinds):
+        # prinseq-lite only writes plain FASTQ
+        for read_filename in os.listdir(export_dir):
+            if read_filename.endswith('.gz'):
+                continue
+            if any("_prinseq_{}_".format(kind) in read_filename for kind in kinds):
+                fastq.gzip_file(os.path.join(export_dir, read_filename))
+
+    def _upload_outputs(self, readsUtils_Client, input_params, uploads, compress_io, times):
+        # uploads are (return key, object name, description, files) of the
+        # objects to save. Plain prinseq outputs are gzipped here with
+        # compress_io, so that an object is uploaded while the next ones are
+        # still compressed
+        def compress(upload):
+            ref_key, name, description, files = upload
+            if compress_io:
+                files = dict((key, path if path.endswith('.gz') else fastq.gzip_file(path))
+                             for key, path in files.items())
+            return ref_key, name, description, files
+
+        def save(upload):
+            ref_key, name, description, files = upload
+            self._log(None, 'Saving {}'.format(description))
+            params = {'wsname': str(input_params['output_ws']),
+                      'name': name,
+                      'source_reads_ref': input_params['input_reads_ref']}
+            params.update(files)
+            return ref_key, description, readsUtils_Client.upload_reads(params)['obj_ref']
+
+        return run_stages(uploads, [('compress', compress, 1),
+                                    ('upload', save, UPLOAD_THREADS)], times)
+
+    def _bad_reads_links(self, export_dir):
+        return [{'path': os.path.join(export_dir, read_filename),
+                 'name': read_filename,
+                 'description': 'Reads removed by low complexity filtering'}
+                for read_filename in sorted(os.listdir(export_dir))
+                if "_prinseq_bad_" in read_filename]
+
+    def _cached_scorer(self, info, lc_method, lc_threshold=None):
+        # scores are cached per object version: wsid/objid/version
+        key = ScoreCache.key('{}/{}/{}'.format(info[6], info[0], info[4]), lc_method)
+        cached, cached_bounds = self.score_cache.load(key) or (None, None)
+        if cached is not None:
+            self._log(None, 'Using cached {} scores'.format(lc_method))
+        # keys settled by the precheck are recorded as bounds, a later run
+        # scores them exactly where lc_threshold needs it
+        precheck = lc_threshold if self.lc_precheck else None
+        return key, Scorer(lc_method, cached=cached, record=True,
+                           memo=ScoreMemo(lc_method, self.score_memo_entries),
+                           precheck=precheck, cached_bounds=cached_bounds)
+
+    def _index_keys(self, info, directions):
+        # downloads of the same object version have the same offsets
+        return ['{}/{}/{}:{}'.format(info[6], info[0], info[4], direction)
+                for direction in directions]
+
+    def _pipeline(self, scorer, num_threads):
+        # cached keys need no scoring, one process reads them faster than the
+        # pipeline would hand the reads around
+        if scorer.cached is not None:
+            self._log(None, 'Filtering on one process with the cached scores')
+            return None
+        return shmpipe.Pipeline(num_threads)
+
+    def _filter(self, info, fastq_paths, lc_method, lc_threshold, engine, num_threads,
+                compress_io, stats_only, keep_bad_reads, filters, derep_mode, tempdir,
+                export_dir):
+        # filter the single end file or the two paired end files of fastq_paths,
+        # returns the outputs holding the stats
+        num_files = len(fastq_paths)
+        native = filtering.filter_paired_end if num_files == 2 else filtering.filter_single_end
+        args = fastq_paths + [lc_method, lc_threshold, compress_io, stats_only, keep_bad_reads]
+        if num_threads > 1 and engine == 'native' and self.shm_pipeline:
+            self._log(None, 'Running native filtering on {} workers'.format(num_threads))
+            score_key, scorer = self._cached_scorer(info, lc_method, lc_threshold)
+            output = [native(*args, scorer=scorer, filters=filters,
+                             pipeline=self._pipeline(scorer, num_threads))]
+            self._save_scores(score_key, scorer, num_files)
+        elif num_threads > 1:
+            self._log(None, 'Running {} filtering on {} shards'.format(engine, num_threads))
+            output = [parallel.filter_sharded(engine, fastq_paths, lc_method, lc_threshold,
+                                              num_threads, tempdir, compress_io, stats_only,
+                                              keep_bad_reads, filters, self.fastq_index_dir,
+                                              self._index_keys(info,
+                                                               ['fwd', 'rev'][:num_files]))]
+        elif engine == 'native':
+            self._log(None, 'Running native low complexity filtering')
+            score_key, scorer = self._cached_scorer(info, lc_method, lc_threshold)
+            output = [native(*args, scorer=scorer, filters=filters, derep_mode=derep_mode,
+                             derep_spill=self._derep_spill(derep_mode, fastq_paths))]
+            self._save_scores(score_key, scorer, num_files)
+        else:
+            for fastq_path in fastq_paths:
+                fastq.gunzip_in_place(fastq_path)
+            output = prinseq.run(prinseq.build_command(fastq_paths[0],
+                                                       fastq_paths[1] if num_files == 2 else None,
+                                                       lc_method, lc_threshold, stats_only,
+                                                       keep_bad_reads, filters, derep_mode),
+                                 None if stats_only else fastq_paths[0], self._prinseq_log)
+            # good reads are compressed on their way to the upload
+            self._compress_prinseq_outputs(export_dir, ['bad'])
+        return output
+
+    def _save_scores(self, key, scorer, num_files):
+        recorded = scorer.recorded(num_files)
+        if recorded is not None:
+            self.score_cache.store(key, *recorded)
+
+    def _derep_spill(self, derep_mode, fastq_paths):
+        # fingerprints of large inputs are partitioned on disk, not held in memory
+        return (derep_mode is not None and
+                sum(os.path.getsize(path) for path in fastq_paths) >= self.derep_spill_bytes)
+
+    def _memoized_output(self, wsClient, token, memo_key, output_ws, object_name):
+        # the objects of an identical earlier run are reused while their names
+        # still refer to them, a new report records this run reusing them
+        memoized = ResultMemo(wsClient).load(output_ws, memo_key, {
+            'output_filtered_ref': object_name,
+            'output_unpaired_fwd_ref': '{}_fwd_singletons'.format(object_name),
+            'output_unpaired_rev_ref': '{}_rev_singletons'.format(object_name)})
+        if memoized is None:
+            return None
+        report_ref, memo_report, refs = memoized
+        message = 'Reused the results of an identical earlier run (report {}).\n{}'.format(
+            report_ref, memo_report['text_message'])
+        report_info = KBaseReport(self.callback_url, token=token).create_extended_report({
+            'message': message,
+            'objects_created': memo_report.get('objects_created') or [],
+            'workspace_name': output_ws})
+        output = {'report_name': report_info['name'], 'report_ref': report_info['ref'],
+                  'report': message, 'stats': summarize_stats(memo_report['text_message'])}
+        output.update(refs)
+        return output
+
     def _setup_pe_files(self, readsLibrary, export_dir, input_params):
         # Download reads Libs to FASTQ files
         input_files_info = dict()
@@ -77,6 +225,17 @@ execReadLibraryPRINSEQ() to run PRINSEQ low complexity filtering on a single Rea
         self.scratch = config['scratch']
         self.callback_url = os.environ['SDK_CALLBACK_URL']
         self.ws_url = config['workspace-url']
+        self.score_cache = ScoreCache(config.get('score-cache-dir') or
+                                      os.path.join(self.scratch, 'score_cache'),
+                                      int(config.get('score-cache-max-bytes') or
+                                          DEFAULT_MAX_BYTES))
+        self.fastq_index_dir = (config.get('fastq-index-dir') or
+                                os.path.join(self.scratch, 'fastq_index'))
+        self.score_memo_entries = int(config.get('score-memo-entries') or DEFAULT_MEMO_ENTRIES)
+        self.derep_spill_bytes = int(config.get('derep-spill-bytes') or derep.DEFAULT_SPILL_BYTES)
+        self.lc_precheck = (config.get('lc-precheck') or 'true').lower() != 'false'
+        self.shm_pipeline = (shmpipe.available() and
+                             (config.get('shm-pipeline') or 'true').lower() != 'false')
         #END_CONSTRUCTOR
         pass
 
@@ -87,23 +246,94 @@ execReadLibraryPRINSEQ() to run PRINSEQ low complexity filtering on a single Rea
            execReadLibraryPRINSEQ input input_reads_ref : may be
            KBaseFile.PairedEndLibrary or KBaseFile.SingleEndLibrary output_ws
            : workspace to write to output_reads_name : obj_name to create
-           lc_method : Low complexity method - value must be "dust" or
-           "entropy" lc_entropy_threshold : Low complexity threshold - Value
-           must be an integer between 0 and 100. Note a higher
-           lc_entropy_threshold in entropy is more stringent.
+           lc_method : Low complexity method - value must be "dust",
+           "entropy" or "both" (DUST and entropy scored in one pass by the
+           native engine, using both thresholds) lc_entropy_threshold :
+           Low complexity threshold - Value must be an integer between 0
+           and 100. Note a higher lc_entropy_threshold in entropy is more
+           stringent.
            lc_dust_threshold : Low complexity threshold - Value must be an
            integer between 0 and 100. Note a lower lc_entropy_threshold is
-           less stringent with dust) -> structure: parameter
+           less stringent with dust lc_combine : For lc_method "both",
+           "and" (default) keeps the reads passing both thresholds, "or" the
+           reads passing either engine : Filtering engine - "prinseq"
+           (default) runs prinseq-lite.pl, "native" scores the reads in
+           process with NumPy num_threads : Number of parallel processes
+           (default 1); prinseq filters that many shards, the native engine
+           scores the reads on that many workers fed through shared memory
+           compress_io : 1 to download the
+           reads gzipped, decompress them on the fly and upload gzipped
+           results (default 0) mode : "filter" (default) or "stats_only" to
+           only score the reads and return the counts, without writing
+           reads, objects or a report, or "sweep" to return the reads kept
+           at every threshold from 0 to 100 instead of filtering
+           (lc_*_threshold are ignored) keep_bad_reads : 1 to keep the reads
+           removed by the filter, gzipped and attached to the report
+           (default 0, they are only counted) min_len : remove reads shorter
+           than this min_qual_mean : remove reads with a lower mean quality
+           (Phred+33) ns_max_p : remove reads with more than this percentage
+           of Ns; these are applied before lc_method, in the same pass, and
+           a read is counted against the first filter it fails derep :
+           "exact" to remove duplicate reads (pairs for paired end input),
+           "revcomp" to also remove reverse complement duplicates; only the
+           first copy is kept and derep runs right before lc_method) ->
+           structure: parameter
            "input_reads_ref" of type "data_obj_ref", parameter "output_ws" of
            type "workspace_name" (Common Types), parameter
            "output_reads_name" of type "data_obj_name", parameter "lc_method"
            of String, parameter "lc_entropy_threshold" of Long, parameter
-           "lc_dust_threshold" of Long
-        :returns: instance of type "outputReadLibraryExecPRINSEQ" ->
-           structure: parameter "output_filtered_ref" of type "data_obj_ref",
-           parameter "output_unpaired_fwd_ref" of type "data_obj_ref",
-           parameter "output_unpaired_rev_ref" of type "data_obj_ref",
-           parameter "report" of String
+           "lc_dust_threshold" of Long, parameter "lc_combine" of String,
+           parameter "engine" of String,
+           parameter "num_threads" of Long, parameter "compress_io" of type
+           "boolean" (A boolean - 0 for false, 1 for true. @range (0, 1)),
+           parameter "mode" of String, parameter "keep_bad_reads" of type
+           "boolean" (A boolean - 0 for false, 1 for true. @range (0, 1)),
+           parameter "min_len" of Long, parameter "min_qual_mean" of Long,
+           parameter "ns_max_p" of Long, parameter "derep" of String
+        :returns: instance of type "outputReadLibraryExecPRINSEQ"
+           (output_filtered_ref : filtered reads (pairs for paired end
+           input) output_unpaired_fwd_ref / output_unpaired_rev_ref : reads
+           kept without their mate report : text of the report stats :
+           counts parsed from the PRINSEQ stats sweep : reads kept at every
+           threshold, for mode "sweep" stage_seconds : wall time of every
+           stage of the run (download, filter, compress, upload, report) and
+           of the whole run (total); compress and upload overlap) ->
+           structure: parameter
+           "output_filtered_ref" of type "data_obj_ref", parameter
+           "output_unpaired_fwd_ref" of type "data_obj_ref", parameter
+           "output_unpaired_rev_ref" of type "data_obj_ref", parameter
+           "report" of String, parameter "report_name" of String, parameter
+           "report_ref" of String, parameter "stats" of type "filterStats"
+           (Counts parsed from the PRINSEQ "Input and filter stats:" block.
+           input_reads, input_bases : both files of a pair added up
+           good_reads : all reads kept good_pairs : pairs where both mates
+           were kept singletons_fwd, singletons_rev : reads kept without
+           their mate lc_method_removed : reads removed by the low
+           complexity filter removed_by : reads removed per filter line of
+           the stats score_memo_lookups, score_memo_hits,
+           score_memo_hit_rate : reads scored by the native engine and the
+           share of them whose score came from the memo of repeated
+           sequences (missing for prinseq and cached scores) precheck_reads,
+           precheck_settled, precheck_settled_fraction : reads scored
+           through the entropy precheck and the share of them settled by
+           its first tier (entropy and both with the native engine))
+           -> structure: parameter "input_reads" of Long, parameter
+           "input_bases" of Long, parameter "good_reads" of Long,
+           parameter "good_pairs" of Long, parameter "singletons_fwd" of
+           Long, parameter "singletons_rev" of Long, parameter
+           "lc_method_removed" of Long, parameter "removed_by" of mapping
+           from String to Long, parameter "score_memo_lookups" of Long,
+           parameter "score_memo_hits" of Long, parameter
+           "score_memo_hit_rate" of Double, parameter "precheck_reads" of
+           Long, parameter "precheck_settled" of Long, parameter
+           "precheck_settled_fraction" of Double, parameter "sweep" of list
+           of type "sweepPoint" (Reads kept at one threshold of a sweep. reads,
+           bases : all reads kept, both mates of a pair counted pairs,
+           singletons_fwd, singletons_rev : paired end input only) ->
+           structure: parameter "threshold" of Long, parameter "reads" of
+           Long, parameter "bases" of Long, parameter "pairs" of Long,
+           parameter "singletons_fwd" of Long, parameter "singletons_rev" of
+           Long, parameter "stage_seconds" of mapping from String to Double
         """
         # ctx is the context object
         # return variables are: output
@@ -113,9 +343,6 @@ execReadLibraryPRINSEQ() to run PRINSEQ low complexity filtering on a single Rea
 #        self.log(console, "\n"+pformat(input_params))
         report = ''
         returnVal = dict()
-#        retVal['output_filtered_ref'] = None
-#        retVal['output_unpaired_fwd_ref'] = None
-#        retVal['output_unpaired_rev_ref'] = None
 
         token = ctx['token']
         wsClient = workspaceService(self.ws_url, token=token)
@@ -131,12 +358,54 @@ execReadLibraryPRINSEQ() to run PRINSEQ low complexity filtering on a single Rea
             if required_param not in input_params or input_params[required_param] is None:
                 raise ValueError("Must define required param: '" + required_param + "'")
 
-        if (input_params['lc_method'] != 'dust') and (input_params['lc_method'] != 'entropy'):
-            raise ValueError("lc_method (low complexity method) must be 'dust' or 'entropy', " +
-                             "it is currently set to : " +
+        if input_params['lc_method'] not in ['dust', 'entropy', 'both']:
+            raise ValueError("lc_method (low complexity method) must be 'dust', 'entropy' " +
+                             "or 'both', it is currently set to : " +
+                             input_params['lc_method'])
+
+        engine = input_params.get('engine') or 'prinseq'
+        if engine not in ['prinseq', 'native']:
+            raise ValueError("engine must be 'prinseq' or 'native', " +
+                             "it is currently set to : " + str(engine))
+        if input_params['lc_method'] == 'both' and engine != 'native':
+            # prinseq-lite applies one lc_method per run
+            self._log(None, "lc_method 'both' is scored by the native engine")
+            engine = 'native'
+        if engine == 'native' and input_params['lc_method'] not in filtering.NATIVE_LC_METHODS:
+            raise ValueError("The native engine does not support lc_method : " +
                              input_params['lc_method'])
 
-        if not ('lc_entropy_threshold' in input_params or 'lc_dust_threshold' in input_params):
+        num_threads = input_params.get('num_threads') or 1
+        if not isinstance(num_threads, int) or num_threads < 1:
+            raise ValueError("num_threads must be a positive integer, it is currently set to : " +
+                             str(num_threads))
+
+        compress_io = bool(input_params.get('compress_io'))
+
+        mode = input_params.get('mode') or 'filter'
+        if mode not in ['filter', 'stats_only', 'sweep']:
+            raise ValueError("mode must be 'filter', 'stats_only' or 'sweep', " +
+                             "it is currently set to : " + str(mode))
+        stats_only = mode == 'stats_only'
+        keep_bad_reads = bool(input_params.get('keep_bad_reads')) and not stats_only
+
+        if mode == 'sweep':
+            if input_params['lc_method'] == 'both':
+                raise ValueError("The sweep needs lc_method 'dust' or 'entropy'")
+            # every threshold from 0 to 100 is scored
+            lc_threshold = None
+        elif input_params['lc_method'] == 'both':
+            if not ('lc_dust_threshold' in input_params and 'lc_entropy_threshold' in input_params):
+                raise ValueError("lc_dust_threshold and lc_entropy_threshold both need to be " +
+                                 "entered for both")
+            lc_combine = input_params.get('lc_combine') or 'and'
+            if lc_combine not in filtering.BOTH_RULES:
+                raise ValueError("lc_combine must be 'and' or 'or', it is currently set to : " +
+                                 str(lc_combine))
+            lc_threshold = {'dust': input_params['lc_dust_threshold'],
+                            'entropy': input_params['lc_entropy_threshold'],
+                            'rule': lc_combine}
+        elif not ('lc_entropy_threshold' in input_params or 'lc_dust_threshold' in input_params):
             raise ValueError(("A low complexity threshold needs to be " +
                               "entered for {}".format(input_params['lc_method'])))
         elif input_params['lc_method'] == 'dust':
@@ -152,10 +421,44 @@ execReadLibraryPRINSEQ() to run PRINSEQ low complexity filtering on a single Rea
             else:
                 lc_threshold = input_params['lc_entropy_threshold']
 
-        if (lc_threshold < 0.0) or (lc_threshold > 100.0):
-            raise ValueError(("The threshold for {} must be between 0 and 100, it is currently " +
-                              "set to : {}").format(input_params['lc_method'],
-                                                    lc_threshold))
+        if isinstance(lc_threshold, dict):
+            checked_thresholds = [('dust', lc_threshold['dust']),
+                                  ('entropy', lc_threshold['entropy'])]
+        elif lc_threshold is not None:
+            checked_thresholds = [(input_params['lc_method'], lc_threshold)]
+        else:
+            checked_thresholds = []
+        for threshold_method, threshold in checked_thresholds:
+            if (threshold < 0.0) or (threshold > 100.0):
+                raise ValueError(("The threshold for {} must be between 0 and 100, it is " +
+                                  "currently set to : {}").format(threshold_method, threshold))
+
+        # prinseq filters applied before lc_method, in the same pass
+        filters = {}
+        for name in filtering.CHAIN_FILTERS:
+            value = input_params.get(name)
+            if value is None:
+                continue
+            if not isinstance(value, int) or value < 0:
+                raise ValueError("{} must be a non negative integer, it is currently set to : {}"
+                                 .format(name, value))
+            filters[name] = value
+        if filters.get('ns_max_p', 0) > 100:
+            raise ValueError("ns_max_p must be between 0 and 100, it is currently set to : " +
+                             str(filters['ns_max_p']))
+
+        derep_mode = input_params.get('derep') or None
+        if derep_mode is not None and derep_mode not in derep.DEREP_MODES:
+            raise ValueError("derep must be 'exact' or 'revcomp', it is currently set to : " +
+                             str(derep_mode))
+        if derep_mode is not None and num_threads > 1:
+            # duplicates can be in different shards
+            self._log(None, 'derep runs in a single process, num_threads ignored')
+            num_threads = 1
+        if (filters or derep_mode) and mode == 'sweep':
+            ignored = sorted(filters) + (['derep'] if derep_mode else [])
+            self._log(None, 'The sweep only scores lc_method, {} ignored'.format(
+                ', '.join(ignored)))
         reportObj = {'objects_created': [],
                      'text_message': ''}
 
@@ -163,8 +466,6 @@ execReadLibraryPRINSEQ() to run PRINSEQ low complexity filtering on a single Rea
         provenance = [{}]
         if 'provenance' in ctx:
             provenance = ctx['provenance']
-        # add additional info to provenance here, in this case the input data object reference
-        provenance[0]['input_ws_objects'] = [str(input_params['input_reads_ref'])]
 
         # GET THE READS OBJECT
         # Determine whether read library or read set is input object
@@ -186,6 +487,38 @@ execReadLibraryPRINSEQ() to run PRINSEQ low complexity filtering on a single Rea
             raise ValueError('Unable to get read library object from workspace: (' +
                              str(input_params['input_reads_ref']) + ')' + str(e))
 
+        # add additional info to provenance here, in this case the exact version of the
+        # input data object
+        input_upa = '{}/{}/{}'.format(input_reads_obj_info[WSID_I],
+                                      input_reads_obj_info[OBJID_I],
+                                      input_reads_obj_info[VERSION_I])
+        provenance[0]['input_ws_objects'] = [input_upa]
+
+        # identical filter requests return the objects made the first time
+        memo_key = None
+        if mode == 'filter':
+            memo_key = ResultMemo.key({'input_upa': input_upa,
+                                       'input_checksum': input_reads_obj_info[CHSUM_I],
+                                       'lc_method': input_params['lc_method'],
+                                       'lc_threshold': lc_threshold,
+                                       'engine': engine,
+                                       'keep_bad_reads': keep_bad_reads,
+                                       'filters': filters,
+                                       'derep': derep_mode,
+                                       'output_ws': str(input_params['output_ws']),
+                                       'output_reads_name':
+                                       input_params.get('output_reads_name') or
+                                       input_reads_obj_info[NAME_I],
+                                       'module_version': self.VERSION,
+                                       'prinseq_version': prinseq.PRINSEQ_VERSION})
+            memoized = self._memoized_output(wsClient, token, memo_key,
+                                             input_params['output_ws'],
+                                             input_params.get('output_reads_name') or
+                                             input_reads_obj_info[NAME_I])
+            if memoized is not None:
+                self._log(None, 'Returning the results of an identical earlier run')
+                return [memoized]
+
         # self.log (console, "B4 TYPE: '" +
         #           str(input_reads_obj_type) +
         #           "' VERSION: '" + str(input_reads_obj_version)+"'")
@@ -209,14 +542,19 @@ execReadLibraryPRINSEQ() to run PRINSEQ low complexity filtering on a single Rea
                                       "KBaseAssembly.SingleEndLibrary"]:
             read_type = 'SE'
 
+        # download -> filter -> compress -> upload -> report, see stages
+        times = StageTimes()
+        times.begin('download')
+
         # Instatiate ReadsUtils
         try:
             readsUtils_Client = ReadsUtils(url=self.callback_url, token=ctx['token'])  # SDK local
             self._log(None, 'Starting Read File(s) Download')
-            readsLibrary = readsUtils_Client.download_reads({'read_libraries':
-                                                            [input_params['input_reads_ref']],
-                                                             'interleaved': 'false'
-                                                             })
+            download_params = {'read_libraries': [input_params['input_reads_ref']],
+                               'interleaved': 'false'}
+            if compress_io:
+                download_params['gzipped'] = 'true'
+            readsLibrary = readsUtils_Client.download_reads(download_params)
             self._log(None, 'Completed Read File(s) Downloading')
         except Exception as e:
             raise ValueError(('Unable to get read library object from workspace: ({})\n')
@@ -247,7 +585,23 @@ execReadLibraryPRINSEQ() to run PRINSEQ low complexity filtering on a single Rea
         export_dir = os.path.join(tempdir, info[1])
         os.makedirs(export_dir)
 
-        if read_type == 'PE':
+        times.begin('filter')
+        if mode == 'sweep':
+            # score every read once with the native engine, nothing is written
+            self._log(None, 'Scoring reads for the threshold sweep')
+            score_key, scorer = self._cached_scorer(info, input_params['lc_method'])
+            if read_type == 'PE':
+                input_files_info = self._setup_pe_files(readsLibrary, export_dir, input_params)
+                sweep_points = sweep.sweep_paired_end(input_files_info["fastq_file_path"],
+                                                      input_files_info["fastq2_file_path"],
+                                                      input_params['lc_method'], scorer)
+                self._save_scores(score_key, scorer, 2)
+            else:
+                sweep_points = sweep.sweep_single_end(
+                    readsLibrary['files'][input_params['input_reads_ref']]['files']['fwd'],
+                    input_params['lc_method'], scorer)
+                self._save_scores(score_key, scorer, 1)
+        elif read_type == 'PE':
             # IF PAIRED END, potentially 6 files created
             # one of each for the two directions(good(paired), good_singletons, bad)
             # Take the good paired and (re)upload new reads object.
@@ -256,26 +610,21 @@ execReadLibraryPRINSEQ() to run PRINSEQ low complexity filtering on a single Rea
             input_files_info = self._setup_pe_files(readsLibrary, export_dir, input_params)
 
             # RUN PRINSEQ with user options (lc_method and lc_threshold)
-            cmd = ("perl /opt/lib/prinseq-lite-0.20.4/prinseq-lite.pl -fastq {} "
-                   "-fastq2 {} -out_format 3 -lc_method {} "
-                   "-lc_threshold {}").format(input_files_info["fastq_file_path"],
-                                              input_files_info["fastq2_file_path"],
-                                              input_params['lc_method'],
-                                              lc_threshold)
-            print("Command to be run : " + cmd)
-            args = shlex.split(cmd)
-            perl_script = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            output = perl_script.communicate()
+            output = self._filter(info, [input_files_info["fastq_file_path"],
+                                         input_files_info["fastq2_file_path"]],
+                                  input_params['lc_method'], lc_threshold, engine, num_threads,
+                                  compress_io, stats_only, keep_bad_reads, filters, derep_mode,
+                                  tempdir, export_dir)
             found_results = False
             file_names_dict = dict()
             for element in output:
-                element = element.decode()
                 if "Input and filter stats:" in element:
                     found_results = True
                     element_parts = element.split("Input and filter stats:")
                     # PRINSEQ OUTPUT
                     report = "Input and filter stats:{}".format(element_parts[1])
                     reportObj['text_message'] = report
+                    returnVal['stats'] = summarize_stats(report)
                     read_files_list = os.listdir(export_dir)
 
                     # proc = subprocess.Popen(['ls', '-l', export_dir], stdout=subprocess.PIPE)
@@ -307,64 +656,34 @@ execReadLibraryPRINSEQ() to run PRINSEQ low complexity filtering on a single Rea
                                   in read_filename):
                                 file_names_dict["{}_good_pair".format(file_direction)] = \
                                     os.path.join(export_dir, read_filename)
+                    uploads = []
                     if (('fwd_good_pair' in file_names_dict) and
                             ('rev_good_pair' in file_names_dict)):
-                        self._log(None, 'Saving new Paired End Reads')
-                        returnVal['filtered_paired_end_ref'] = \
-                            readsUtils_Client.upload_reads({'wsname':
-                                                            str(input_params['output_ws']),
-                                                            'name': new_object_name,
-                                                            'source_reads_ref':
-                                                            input_params['input_reads_ref'],
-                                                            'fwd_file':
-                                                                file_names_dict['fwd_good_pair'],
-                                                            'rev_file':
-                                                                file_names_dict['rev_good_pair']
-                                                            }
-                                                           )['obj_ref']
-                        reportObj['objects_created'].append({'ref':
-                                                             returnVal['filtered_paired_end_ref'],
-                                                             'description':
-                                                             'Filtered Paired End Reads'})
-                        print("REFERENCE : " + str(returnVal['filtered_paired_end_ref']))
+                        uploads.append(('output_filtered_ref', new_object_name,
+                                        'Filtered Paired End Reads',
+                                        {'fwd_file': file_names_dict['fwd_good_pair'],
+                                         'rev_file': file_names_dict['rev_good_pair']}))
                     else:
                         reportObj['text_message'] += \
                             "\n\nNo good matching pairs passed low complexity filtering.\n" + \
                             "Consider loosening the threshold value.\n"
                     if 'fwd_good_singletons' in file_names_dict:
-                        self._log(None, 'Saving new Forward Unpaired Reads')
-                        fwd_object_name = "{}_fwd_singletons".format(new_object_name)
-                        returnVal['output_filtered_fwd_unpaired_end_ref'] = \
-                            readsUtils_Client.upload_reads({'wsname':
-                                                            str(input_params['output_ws']),
-                                                            'name': fwd_object_name,
-                                                            'source_reads_ref':
-                                                            input_params['input_reads_ref'],
-                                                            'fwd_file':
-                                                            file_names_dict['fwd_good_singletons']}
-                                                           )['obj_ref']
-                        reportObj['objects_created'].append(
-                            {'ref': returnVal['output_filtered_fwd_unpaired_end_ref'],
-                             'description': 'Filtered Forward Unpaired End Reads'})
-                        print("REFERENCE : " + \
-                            str(returnVal['output_filtered_fwd_unpaired_end_ref']))
+                        uploads.append(('output_unpaired_fwd_ref',
+                                        "{}_fwd_singletons".format(new_object_name),
+                                        'Filtered Forward Unpaired End Reads',
+                                        {'fwd_file': file_names_dict['fwd_good_singletons']}))
                     if 'rev_good_singletons' in file_names_dict:
-                        self._log(None, 'Saving new Reverse Unpaired Reads')
-                        rev_object_name = "{}_rev_singletons".format(new_object_name)
-                        returnVal['output_filtered_rev_unpaired_end_ref'] = \
-                            readsUtils_Client.upload_reads({'wsname':
-                                                            str(input_params['output_ws']),
-                                                            'name': rev_object_name,
-                                                            'source_reads_ref':
-                                                            input_params['input_reads_ref'],
-                                                            'fwd_file':
-                                                            file_names_dict['rev_good_singletons']}
-                                                           )['obj_ref']
-                        reportObj['objects_created'].append(
-                            {'ref': returnVal['output_filtered_rev_unpaired_end_ref'],
-                             'description': 'Filtered Reverse Unpaired End Reads'})
-                        print("REFERENCE : " + \
-                            str(returnVal['output_filtered_rev_unpaired_end_ref']))
+                        uploads.append(('output_unpaired_rev_ref',
+                                        "{}_rev_singletons".format(new_object_name),
+                                        'Filtered Reverse Unpaired End Reads',
+                                        {'fwd_file': file_names_dict['rev_good_singletons']}))
+                    times.end()
+                    for ref_key, description, ref in self._upload_outputs(
+                            readsUtils_Client, input_params, uploads, compress_io, times):
+                        returnVal[ref_key] = ref
+                        reportObj['objects_created'].append({'ref': ref,
+                                                             'description': description})
+                        print("REFERENCE : " + str(ref))
                     if len(reportObj['objects_created']) > 0:
                         reportObj['text_message'] += "\nOBJECTS CREATED :\n"
                         for obj in reportObj['objects_created']:
@@ -390,54 +709,44 @@ execReadLibraryPRINSEQ() to run PRINSEQ low complexity filtering on a single Rea
             shutil.move(input_fwd_file_path, fastq_file_path)
 
             # RUN PRINSEQ with user options (lc_method and lc_threshold)
-            cmd = ("perl /opt/lib/prinseq-lite-0.20.4/prinseq-lite.pl -fastq {} "
-                   "-out_format 3 -lc_method {} "
-                   "-lc_threshold {}").format(fastq_file_path,
-                                              input_params['lc_method'],
-                                              lc_threshold)
-            print("Command to be run : " + cmd)
-            args = shlex.split(cmd)
-            print("ARGS:  " + str(args))
-            perl_script = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            output = perl_script.communicate()
+            output = self._filter(info, [fastq_file_path], input_params['lc_method'],
+                                  lc_threshold, engine, num_threads, compress_io, stats_only,
+                                  keep_bad_reads, filters, derep_mode, tempdir, export_dir)
             print("OUTPUT: " + str(output))
             found_results = False
             found_se_filtered_file = False
             file_names_dict = dict()
             for element in output:
-                element = element.decode()
                 if "Input and filter stats:" in element:
                     found_results = True
                     element_parts = element.split("Input and filter stats:")
                     # PRINSEQ OUTPUT
                     report = "Input and filter stats:{}".format(element_parts[1])
                     reportObj['text_message'] = report
+                    returnVal['stats'] = summarize_stats(report)
                     read_files_list = os.listdir(export_dir)
 
                     for read_filename in read_files_list:
                         print("Early Read File : {}".format(read_filename))
 
+                    uploads = []
                     for read_filename in read_files_list:
                         print(f"Read File : {read_filename}")
                         if f"{fastq_filename}_prinseq_good_" in read_filename:
                             #Found Good file. Save the Reads objects
-                            self._log(None, 'Saving Filtered Single End Reads')
-                            returnVal['output_filtered_single_end_ref'] = \
-                                readsUtils_Client.upload_reads({'wsname':
-                                                                str(input_params['output_ws']),
-                                                                'name': new_object_name,
-                                                                'source_reads_ref':
-                                                                input_params['input_reads_ref'],
-                                                                'fwd_file':
-                                                                    os.path.join(export_dir,
-                                                                                 read_filename)}
-                                                               )['obj_ref']
-                            reportObj['objects_created'].append(
-                                {'ref': returnVal['output_filtered_single_end_ref'],
-                                 'description': 'Filtered Single End Reads'})
-                            print("REFERENCE : " + str(returnVal['output_filtered_single_end_ref']))
+                            uploads.append(('output_filtered_ref', new_object_name,
+                                            'Filtered Single End Reads',
+                                            {'fwd_file': os.path.join(export_dir,
+                                                                      read_filename)}))
                             found_se_filtered_file = True
                             break
+                    times.end()
+                    for ref_key, description, ref in self._upload_outputs(
+                            readsUtils_Client, input_params, uploads, compress_io, times):
+                        returnVal[ref_key] = ref
+                        reportObj['objects_created'].append({'ref': ref,
+                                                             'description': description})
+                        print("REFERENCE : " + str(ref))
             if not found_se_filtered_file:
                 reportObj['text_message'] += \
                     "\n\nNone of the reads passed low complexity filtering.\n" + \
@@ -448,14 +757,35 @@ execReadLibraryPRINSEQ() to run PRINSEQ low complexity filtering on a single Rea
             print("REPORT OBJECT :")
             print(str(reportObj))
 
-        # save report object
-        #
-        report = KBaseReport(self.callback_url, token=ctx['token'])
-        #report = KBaseReport(self.callback_url, token=ctx['token'], service_ver=SERVICE_VER)
-        report_info = report.create({'report': reportObj,
-                                    'workspace_name': input_params['output_ws']})
-
-        output = {'report_name': report_info['name'], 'report_ref': report_info['ref']}
+        times.end()
+        if mode == 'sweep':
+            output = {'report': sweep.format_sweep(sweep_points), 'sweep': sweep_points}
+        elif stats_only:
+            # nothing was written, only report the counts
+            output = {'report': report, 'stats': returnVal['stats']}
+        else:
+            # save report object
+            #
+            times.begin('report')
+            report = KBaseReport(self.callback_url, token=ctx['token'])
+            #report = KBaseReport(self.callback_url, token=ctx['token'], service_ver=SERVICE_VER)
+            # the report name is what an identical request looks up
+            report_params = {'message': reportObj['text_message'],
+                             'objects_created': reportObj['objects_created'],
+                             'workspace_name': input_params['output_ws'],
+                             'report_object_name': ResultMemo.report_name(memo_key)}
+            if keep_bad_reads:
+                # attach the removed reads to the report for auditing
+                report_params['file_links'] = self._bad_reads_links(export_dir)
+            report_info = report.create_extended_report(report_params)
+
+            output = {'report_name': report_info['name'], 'report_ref': report_info['ref'],
+                      'report': reportObj['text_message']}
+            output.update(returnVal)
+            times.end()
+        # kept out of the result memo, a reused result runs no stage
+        output['stage_seconds'] = times.summary()
+        self._log(None, times.format())
 
         #END execReadLibraryPRINSEQ
 
@@ -0,0 +1,567 @@
+# -*- coding: utf-8 -*-
+"""
+Native low complexity scoring for kb_PRINSEQ.
+
+Reimplements the DUST and entropy scoring of prinseq-lite 0.20.4
+(-lc_method dust / entropy) on batches of reads with NumPy instead of one
+read at a time in Perl.
+
+prinseq scores a read over 64 bp windows moved in steps of 32 bp, plus a
+trailing window holding the rest of the read, and counts the trinucleotides
+of every window. The read score is the mean of its window scores scaled to
+0 - 100.
+
+DUST: the window score is the number of identical trinucleotide pairs,
+normalised so that a window made of a single repeated trinucleotide scores
+31. A read is discarded when the integer part of its score is above
+-lc_threshold.
+
+Entropy: the window score is the Shannon entropy of the trinucleotide
+frequencies divided by the largest entropy the window could reach. A read
+is discarded when its score is below -lc_threshold.
+
+Bases are matched case insensitively. The kernels work on
+packed.PackedReads batches, lists of sequences are packed first, and count
+anything other than A, C, G or T as N. prinseq counts every letter apart,
+so the rare reads holding other letters (IUPAC ambiguity codes such as R
+or Y) are scored again one at a time by letter_scores(), which counts
+their trinucleotides as prinseq does; their scores replace the batch ones.
+
+Reads are laid out as the rows of a 2D matrix: all reads share the same
+window starts, so every window position is counted for all reads at once
+with whole-matrix operations. A batch of reads of a single length (as
+Illumina libraries are) is reshaped into the matrix as is, variable
+length reads are padded, their trailing windows masked. Batches where
+padding would more than double the memory are counted read by read
+(word_counts) instead.
+
+Counting every window takes a row of NUM_WORDS counts per 32 bp, too much
+memory for long (PacBio, Nanopore) reads. For those dust_scores() slides
+along the reads instead (sliding_window_pairs): the identical pairs a
+trinucleotide makes with the ones shortly before and after it are counted
+once, and the pairs of a window follow from running sums of those, in
+time linear in the read length and a few bytes per base. Only the
+trailing window of every read is counted as before.
+
+As thresholds are integers, only the integer part of a score matters:
+score_keys() reduces scores to it (one byte per read) and keep_keys()
+applies a threshold to those keys exactly like dust_keep and entropy_keep.
+lc_method "both" scores DUST and entropy from the same trinucleotide
+counts, its keys having one column per method.
+
+For a single threshold most reads are clearly complex. precheck_keys()
+bounds the entropy score of every read from below with the collision
+entropy, from the same counts DUST uses, and only computes the exact
+entropy of the reads the bound does not settle. The counts are still taken
+for every read; what the bound saves is the per-word entropy terms, about
+60% of the entropy scoring time of 150 bp reads, the counts being the rest.
+"""
+from collections import Counter
+
+import numpy as np
+
+from kb_PRINSEQ import packed
+
+WINDOW_SIZE = 64
+WINDOW_STEP = 32
+WORD_SIZE = 3
+
+# A, C, G, T and N
+ALPHABET_SIZE = 5
+NUM_WORDS = ALPHABET_SIZE ** WORD_SIZE
+
+# score of a window made of a single repeated trinucleotide
+DUST_MAX_WINDOW_SCORE = 31
+DUST_SCALE = 100 / DUST_MAX_WINDOW_SCORE
+
+# trailing windows this short cannot be scored, they count as the maximum
+# DUST window score and as a fully complex entropy window
+MIN_SCORED_WINDOW = 6
+
+# number of distinct trinucleotides without N, caps the entropy normaliser
+ENTROPY_MAX_WORDS = 4 ** WORD_SIZE
+
+# largest padded matrix, relative to the bases of the batch, worth counting
+MAX_PADDING_RATIO = 2
+
+# largest distance, in trinucleotides, between two of a full window
+MAX_PAIR_LAG = WINDOW_SIZE - WORD_SIZE
+
+# mean read length from which dust_scores() slides along the reads
+LONG_READ_LENGTH = 1000
+
+MAX_SCORE = 100
+
+# lc_methods precheck_keys() can settle reads for, by their entropy
+PRECHECK_METHODS = ['entropy', 'both']
+
+# distance kept between an entropy bound and the threshold, far above the
+# rounding of either score
+PRECHECK_MARGIN = 1e-6
+
+
+def _packed(reads):
+    if isinstance(reads, packed.PackedReads):
+        return reads
+    return packed.PackedReads.from_seqs(reads)
+
+
+def encode(reads):
+    """
+    Base codes of a batch of reads, a packed.PackedReads or a list of
+    sequences (bytes).
+
+    Returns the codes, back to back, with the offset and the length of every
+    read in them.
+    """
+    reads = _packed(reads)
+    return reads.codes(), reads.offsets, reads.lengths
+
+
+def _window_steps(lengths):
+    # full windows of every read and the length of its trailing window
+    lengths = np.asarray(lengths, dtype=np.int64)
+    steps = np.where(lengths > WINDOW_SIZE, (lengths - WINDOW_SIZE) // WINDOW_STEP + 1, 0)
+    rest = lengths - steps * WINDOW_STEP
+    # never leave a trailing window shorter than one step
+    short = (steps > 0) & (rest <= WINDOW_STEP)
+    steps[short] -= 1
+    rest[short] += WINDOW_STEP
+    return steps, rest
+
+
+def window_layout(lengths):
+    """
+    Lay out the prinseq scoring windows of every read.
+
+    Returns, per window, the read it belongs to, its index within the read,
+    its length and whether it is the trailing window of the read.
+    """
+    steps, rest = _window_steps(lengths)
+    num_windows = steps + 1
+    read_index = np.repeat(np.arange(len(lengths)), num_windows)
+    first_window = np.cumsum(num_windows) - num_windows
+    window_index = np.arange(num_windows.sum()) - np.repeat(first_window, num_windows)
+    is_last = window_index == steps[read_index]
+    window_length = np.where(is_last, rest[read_index], WINDOW_SIZE)
+    return read_index, window_index, window_length, is_last
+
+
+def word_counts(codes, window_start, window_length):
+    """
+    Count the trinucleotides of every window.
+
+    Returns an array of shape (number of windows, NUM_WORDS).
+    """
+    # word indexes stay below NUM_WORDS, so one byte per position is enough
+    padded = np.concatenate((codes, np.zeros(WORD_SIZE - 1, dtype=np.uint8)))
+    words = padded[:-2] * np.uint8(ALPHABET_SIZE * ALPHABET_SIZE) + \
+        padded[1:-1] * np.uint8(ALPHABET_SIZE) + padded[2:]
+
+    num_words = window_length - WORD_SIZE + 1
+    first_word = np.cumsum(num_words) - num_words
+    owner = np.repeat(np.arange(len(window_start)), num_words)
+    positions = np.repeat(window_start, num_words) + \
+        (np.arange(num_words.sum()) - np.repeat(first_word, num_words))
+    counts = np.bincount(owner * NUM_WORDS + words[positions],
+                         minlength=len(window_start) * NUM_WORDS)
+    return counts.reshape(len(window_start), NUM_WORDS)
+
+
+def _row_counts(words):
+    # word counts of every row of a matrix of word indexes, NUM_WORDS marks
+    # the padding and is dropped
+    offsets = np.arange(len(words), dtype=np.int64)[:, np.newaxis] * (NUM_WORDS + 1)
+    counts = np.bincount((offsets + words).ravel(), minlength=len(words) * (NUM_WORDS + 1))
+    return counts.reshape(len(words), NUM_WORDS + 1)[:, :NUM_WORDS]
+
+
+def matrix_word_counts(codes, lengths):
+    """
+    Count the trinucleotides of every window of every read, the reads being
+    the rows of a (padded) matrix.
+
+    Returns an array of shape (number of windows, NUM_WORDS), the windows in
+    the order of window_layout().
+    """
+    steps, rest = _window_steps(lengths)
+    width = int(lengths.max()) if len(lengths) else 0
+    if width < WORD_SIZE:
+        return np.zeros((int(steps.sum()) + len(lengths), NUM_WORDS), dtype=np.int64)
+
+    fixed = bool((lengths == width).all())
+    if fixed:
+        matrix = codes.reshape(len(lengths), width)
+    else:
+        matrix = np.zeros((len(lengths), width), dtype=np.uint8)
+        matrix[np.arange(width) < lengths[:, np.newaxis]] = codes
+    words = matrix[:, :-2] * np.uint8(ALPHABET_SIZE * ALPHABET_SIZE) + \
+        matrix[:, 1:-1] * np.uint8(ALPHABET_SIZE) + matrix[:, 2:]
+
+    # the words of every window, one row per (read, window), padded with
+    # NUM_WORDS; full windows start at the same offsets in every read
+    full_words = WINDOW_SIZE - WORD_SIZE + 1
+    tail_words = np.maximum(rest - WORD_SIZE + 1, 0)
+    max_steps = int(steps.max())
+    windows = np.full((len(lengths), max_steps + 1, max(full_words, int(tail_words.max()))),
+                      NUM_WORDS, dtype=np.uint8)
+    for step in range(max_steps):
+        start = step * WINDOW_STEP
+        if fixed:
+            windows[:, step, :full_words] = words[:, start:start + full_words]
+        else:
+            rows = np.flatnonzero(steps > step)
+            windows[rows, step, :full_words] = words[rows, start:start + full_words]
+
+    start = steps * WINDOW_STEP
+    if fixed:
+        windows[:, max_steps, :tail_words[0]] = words[:, start[0]:start[0] + tail_words[0]]
+    else:
+        columns = np.arange(int(tail_words.max()))
+        tail = words[np.arange(len(lengths))[:, np.newaxis],
+                     np.minimum(start[:, np.newaxis] + columns, words.shape[1] - 1)]
+        windows[np.arange(len(lengths)), steps, :len(columns)] = \
+            np.where(columns < tail_words[:, np.newaxis], tail, np.uint8(NUM_WORDS))
+
+    counts = _row_counts(windows.reshape(-1, windows.shape[2]))
+    if fixed:
+        return counts
+    # reads with fewer windows leave padding rows
+    return counts[(np.arange(max_steps + 1) <= steps[:, np.newaxis]).ravel()]
+
+
+def _mean_window_score(read_index, window_scores, num_reads):
+    # prinseq adds the window scores up in order before averaging them
+    totals = np.bincount(read_index, weights=window_scores, minlength=num_reads)
+    return totals / np.bincount(read_index, minlength=num_reads)
+
+
+class _Windows(object):
+    """
+    The scoring windows of a batch of reads with their trinucleotide counts.
+
+    counts only holds the windows long enough to be scored, listed in
+    scored.
+    """
+
+    def __init__(self, reads):
+        codes, offsets, lengths = encode(reads)
+        self.num_reads = len(lengths)
+        self.read_index, window_index, self.length, self.is_last = window_layout(lengths)
+        self.scored = np.flatnonzero(self.length >= MIN_SCORED_WINDOW)
+        width = int(lengths.max()) if len(lengths) else 0
+        if len(lengths) * width <= MAX_PADDING_RATIO * len(codes):
+            counts = matrix_word_counts(codes, lengths)
+            self.counts = counts if len(self.scored) == len(counts) else counts[self.scored]
+        else:
+            window_start = offsets[self.read_index[self.scored]] + \
+                window_index[self.scored] * WINDOW_STEP
+            self.counts = word_counts(codes, window_start, self.length[self.scored])
+        self._squares = None
+
+    def read_scores(self, window_scores):
+        return _mean_window_score(self.read_index, window_scores, self.num_reads)
+
+    def squares(self):
+        """
+        Sum of the squared trinucleotide counts of every scored window.
+        """
+        if self._squares is None:
+            self._squares = _squares(self.counts)
+        return self._squares
+
+
+def _squares(counts):
+    return np.einsum('ij,ij->i', counts, counts)
+
+
+def _count_pairs(squares, length):
+    # sum of count * (count - 1) / 2, the counts adding up to the words
+    return (squares - (length - WORD_SIZE + 1)) // 2
+
+
+def _dust_pair_scores(pairs, length, is_last):
+    # DUST score of scored windows from their identical trinucleotide pairs
+    return np.where(is_last,
+                    (pairs / (length - 3)) * ((WINDOW_SIZE - 2) / (length - 2)),
+                    pairs / (WINDOW_SIZE - 2))
+
+
+def _dust_window_scores(windows):
+    window_scores = np.full(len(windows.read_index), float(DUST_MAX_WINDOW_SCORE))
+    length = windows.length[windows.scored]
+    window_scores[windows.scored] = _dust_pair_scores(
+        _count_pairs(windows.squares(), length), length, windows.is_last[windows.scored])
+    return window_scores
+
+
+def _pair_counts(words):
+    # identical words among the MAX_PAIR_LAG words before and after every word
+    behind = np.zeros(len(words), dtype=np.uint8)
+    ahead = np.zeros(len(words), dtype=np.uint8)
+    equal = np.empty(len(words), dtype=bool)
+    for lag in range(1, MAX_PAIR_LAG + 1):
+        same = equal[:len(words) - lag]
+        np.equal(words[lag:], words[:-lag], out=same)
+        behind[lag:] += same
+        ahead[:-lag] += same
+    return behind, ahead
+
+
+def sliding_window_pairs(codes, offsets, lengths):
+    """
+    Count the identical trinucleotide pairs of every full window, sliding
+    along the reads instead of counting the trinucleotides of every window.
+
+    Returns one count per full (WINDOW_SIZE) window, in the order of
+    window_layout() without the trailing windows.
+    """
+    steps, _ = _window_steps(lengths)
+    # reads are laid out MAX_PAIR_LAG bases apart so that no pair spans two
+    gaps = np.arange(1, len(lengths) + 1, dtype=np.int64) * MAX_PAIR_LAG
+    layout = np.full(len(codes) + int(gaps[-1:].sum()), ALPHABET_SIZE, dtype=np.uint8)
+    layout[np.arange(len(codes)) + np.repeat(gaps - MAX_PAIR_LAG, lengths)] = codes
+    words = layout[:-2] * np.uint8(ALPHABET_SIZE * ALPHABET_SIZE) + \
+        layout[1:-1] * np.uint8(ALPHABET_SIZE) + layout[2:]
+    gap = layout == ALPHABET_SIZE
+    outside = gap[:-2] | gap[1:-1] | gap[2:]
+    words[outside] = np.uint8(255)
+
+    behind, ahead = _pair_counts(words)
+    behind[outside] = 0
+    ahead[outside] = 0
+    # pairs started and ended before every position; every pair started
+    # before a window ends before the window does, so the pairs of the
+    # window are the ones ended before its end less the ones started
+    # before its start
+    total = np.int32 if len(words) * MAX_PAIR_LAG < 2 ** 31 else np.int64
+    ended = np.zeros(len(words) + 1, dtype=total)
+    started = np.zeros(len(words) + 1, dtype=total)
+    np.cumsum(behind, out=ended[1:])
+    np.cumsum(ahead, out=started[1:])
+
+    first_step = np.cumsum(steps) - steps
+    window_start = np.repeat(offsets + gaps - MAX_PAIR_LAG - first_step * WINDOW_STEP, steps) + \
+        np.arange(int(steps.sum()), dtype=np.int64) * WINDOW_STEP
+    return ended[window_start + MAX_PAIR_LAG + 1] - started[window_start]
+
+
+def _sliding_dust_scores(codes, offsets, lengths):
+    read_index, window_index, length, is_last = window_layout(lengths)
+    window_scores = np.full(len(read_index), float(DUST_MAX_WINDOW_SCORE))
+    full = np.flatnonzero(~is_last)
+    window_scores[full] = _dust_pair_scores(
+        sliding_window_pairs(codes, offsets, lengths), length[full], False)
+    # the trailing window of every read is counted as before
+    tails = np.flatnonzero(is_last & (length >= MIN_SCORED_WINDOW))
+    counts = word_counts(codes, offsets[read_index[tails]] + window_index[tails] * WINDOW_STEP,
+                         length[tails])
+    window_scores[tails] = _dust_pair_scores(_count_pairs(_squares(counts), length[tails]),
+                                             length[tails], True)
+    return _mean_window_score(read_index, window_scores, len(lengths))
+
+
+_entropy_terms_table = np.zeros((1, 1))
+
+
+def _entropy_terms(max_words):
+    # frequency * log(frequency) of every count of a word among num_words,
+    # indexed by [num_words, count] and computed as the same NumPy
+    # operations on the frequencies would
+    global _entropy_terms_table
+    if len(_entropy_terms_table) <= max_words:
+        num_words = np.arange(max_words + 1)
+        counts = np.arange(max_words + 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            frequencies = counts[np.newaxis, :] / num_words[:, np.newaxis]
+        frequencies[0] = 0
+        logs = np.log(np.where(frequencies > 0, frequencies, 1))
+        _entropy_terms_table = frequencies * logs
+    return _entropy_terms_table
+
+
+def _entropy_window_scores(windows, reads=None):
+    # only the windows of reads (a mask) when given, the others score 1
+    window_scores = np.ones(len(windows.read_index))
+    scored = windows.scored
+    counts = windows.counts
+    if reads is not None:
+        rows = np.flatnonzero(reads[windows.read_index[scored]])
+        scored = scored[rows]
+        counts = counts[rows]
+    num_words = windows.length[scored] - WORD_SIZE + 1
+    terms = _entropy_terms(int(num_words.max()) if len(num_words) else 0)
+    entropy = -terms[num_words[:, np.newaxis], counts].sum(axis=1)
+    window_scores[scored] = entropy / np.log(np.minimum(num_words, ENTROPY_MAX_WORDS))
+    return window_scores
+
+
+def _entropy_bound_scores(windows):
+    # lower bound of every window score: the collision entropy
+    # -log(sum of the squared frequencies) never exceeds the Shannon entropy
+    window_bounds = np.ones(len(windows.read_index))
+    num_words = windows.length[windows.scored] - WORD_SIZE + 1
+    entropy = 2 * np.log(num_words) - np.log(windows.squares())
+    window_bounds[windows.scored] = entropy / np.log(np.minimum(num_words, ENTROPY_MAX_WORDS))
+    return window_bounds
+
+
+def letter_scores(seq):
+    """
+    Compute the DUST and the entropy score of one read the way prinseq
+    does, every letter (case aside) counted apart.
+    """
+    seq = bytes(seq).upper()
+    read_index, window_index, length, is_last = window_layout(np.array([len(seq)]))
+    dust = np.full(len(read_index), float(DUST_MAX_WINDOW_SCORE))
+    entropy = np.ones(len(read_index))
+    for window in np.flatnonzero(length >= MIN_SCORED_WINDOW).tolist():
+        start = int(window_index[window]) * WINDOW_STEP
+        num_words = int(length[window]) - WORD_SIZE + 1
+        counts = np.array(list(Counter(seq[position:position + WORD_SIZE] for position in
+                                       range(start, start + num_words)).values()))
+        dust[window] = _dust_pair_scores(_count_pairs(int(counts.dot(counts)), length[window]),
+                                         length[window], is_last[window])
+        entropy[window] = -_entropy_terms(num_words)[num_words, counts].sum() / \
+            np.log(min(num_words, ENTROPY_MAX_WORDS))
+    return (_mean_window_score(read_index, dust, 1)[0] * DUST_SCALE,
+            _mean_window_score(read_index, entropy, 1)[0] * 100)
+
+
+def _rescore_letters(reads, dust=None, entropy=None):
+    # replace the batch scores of the reads holding other letters
+    for index, seq in reads.letters.items():
+        read_dust, read_entropy = letter_scores(seq)
+        if dust is not None:
+            dust[index] = read_dust
+        if entropy is not None:
+            entropy[index] = read_entropy
+
+
+def dust_scores(reads):
+    """
+    Compute the prinseq DUST score (0 - 100) of every read in a batch.
+    """
+    if len(reads) == 0:
+        return np.zeros(0)
+    reads = _packed(reads)
+    if reads.num_bases() >= LONG_READ_LENGTH * len(reads):
+        scores = _sliding_dust_scores(*encode(reads)) * DUST_SCALE
+    else:
+        windows = _Windows(reads)
+        scores = windows.read_scores(_dust_window_scores(windows)) * DUST_SCALE
+    _rescore_letters(reads, dust=scores)
+    return scores
+
+
+def entropy_scores(reads):
+    """
+    Compute the prinseq entropy score (0 - 100) of every read in a batch.
+    """
+    if len(reads) == 0:
+        return np.zeros(0)
+    reads = _packed(reads)
+    windows = _Windows(reads)
+    scores = windows.read_scores(_entropy_window_scores(windows)) * 100
+    _rescore_letters(reads, entropy=scores)
+    return scores
+
+
+def both_scores(reads):
+    """
+    Compute the DUST and the entropy score of every read in a batch,
+    counting the trinucleotides only once.
+    """
+    if len(reads) == 0:
+        return np.zeros(0), np.zeros(0)
+    reads = _packed(reads)
+    windows = _Windows(reads)
+    dust = windows.read_scores(_dust_window_scores(windows)) * DUST_SCALE
+    entropy = windows.read_scores(_entropy_window_scores(windows)) * 100
+    _rescore_letters(reads, dust, entropy)
+    return dust, entropy
+
+
+def dust_keep(scores, threshold):
+    """
+    prinseq discards reads whose integer DUST score is above the threshold.
+    """
+    return np.floor(scores) <= threshold
+
+
+def entropy_keep(scores, threshold):
+    """
+    prinseq discards reads whose entropy score is below the threshold.
+    """
+    return scores >= threshold
+
+
+def _keys(scores):
+    return np.clip(np.floor(scores), 0, MAX_SCORE).astype(np.uint8)
+
+
+def score_keys(reads, lc_method):
+    """
+    Integer part (0 - 100) of the lc_method score of every read of a batch.
+
+    For lc_method "both" the keys have two columns, DUST then entropy.
+    """
+    if lc_method == 'dust':
+        return _keys(dust_scores(reads))
+    if lc_method == 'entropy':
+        return _keys(entropy_scores(reads))
+    if lc_method == 'both':
+        return np.stack([_keys(scores) for scores in both_scores(reads)], axis=1)
+    raise ValueError('The native engine does not support lc_method {}'.format(lc_method))
+
+
+def precheck_keys(reads, lc_method, lc_threshold):
+    """
+    Score keys of a batch of reads for one lc_threshold, scoring exactly
+    only the reads a first tier cannot settle.
+
+    Tier 1 bounds the entropy score of every read from below with the
+    collision entropy of its windows, which only needs the sum of the
+    squared trinucleotide counts, as DUST does, instead of an entropy term
+    per trinucleotide. The counts themselves are taken for all the reads,
+    the exact scores need them too. Reads whose bound is clearly at least
+    the entropy threshold are settled: they get the integer part of their
+    bound as entropy key, at least the threshold like their exact key, so
+    keep_keys() takes the same decisions as on score_keys(). The others
+    are scored exactly, as are the reads holding letters other than A, C,
+    G, T and N (see letter_scores). For lc_method "both" lc_threshold is
+    the dict of both thresholds and DUST keys are always exact.
+
+    Returns the keys and which reads were settled in tier 1.
+    """
+    if lc_method not in PRECHECK_METHODS:
+        raise ValueError('No precheck for lc_method {}'.format(lc_method))
+    if len(reads) == 0:
+        return score_keys([], lc_method), np.zeros(0, dtype=bool)
+    threshold = lc_threshold['entropy'] if lc_method == 'both' else lc_threshold
+    reads = _packed(reads)
+    windows = _Windows(reads)
+    bounds = windows.read_scores(_entropy_bound_scores(windows)) * 100 - PRECHECK_MARGIN
+    settled = bounds >= threshold
+    settled[list(reads.letters)] = False
+    entropy = windows.read_scores(_entropy_window_scores(windows, ~settled)) * 100
+    dust = None
+    if lc_method == 'both':
+        dust = windows.read_scores(_dust_window_scores(windows)) * DUST_SCALE
+    _rescore_letters(reads, dust, entropy)
+    keys = _keys(np.where(settled, bounds, entropy))
+    if lc_method == 'both':
+        keys = np.stack((_keys(dust), keys), axis=1)
+    return keys, settled
+
+
+def keep_keys(keys, lc_method, threshold):
+    """
+    Reads kept by an integer threshold given their score keys.
+
+    A DUST score is at most the threshold when its integer part is, and an
+    entropy score is at least the threshold when its integer part is.
+    """
+    if lc_method == 'dust':
+        return keys <= threshold
+    return keys >= threshold
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Memoization of execReadLibraryPRINSEQ results.
+
+A filter run is fully determined by the input object version (its UPA and
+checksum), the filter parameters, where the output goes and the versions of
+the module and of prinseq-lite. The report of a filter run is saved in the
+output workspace under report_name() of a hash of all of these, so that an
+identical request, in whichever container it runs, finds the report and the
+objects made the first time instead of filtering again.
+
+The workspace is the store: nothing is kept on local disk, and a result
+only counts while every object its report lists is still the current
+version of the name it was saved under.
+"""
+import hashlib
+import json
+
+REPORT_PREFIX = 'kb_PRINSEQ_report_'
+
+# object info fields
+_OBJID_I, _NAME_I, _VERSION_I, _WSID_I = 0, 1, 4, 6
+
+
+def _upa(info):
+    return '{}/{}/{}'.format(info[_WSID_I], info[_OBJID_I], info[_VERSION_I])
+
+
+def _object_id(workspace, name):
+    # output_ws is a workspace name or id
+    if str(workspace).isdigit():
+        return {'wsid': int(workspace), 'name': name}
+    return {'workspace': str(workspace), 'name': name}
+
+
+class ResultMemo(object):
+
+    def __init__(self, ws_client):
+        self.ws_client = ws_client
+
+    @staticmethod
+    def key(fields):
+        """
+        Memo key of a request described by a dict of JSON serializable
+        fields.
+        """
+        return hashlib.sha1(json.dumps(fields, sort_keys=True).encode()).hexdigest()
+
+    @staticmethod
+    def report_name(key):
+        """
+        Name of the report saved by the run memoized under key.
+        """
+        return REPORT_PREFIX + key
+
+    def load(self, workspace, key, names):
+        """
+        The result of the run memoized under key in workspace, or None.
+
+        names maps the output keys of the result (output_filtered_ref, ...)
+        to the names of their objects. Returns (report_ref, report, refs):
+        the report object data, and the ref of every object it lists by
+        output key. Every listed object has to be the current version of
+        one of names.
+        """
+        try:
+            report_object = self.ws_client.get_objects2(
+                {'objects': [_object_id(workspace, self.report_name(key))]})['data'][0]
+        except Exception:
+            # no report of an identical run
+            return None
+        report = report_object['data']
+        output_keys = list(names)
+        infos = self.ws_client.get_object_info3(
+            {'objects': [_object_id(workspace, names[output_key]) for output_key in output_keys],
+             'ignoreErrors': 1})['infos']
+        current = dict((_upa(info), output_key)
+                       for output_key, info in zip(output_keys, infos) if info is not None)
+        refs = {}
+        for created in report.get('objects_created') or []:
+            if created['ref'] not in current:
+                # the name was saved over, or the object deleted, since
+                return None
+            refs[current[created['ref']]] = created['ref']
+        return _upa(report_object['info']), report, refs
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Packed batches of reads for the native scoring kernels.
+
+A PackedReads holds the sequences of a batch of reads back to back in one
+buffer, one code per base: A, C, G, T are 0 - 3 (lower case included),
+anything else is N_CODE, which the kernels count as N. offsets and lengths
+locate every read in the buffer. A batch is built straight from the
+buffer of a fastq.RecordBlock with one NumPy table lookup, without a
+Python object per read. The codes are what the kernels index their
+trinucleotide counts with, so they are kept a byte a base rather than
+packed four to a byte, which the kernels would only unpack again.
+
+prinseq counts every letter apart, so the few reads holding letters other
+than A, C, G, T and N (IUPAC ambiguity codes such as R or Y) also keep
+their sequence in letters, for the scoring to count them read by read.
+"""
+import numpy as np
+
+# code of the bases other than A, C, G and T
+N_CODE = 4
+
+_BASE_CODES = np.full(256, N_CODE, dtype=np.uint8)
+for _code, _bases in enumerate((b'Aa', b'Cc', b'Gg', b'Tt')):
+    for _base in _bases:
+        _BASE_CODES[_base] = _code
+
+# bytes the codes do not tell apart from N
+_OTHER_LETTERS = _BASE_CODES == N_CODE
+for _base in b'Nn':
+    _OTHER_LETTERS[_base] = False
+
+
+def _offsets(lengths):
+    offsets = np.zeros(len(lengths), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=offsets[1:])
+    return offsets
+
+
+def gather(block, indices=None):
+    """
+    The sequences of a block (or of the reads at indices) back to back.
+
+    Returns the bases as uint8 ASCII with the offset and length of every
+    read in them.
+    """
+    starts = block.seq_starts
+    lengths = block.seq_lengths()
+    if indices is not None:
+        starts = starts[indices]
+        lengths = lengths[indices]
+    lengths = lengths.astype(np.int64)
+    offsets = _offsets(lengths)
+    # position in the block buffer of every base
+    positions = np.arange(int(lengths.sum()), dtype=np.int64) + \
+        np.repeat(starts - offsets, lengths)
+    return block.raw()[positions], offsets, lengths
+
+
+class PackedReads(object):
+    """
+    letters maps the index of every read holding letters other than A, C,
+    G, T and N to its sequence (bytes).
+    """
+
+    def __init__(self, codes, offsets, lengths, letters=None):
+        self.base_codes = codes
+        self.offsets = offsets
+        self.lengths = lengths
+        self.letters = letters or {}
+
+    @classmethod
+    def from_bases(cls, bases, offsets, lengths):
+        """
+        Pack ASCII bases (uint8) located by offsets and lengths.
+        """
+        letters = {}
+        other = np.flatnonzero(_OTHER_LETTERS[bases])
+        if len(other):
+            for index in np.unique(np.searchsorted(offsets, other, side='right') - 1).tolist():
+                start = int(offsets[index])
+                letters[index] = bases[start:start + int(lengths[index])].tobytes()
+        return cls(_BASE_CODES[bases], offsets, lengths, letters)
+
+    @classmethod
+    def from_block(cls, block, indices=None):
+        """
+        Pack the reads of a fastq.RecordBlock, or the ones at indices.
+        """
+        return cls.from_bases(*gather(block, indices))
+
+    @classmethod
+    def from_seqs(cls, seqs):
+        """
+        Pack a list of sequences (bytes like).
+        """
+        lengths = np.fromiter((len(seq) for seq in seqs), dtype=np.int64, count=len(seqs))
+        bases = np.frombuffer(b''.join(seqs), dtype=np.uint8)
+        return cls.from_bases(bases, _offsets(lengths), lengths)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def num_bases(self):
+        return int(self.lengths.sum())
+
+    def codes(self):
+        """
+        One code per base: 0 - 3 for A, C, G and T, N_CODE for the others.
+        """
+        return self.base_codes
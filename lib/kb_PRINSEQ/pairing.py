@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Pairing of the forward and reverse reads of a paired end library.
+
+Normally the two files list the mates in the same order and are walked in
+lockstep, checking the read identifiers as they go, with memory bounded by
+the FASTQ block size. When the files turn out to be out of sync (different
+identifiers or read counts), synchronize() pairs the mates by identifier in
+external memory: both files are partitioned on disk by a hash of the
+identifier and every partition is joined on its own, so that only one
+partition is ever held in memory.
+"""
+import os
+import shutil
+import tempfile
+import zlib
+
+from kb_PRINSEQ import fastq
+
+# partitions are sized so that one of them comfortably fits in memory
+PARTITION_SIZE = 64 * 1024 * 1024
+
+
+class OutOfSync(ValueError):
+    pass
+
+
+def pair_id(header):
+    """
+    Identifier shared by both mates: the first word of the header without a
+    trailing /1 or /2.
+    """
+    words = bytes(header).split(None, 1)
+    name = words[0] if words else b''
+    if name[-2:] in (b'/1', b'/2'):
+        name = name[:-2]
+    return name
+
+
+def block_ids(block):
+    return [pair_id(block.header(i)) for i in range(len(block))]
+
+
+def synchronized_blocks(fwd_blocks, rev_blocks):
+    """
+    Walk the forward and reverse blocks in lockstep.
+
+    Yields (fwd, rev) block slices with the same number of records and
+    raises OutOfSync as soon as the mates stop lining up. Errors reading
+    the files are raised as they are.
+    """
+    pairs = fastq.paired_blocks(fwd_blocks, rev_blocks)
+    while True:
+        try:
+            blocks = next(pairs, None)
+        except fastq.UnevenPairs as e:
+            raise OutOfSync(str(e))
+        if blocks is None:
+            return
+        if block_ids(blocks[0]) != block_ids(blocks[1]):
+            raise OutOfSync('Forward and reverse read identifiers do not match')
+        yield blocks
+
+
+def in_lockstep(fwd_path, rev_path):
+    """
+    Whether the mates of two FASTQ files line up all the way through.
+    """
+    try:
+        for _ in synchronized_blocks(fastq.map_blocks(fwd_path), fastq.map_blocks(rev_path)):
+            pass
+    except OutOfSync:
+        return False
+    return True
+
+
+def _partition(source, partition_paths):
+    writers = [fastq.FastqWriter(path, buffer_size=fastq.WRITE_BUFFER_SIZE // 8)
+               for path in partition_paths]
+    try:
+        for block in fastq.map_blocks(*source):
+            for i in range(len(block)):
+                partition = zlib.crc32(pair_id(block.header(i))) % len(writers)
+                writers[partition].write(block.record(i))
+    finally:
+        for writer in writers:
+            writer.close()
+
+
+def _sources(fwd_path, rev_path, sources):
+    return sources or [(fwd_path, 0, None), (rev_path, 0, None)]
+
+
+def synchronize(fwd_path, rev_path, work_dir, sources=None):
+    """
+    Pair the mates of two out of sync files by identifier.
+
+    sources, (path, start, end) byte ranges, are read instead of the files
+    when given.
+    Returns ([fwd_synced, rev_synced], [fwd_orphans, rev_orphans]): the
+    synced files list the mates in the same order, the orphan files hold
+    the reads whose mate is missing (or whose identifier is repeated).
+    """
+    sources = _sources(fwd_path, rev_path, sources)
+    path, start, end = sources[0]
+    size = (os.path.getsize(path) if end is None else end) - start
+    num_partitions = max(1, size // PARTITION_SIZE + 1)
+    partitions = [[os.path.join(work_dir, '{}_part{}'.format(direction, index))
+                   for index in range(num_partitions)]
+                  for direction in ('fwd', 'rev')]
+    _partition(sources[0], partitions[0])
+    _partition(sources[1], partitions[1])
+
+    synced = [os.path.join(work_dir, 'fwd_synced'), os.path.join(work_dir, 'rev_synced')]
+    orphans = [os.path.join(work_dir, 'fwd_orphans'), os.path.join(work_dir, 'rev_orphans')]
+    synced_writers = [fastq.FastqWriter(path) for path in synced]
+    orphan_writers = [fastq.FastqWriter(path) for path in orphans]
+    try:
+        for fwd_partition, rev_partition in zip(*partitions):
+            mates = {}
+            for block in fastq.map_blocks(fwd_partition):
+                for i in range(len(block)):
+                    name = pair_id(block.header(i))
+                    if name in mates:
+                        orphan_writers[0].write(block.record(i))
+                    else:
+                        mates[name] = block.record(i)
+            for block in fastq.map_blocks(rev_partition):
+                for i in range(len(block)):
+                    mate = mates.pop(pair_id(block.header(i)), None)
+                    if mate is None:
+                        orphan_writers[1].write(block.record(i))
+                    else:
+                        synced_writers[0].write(mate)
+                        synced_writers[1].write(block.record(i))
+            for mate in mates.values():
+                orphan_writers[0].write(mate)
+            os.remove(fwd_partition)
+            os.remove(rev_partition)
+    finally:
+        for writer in synced_writers + orphan_writers:
+            writer.close()
+    return synced, orphans
+
+
+class _Walk(object):
+    # the walk() of process_pairs, sources are the (path, start, end) byte
+    # ranges it reads
+
+    def __init__(self, sources):
+        self.sources = sources
+
+    def __call__(self):
+        return synchronized_blocks(fastq.map_blocks(*self.sources[0]),
+                                   fastq.map_blocks(*self.sources[1]))
+
+
+def process_pairs(fwd_path, rev_path, process, sources=None, resync=True):
+    """
+    Run process(walk, orphan_paths) over the mates of two files, walk()
+    returns a new iterator over the paired blocks every time it is called
+    and walk.sources are the byte ranges it reads. sources, (path, start,
+    end) byte ranges, are read instead of the files when given.
+
+    process is first given the files walked in lockstep and no orphans. If
+    that raises OutOfSync, it is run again from the start on copies paired
+    by synchronize(), so it must leave nothing behind when it fails. Without
+    resync the OutOfSync is raised instead, for callers that only see a
+    part of the files.
+    Returns what process returns.
+    """
+    sources = _sources(fwd_path, rev_path, sources)
+    try:
+        return process(_Walk(sources), [])
+    except OutOfSync as e:
+        if not resync:
+            raise
+        print('Paired end files are out of sync ({}), pairing reads by identifier'.format(e))
+
+    work_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(fwd_path)))
+    try:
+        synced, orphans = synchronize(fwd_path, rev_path, work_dir, sources)
+        return process(_Walk([(path, 0, None) for path in synced]), orphans)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Sharded low complexity filtering on several cores.
+
+The input FASTQ file(s) are split into shards holding the same records in
+the same order, every shard is filtered
+in its own process with either prinseq-lite.pl or the native engine, and
+the good, singleton and bad outputs and the stats are merged back in input
+order under the names prinseq would have used for the whole input.
+Shards are cut at record boundaries taken from the offset index of every
+input (see fastqindex). The native engine workers map their byte range
+of the inputs (see fastq.map_blocks), sharing the pages of the files, for
+prinseq the ranges are copied to shard files.
+Paired end shards only hold both mates of every pair when the files are in
+sync, mates out of sync are paired by one process over the whole files:
+prinseq inputs are checked before they are split, native shards stop at
+the first mismatch and the run starts over as a single shard.
+Compressed shard outputs are gzip files themselves, so they are merged by
+plain concatenation too.
+"""
+import glob
+import os
+import re
+import shutil
+import tempfile
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+from kb_PRINSEQ import fastq
+from kb_PRINSEQ import fastqindex
+from kb_PRINSEQ import filtering
+from kb_PRINSEQ import pairing
+from kb_PRINSEQ import prinseq
+from kb_PRINSEQ.stats import STATS_HEADER, merge_stats
+
+OUTPUT_KINDS = ['good', 'good_singletons', 'bad']
+
+
+def split_fastq(fastq_path, shard_paths, ranges):
+    """
+    Copy the byte ranges of a FASTQ file (see FastqIndex.shard_ranges) to
+    the shard paths, one range per shard.
+    """
+    with open(fastq_path, 'rb') as source:
+        for shard_path, (start, end) in zip(shard_paths, ranges):
+            source.seek(start)
+            with open(shard_path, 'wb') as shard:
+                left = end - start
+                while left > 0:
+                    chunk = source.read(min(fastq.BLOCK_SIZE, left))
+                    if not chunk:
+                        break
+                    shard.write(chunk)
+                    left -= len(chunk)
+
+
+def filter_shard(engine, shard_paths, lc_method, lc_threshold, compress=False,
+                 stats_only=False, keep_bad=False, filters=None, sources=None,
+                 resync=True):
+    """
+    Filter one shard (one path for single end, two for paired end).
+
+    The native engine reads sources, the (path, start, end) byte ranges of
+    the shard in the inputs, when given; the shard paths then only name
+    the outputs. Without resync, paired end mates out of sync raise
+    pairing.OutOfSync.
+    Returns the stats text of the run.
+    """
+    if engine == 'native':
+        if len(shard_paths) == 2:
+            return filtering.filter_paired_end(shard_paths[0], shard_paths[1],
+                                               lc_method, lc_threshold, compress, stats_only,
+                                               keep_bad, filters=filters, sources=sources,
+                                               resync=resync)
+        return filtering.filter_single_end(shard_paths[0], lc_method, lc_threshold, compress,
+                                           stats_only, keep_bad, filters=filters,
+                                           source=sources[0] if sources else None)
+
+    fastq2_path = shard_paths[1] if len(shard_paths) == 2 else None
+    output = prinseq.run(prinseq.build_command(shard_paths[0], fastq2_path,
+                                               lc_method, lc_threshold, stats_only, keep_bad,
+                                               filters))
+    for element in output:
+        if STATS_HEADER in element:
+            for shard_path in shard_paths:
+                for kind in OUTPUT_KINDS:
+                    if not _compressed(kind, compress):
+                        continue
+                    for path in _shard_outputs(shard_path, kind):
+                        if not path.endswith('.gz'):
+                            fastq.gzip_file(path)
+            return STATS_HEADER + element.split(STATS_HEADER)[1]
+    raise Exception('Unable to execute PRINSEQ, Error: {}'.format(str(output)))
+
+
+def _compressed(kind, compress):
+    # kept bad reads are always compressed
+    return compress or kind == 'bad'
+
+
+def _shard_outputs(shard_path, kind):
+    name = re.compile(r'^{}_prinseq_{}_[A-Za-z0-9]+\.fastq(\.gz)?$'.format(
+        re.escape(os.path.basename(shard_path)), kind))
+    return sorted(path for path in glob.glob(shard_path + '_prinseq_*')
+                  if name.match(os.path.basename(path)))
+
+
+def merge_outputs(fastq_paths, shards, tag, compress=False):
+    """
+    Concatenate the outputs of every shard in shard order.
+
+    shards lists the shard paths of every shard, in the order of
+    fastq_paths. Empty outputs are not created, as with prinseq.
+    """
+    for direction, fastq_path in enumerate(fastq_paths):
+        for kind in OUTPUT_KINDS:
+            parts = []
+            for shard_paths in shards:
+                parts.extend(_shard_outputs(shard_paths[direction], kind))
+            if not parts:
+                continue
+            with open(filtering.output_path(fastq_path, kind, tag,
+                                            _compressed(kind, compress)), 'wb') as merged:
+                for part in parts:
+                    with open(part, 'rb') as shard_output:
+                        shutil.copyfileobj(shard_output, merged, fastq.WRITE_BUFFER_SIZE)
+
+
+def filter_sharded(engine, fastq_paths, lc_method, lc_threshold, num_shards, work_dir,
+                   compress=False, stats_only=False, keep_bad=False, filters=None,
+                   index_dir=None, index_keys=None):
+    """
+    Filter fastq_paths (one path for single end, two for paired end) in
+    num_shards processes. Outputs are gzipped when compress is set and not
+    written when stats_only is set. Bad reads are written (gzipped) only
+    with keep_bad. filters are applied before lc_method, see
+    filtering.CHAIN_FILTERS. The offset indexes of the inputs are kept in
+    index_dir under index_keys, one per path, when given (see fastqindex).
+
+    Writes prinseq named outputs next to the inputs and returns the merged
+    stats text.
+    """
+    indexes = []
+    for fastq_path, key in zip(fastq_paths, index_keys or [None] * len(fastq_paths)):
+        fastq.gunzip_in_place(fastq_path)
+        indexes.append(fastqindex.fastq_index(fastq_path, index_dir=index_dir, key=key))
+    ranges = [index.shard_ranges(num_shards) for index in indexes]
+    if len(fastq_paths) == 2 and not (
+            _same_boundaries(fastq_paths, indexes, ranges) and
+            (engine == 'native' or pairing.in_lockstep(*fastq_paths))):
+        # mates out of sync can only be paired over the whole files
+        ranges = [index.shard_ranges(1) for index in indexes]
+    args = (engine, fastq_paths, lc_method, lc_threshold, work_dir, compress, stats_only,
+            keep_bad, filters)
+    try:
+        return _filter_shards(ranges, *args)
+    except pairing.OutOfSync:
+        if len(ranges[0]) == 1:
+            raise
+        return _filter_shards([index.shard_ranges(1) for index in indexes], *args)
+
+
+def _same_boundaries(fastq_paths, indexes, ranges):
+    """
+    Whether the shard ranges of paired end files start at the same record
+    numbers, with the mates of a pair there.
+    """
+    if len(set((len(index), index.interval) for index in indexes)) > 1:
+        return False
+    if len(set(len(path_ranges) for path_ranges in ranges)) > 1:
+        return False
+    ids = []
+    for fastq_path, path_ranges in zip(fastq_paths, ranges):
+        with open(fastq_path, 'rb') as handle:
+            path_ids = []
+            for start, _ in path_ranges:
+                handle.seek(start)
+                path_ids.append(pairing.pair_id(handle.readline()[1:]))
+            ids.append(path_ids)
+    return ids[0] == ids[1]
+
+
+def _filter_shards(ranges, engine, fastq_paths, lc_method, lc_threshold, work_dir, compress,
+                   stats_only, keep_bad, filters):
+    shard_dir = tempfile.mkdtemp(dir=work_dir)
+    try:
+        shards = [[os.path.join(shard_dir, 'shard{}_{}'.format(index, os.path.basename(path)))
+                   for path in fastq_paths]
+                  for index in range(len(ranges[0]))]
+        # the native engine maps its range of the inputs, prinseq needs files
+        sources = [[(fastq_path, start, end)
+                    for fastq_path, (start, end) in zip(fastq_paths, shard_ranges)]
+                   for shard_ranges in zip(*ranges)]
+        if engine != 'native':
+            for direction, fastq_path in enumerate(fastq_paths):
+                split_fastq(fastq_path, [shard_paths[direction] for shard_paths in shards],
+                            ranges[direction])
+            sources = [None] * len(shards)
+
+        with ProcessPoolExecutor(max_workers=len(shards)) as pool:
+            # a single shard pairs mates out of sync itself
+            futures = [pool.submit(filter_shard, engine, shard_paths, lc_method, lc_threshold,
+                                   compress, stats_only, keep_bad, filters, shard_sources,
+                                   len(shards) == 1)
+                       for shard_paths, shard_sources in zip(shards, sources)]
+            results = [future.result() for future in futures]
+
+        merge_outputs(fastq_paths, shards, uuid.uuid4().hex[:4], compress)
+    finally:
+        shutil.rmtree(shard_dir, ignore_errors=True)
+    return merge_stats(results)
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for running prinseq-lite.pl as a subprocess.
+"""
+import os
+import shlex
+import subprocess
+import threading
+import time
+from collections import deque
+
+from kb_PRINSEQ import fastq
+from kb_PRINSEQ.derep import PRINSEQ_DEREP
+from kb_PRINSEQ.stats import STATS_HEADER
+
+PRINSEQ_VERSION = "0.20.4"
+PRINSEQ_LITE = "perl /opt/lib/prinseq-lite-{}/prinseq-lite.pl".format(PRINSEQ_VERSION)
+
+# seconds between two progress messages
+PROGRESS_INTERVAL = 30
+
+# lines of output kept to report an error when prinseq prints no stats
+ERROR_TAIL_LINES = 50
+
+
+def build_command(fastq_path, fastq2_path, lc_method, lc_threshold, stats_only=False,
+                  keep_bad=False, filters=None, derep_mode=None):
+    """
+    Build the prinseq-lite command line, fastq2_path is None for single end reads.
+
+    Bad reads are only written with keep_bad. With stats_only prinseq only
+    reports the counts and writes no reads. filters holds the values of the
+    other prinseq filters to apply (min_len, min_qual_mean, ns_max_p) and
+    derep_mode one of derep.DEREP_MODES.
+    """
+    cmd = "{} -fastq {}".format(PRINSEQ_LITE, fastq_path)
+    if fastq2_path is not None:
+        cmd += " -fastq2 {}".format(fastq2_path)
+    for name, value in sorted((filters or {}).items()):
+        if value is not None:
+            cmd += " -{} {}".format(name, value)
+    if derep_mode is not None:
+        cmd += " -derep {}".format(PRINSEQ_DEREP[derep_mode])
+    cmd += " -out_format 3 -lc_method {} -lc_threshold {}".format(lc_method, lc_threshold)
+    if stats_only:
+        cmd += " -out_good null -out_bad null"
+    elif not keep_bad:
+        cmd += " -out_bad null"
+    return cmd
+
+
+def _read_stream(stream, log, kept):
+    # everything before the stats block is logged as it comes and only the
+    # last lines of it are kept, in case prinseq fails
+    tail = deque(maxlen=ERROR_TAIL_LINES)
+    for line in iter(stream.readline, b''):
+        line = line.decode(errors='replace')
+        if kept or STATS_HEADER in line:
+            kept.append(line)
+        else:
+            tail.append(line)
+            if line.strip():
+                log(line.rstrip())
+    stream.close()
+    if not kept:
+        kept.extend(tail)
+
+
+def _estimate_reads(fastq_path):
+    # average record size of the first block times the file size
+    block = next(fastq.read_blocks(fastq_path), None)
+    if block is None:
+        return 0
+    record_size = float(block.bounds[-1] - block.bounds[0]) / len(block)
+    return int(os.path.getsize(fastq_path) / record_size)
+
+
+def _input_position(pid, fastq_path):
+    # the offset prinseq has read the input up to, from the file descriptor
+    # table of the process (Linux /proc), None when it is not available
+    fd_dir = '/proc/{}/fd'.format(pid)
+    target = os.path.realpath(fastq_path)
+    try:
+        for fd in os.listdir(fd_dir):
+            if os.path.realpath(os.path.join(fd_dir, fd)) != target:
+                continue
+            with open('/proc/{}/fdinfo/{}'.format(pid, fd)) as fdinfo:
+                for line in fdinfo:
+                    if line.startswith('pos:'):
+                        return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+class _Progress(threading.Thread):
+    """
+    Logs reads processed per second and the time left while prinseq runs.
+
+    Progress is how far the prinseq process (pid) has read fastq_path,
+    whatever it writes out; nothing is logged where the read position
+    cannot be seen.
+    """
+
+    def __init__(self, pid, fastq_path, log, interval):
+        super(_Progress, self).__init__()
+        self.daemon = True
+        self.pid = pid
+        self.fastq_path = fastq_path
+        self.log = log
+        self.interval = interval
+        self.done = threading.Event()
+
+    def run(self):
+        input_size = os.path.getsize(self.fastq_path)
+        total_reads = _estimate_reads(self.fastq_path)
+        start = time.time()
+        while not self.done.wait(self.interval):
+            if not input_size or not total_reads:
+                continue
+            position = _input_position(self.pid, self.fastq_path)
+            if position is None:
+                continue
+            fraction = min(position / float(input_size), 1.0)
+            elapsed = time.time() - start
+            reads = int(fraction * total_reads)
+            message = 'prinseq progress: ~{:,} of ~{:,} reads ({:.1f}%), {:,.0f} reads/s'.format(
+                reads, total_reads, 100 * fraction, reads / elapsed)
+            if fraction > 0:
+                message += ', ETA {:.0f} s'.format(elapsed * (1 - fraction) / fraction)
+            self.log(message)
+
+    def stop(self):
+        self.done.set()
+        self.join()
+
+
+def run(cmd, fastq_path=None, log=print):
+    """
+    Run a prinseq-lite command and return its decoded [stdout, stderr].
+
+    Both streams are read line by line on background threads and passed to
+    log as they arrive; only the stats block at the end (or the last lines
+    of a stream without one) is kept, so memory use does not grow with the
+    amount of output. When fastq_path (the first
+    input file) is given, progress is logged every PROGRESS_INTERVAL seconds.
+    """
+    log("Command to be run : " + cmd)
+    args = shlex.split(cmd)
+    perl_script = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    kept = [[], []]
+    readers = [threading.Thread(target=_read_stream, args=(stream, log, lines))
+               for stream, lines in zip((perl_script.stdout, perl_script.stderr), kept)]
+    for reader in readers:
+        reader.daemon = True
+        reader.start()
+    progress = None
+    if fastq_path is not None:
+        progress = _Progress(perl_script.pid, fastq_path, log, PROGRESS_INTERVAL)
+        progress.start()
+    try:
+        for reader in readers:
+            reader.join()
+        perl_script.wait()
+    finally:
+        if progress is not None:
+            progress.stop()
+    return [''.join(lines) for lines in kept]
@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+"""
+Per-read score cache for the native engine.
+
+The threshold is only a cut on the low complexity score, so once the reads
+of an input have been scored, filtering it again at another threshold only
+needs the scores. The integer score keys of every read (see
+lowcomplexity.score_keys, one byte per read) are kept in one .npz file per
+input object version and lc_method under the cache directory, in the order
+of the reads in the input files.
+
+Runs with the entropy precheck (see lowcomplexity.precheck_keys) only know
+a lower bound of the entropy score of the reads settled in its first tier.
+Their keys are cached as they are, marked as bounds: a bound at least the
+threshold of a later run still keeps the read, the others are scored
+exactly when the entry is used.
+
+The cache is bounded in size: entries are touched when they are used and
+the least recently used ones are removed when a new entry would take the
+cache over its size limit.
+
+Within a run, low complexity reads (poly-A, microsatellites, adapter
+dimers) tend to be the same few sequences over and over. ScoreMemo keeps
+the keys of the sequences scored last by their 64-bit fingerprint (see
+derep.fingerprints) in a bounded LRU of sorted NumPy arrays, so that a
+repeated sequence is only scored once.
+"""
+import hashlib
+import os
+import uuid
+
+import numpy as np
+
+from kb_PRINSEQ import derep
+from kb_PRINSEQ import lowcomplexity
+from kb_PRINSEQ import packed
+
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+# sequences whose score keys the memo holds, about 100 bytes each
+DEFAULT_MEMO_ENTRIES = 512 * 1024
+
+# bump when the scoring changes so older entries are not used anymore
+CACHE_FORMAT = 1
+
+
+class ScoreMemo(object):
+    """
+    Bounded LRU memo of score keys by sequence fingerprint.
+
+    The fingerprints are kept sorted in one array, with the keys and the
+    last use of every entry alongside, so that a whole block is looked up
+    with one searchsorted. Entries are used by block: when the memo is
+    full, the ones last used by the oldest blocks are dropped.
+
+    lookups counts the reads asked for and hits the ones that did not need
+    scoring, having been seen before in the memo or earlier in the block.
+    checked counts the reads scored through the precheck and settled the
+    ones it settled in its first tier.
+    """
+
+    def __init__(self, lc_method, max_entries=DEFAULT_MEMO_ENTRIES):
+        self.lc_method = lc_method
+        self.max_entries = max_entries
+        empty = lowcomplexity.score_keys([], lc_method)
+        self.fingerprints = np.zeros(0, dtype=np.uint64)
+        self.entry_keys = empty
+        self.used = np.zeros(0, dtype=np.int64)
+        self.clock = 0
+        self.lookups = 0
+        self.hits = 0
+        self.checked = 0
+        self.settled = 0
+
+    def __len__(self):
+        return len(self.fingerprints)
+
+    def reset_counts(self):
+        """
+        Start the counters over, for a pass over reads that were already
+        counted. The entries are kept.
+        """
+        self.lookups = 0
+        self.hits = 0
+        self.checked = 0
+        self.settled = 0
+
+    def _score(self, reads, precheck):
+        if precheck is None:
+            return lowcomplexity.score_keys(reads, self.lc_method), None
+        keys, settled = lowcomplexity.precheck_keys(reads, self.lc_method, precheck)
+        self.checked += len(settled)
+        self.settled += int(settled.sum())
+        return keys, settled
+
+    def _add(self, positions, fingerprints, keys):
+        # positions, from searchsorted, keep the fingerprints sorted
+        self.fingerprints = np.insert(self.fingerprints, positions, fingerprints)
+        self.entry_keys = np.insert(self.entry_keys, positions, keys, axis=0)
+        self.used = np.insert(self.used, positions, self.clock)
+        excess = len(self.fingerprints) - self.max_entries
+        if excess > 0:
+            kept = np.sort(np.argpartition(self.used, excess - 1)[excess:]) \
+                if excess < len(self.used) else np.zeros(0, dtype=np.intp)
+            self.fingerprints = self.fingerprints[kept]
+            self.entry_keys = self.entry_keys[kept]
+            self.used = self.used[kept]
+
+    def keys(self, block, precheck=None):
+        """
+        Score keys of the reads of a fastq.RecordBlock.
+
+        With precheck, an lc_threshold, the keys come from
+        lowcomplexity.precheck_keys() and only the exact ones are memoized.
+        """
+        return self.keys_and_bounds(block, precheck)[0]
+
+    def keys_and_bounds(self, block, precheck=None):
+        """
+        keys() with which of the keys are only the lower bounds of the
+        precheck, see lowcomplexity.precheck_keys().
+        """
+        self.clock += 1
+        unique, first, inverse = np.unique(derep.fingerprints(block), return_index=True,
+                                           return_inverse=True)
+        keys = np.empty((len(unique),) + self.entry_keys.shape[1:], dtype=self.entry_keys.dtype)
+        positions = np.searchsorted(self.fingerprints, unique)
+        found = np.zeros(len(unique), dtype=bool)
+        if len(self.fingerprints):
+            entries = np.minimum(positions, len(self.fingerprints) - 1)
+            found = self.fingerprints[entries] == unique
+            keys[found] = self.entry_keys[entries[found]]
+            self.used[entries[found]] = self.clock
+        missing = np.flatnonzero(~found)
+        bounds = np.zeros(len(unique), dtype=bool)
+        if len(missing):
+            scored, settled = self._score(
+                packed.PackedReads.from_block(block, first[missing]), precheck)
+            keys[missing] = scored
+            new = slice(None) if settled is None else ~settled
+            self._add(positions[missing][new], unique[missing][new], scored[new])
+            if settled is not None:
+                bounds[missing[settled]] = True
+        self.lookups += len(block)
+        self.hits += len(block) - len(missing)
+        inverse = inverse.reshape(-1)
+        return keys[inverse], bounds[inverse]
+
+
+class Scorer(object):
+    """
+    Score keys of the reads of one or two input files.
+
+    keys() has to be called on the blocks of every file in file order.
+    Keys come from cached (one array per file) when given, otherwise they
+    are computed through a ScoreMemo and, with record set, kept so that
+    recorded() can return them for the cache.
+
+    precheck, the lc_threshold the keys are used with, lets the entropy
+    scoring settle clearly complex reads in a first tier (see
+    lowcomplexity.precheck_keys). Their keys are only lower bounds, they
+    are recorded as such. cached_bounds (one mask per file) marks the
+    cached keys that are bounds; the reads whose bound does not settle
+    precheck, all of them without precheck, are scored exactly.
+    """
+
+    def __init__(self, lc_method, cached=None, record=False, memo=None, precheck=None,
+                 cached_bounds=None):
+        self.lc_method = lc_method
+        self.cached = cached
+        self.cached_bounds = cached_bounds
+        self.offsets = [0, 0]
+        self.record = record and cached is None
+        if lc_method not in lowcomplexity.PRECHECK_METHODS:
+            precheck = None
+        self.precheck = precheck
+        self.computed = [[], []]
+        self.bounds = [[], []]
+        self.memo = memo if memo is not None else ScoreMemo(lc_method)
+
+    def _entropy_keys(self, keys):
+        return keys[:, 1] if self.lc_method == 'both' else keys
+
+    def _from_cache(self, direction, start, block):
+        keys = self.cached[direction][start:start + len(block)]
+        if len(keys) != len(block):
+            raise ValueError('Cached scores do not match the input reads')
+        if self.cached_bounds is None:
+            return keys
+        bounds = self.cached_bounds[direction][start:start + len(block)]
+        if self.precheck is not None:
+            threshold = self.precheck['entropy'] if self.lc_method == 'both' else \
+                self.precheck
+            bounds = bounds & (self._entropy_keys(keys) < threshold)
+        inexact = np.flatnonzero(bounds)
+        if len(inexact):
+            keys = keys.copy()
+            keys[inexact] = lowcomplexity.score_keys(
+                packed.PackedReads.from_block(block, inexact), self.lc_method)
+        return keys
+
+    def keys(self, direction, block):
+        start = self.offsets[direction]
+        self.offsets[direction] += len(block)
+        if self.cached is not None:
+            return self._from_cache(direction, start, block)
+        keys, bounds = self.memo.keys_and_bounds(block, self.precheck)
+        self.add_recorded(direction, keys, bounds)
+        return keys
+
+    def add_recorded(self, direction, keys, bounds):
+        """
+        Record the keys and bounds of the next reads of a file, computed
+        elsewhere, as the shmpipe workers do.
+        """
+        if self.record:
+            self.computed[direction].append(keys)
+            self.bounds[direction].append(bounds)
+
+    def memo_counts(self):
+        """
+        (lookups, hits) of the memo, None when no read was scored.
+        """
+        if not self.memo.lookups:
+            return None
+        return self.memo.lookups, self.memo.hits
+
+    def precheck_counts(self):
+        """
+        (checked, settled) of the precheck, None when it scored no read.
+        """
+        if not self.memo.checked:
+            return None
+        return self.memo.checked, self.memo.settled
+
+    def unordered(self):
+        """
+        A plain scorer for the same reads in another order; cached keys do
+        not apply to them and this scorer stops recording. The memo counts
+        start over, so that they cover the reads once.
+        """
+        self.record = False
+        self.memo.reset_counts()
+        return Scorer(self.lc_method, memo=self.memo, precheck=self.precheck)
+
+    def recorded(self, num_files):
+        """
+        The keys computed for every file and which of them are bounds, None
+        when they were not recorded.
+        """
+        if not self.record:
+            return None
+        keys = [np.concatenate(keys) if keys else lowcomplexity.score_keys([], self.lc_method)
+                for keys in self.computed[:num_files]]
+        bounds = [np.concatenate(bounds) if bounds else np.zeros(0, dtype=bool)
+                  for bounds in self.bounds[:num_files]]
+        return keys, bounds
+
+
+class ScoreCache(object):
+    """
+    Size bounded LRU cache of score keys on disk.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def key(object_ref, lc_method):
+        """
+        Cache key of an input, object_ref has to include the version
+        (wsid/objid/version).
+        """
+        return '{}:{}:{}'.format(CACHE_FORMAT, object_ref, lc_method)
+
+    def _path(self, key):
+        return os.path.join(self.directory,
+                            hashlib.sha1(key.encode()).hexdigest() + '.npz')
+
+    def load(self, key):
+        """
+        The cached arrays of key, one per input file, and the masks of the
+        keys that are bounds, or None.
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as entry:
+                num_files = sum(1 for name in entry.files if name.startswith('file'))
+                arrays = [entry['file{}'.format(i)] for i in range(num_files)]
+                bounds = [entry['bound{}'.format(i)] if 'bound{}'.format(i) in entry.files
+                          else np.zeros(len(array), dtype=bool)
+                          for i, array in enumerate(arrays)]
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+        # a use makes the entry the most recent one
+        os.utime(path, None)
+        return arrays, bounds
+
+    def store(self, key, arrays, bounds=None):
+        size = sum(array.nbytes for array in arrays + (bounds or []))
+        if size > self.max_bytes:
+            return
+        self._evict(self.max_bytes - size)
+        path = self._path(key)
+        temp_path = '{}.{}.tmp.npz'.format(path, uuid.uuid4().hex)
+        entry = dict(('file{}'.format(i), array) for i, array in enumerate(arrays))
+        if bounds is not None:
+            entry.update(('bound{}'.format(i), mask) for i, mask in enumerate(bounds))
+        np.savez(temp_path, **entry)
+        os.rename(temp_path, path)
+
+    def _evict(self, room):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npz') or '.tmp.' in name:
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= room:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
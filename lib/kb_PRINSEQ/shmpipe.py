@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+"""
+Shared memory pipeline running the native engine on several cores.
+
+A reader process walks the input(s) and packs consecutive records into a
+free slot of a ring of multiprocessing.shared_memory buffers: the record
+bytes of every direction with their bounds, sequence and quality positions.
+Scoring workers rebuild fastq.RecordBlocks over the shared bytes, run the
+filter chain on them and write the keep mask and score keys of every read
+back into the slot. The calling process takes the slots back in input order, writes the
+kept records straight out of shared memory and hands the slot back to the
+reader. Only slot numbers and counts go through the queues, the records
+are never pickled, and the number of slots bounds the memory in flight:
+the reader waits for a free slot when the writer falls behind.
+
+Unlike parallel.filter_sharded, the outputs are written once and in order,
+nothing is copied or merged afterwards, and paired end files out of sync
+are detected by the reader as in the lockstep walk of pairing. Every
+worker keeps its own score memo, its keys go back through the slots so
+that a recording scorecache.Scorer can cache them. Dereplication needs all
+the reads in one process and is not supported.
+
+multiprocessing.shared_memory needs Python 3.8, available() tells whether
+it can be used.
+"""
+import multiprocessing
+import pickle
+import queue
+import traceback
+
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+from kb_PRINSEQ import fastq
+from kb_PRINSEQ import pairing
+from kb_PRINSEQ.filtering import FilterChain
+from kb_PRINSEQ.scorecache import ScoreMemo
+
+# a slot holds a whole block of both directions
+SLOT_SIZE = 4 * fastq.BLOCK_SIZE
+SLOTS_PER_WORKER = 2
+
+# seconds between checks that the pipeline processes are still running
+POLL_SECONDS = 1
+
+# bounds, sequence starts and ends, quality starts
+_POSITION_ROWS = 4
+
+# score keys of a read (two for lc_method both) and whether they are bounds
+_KEY_COLUMNS = 2
+_SCORE_BYTES = _KEY_COLUMNS + 1
+
+
+def available():
+    return shared_memory is not None
+
+
+def _aligned(size):
+    return -(-size // 4) * 4
+
+
+def _slot_bytes(num_reads, size):
+    # positions, keep mask, score keys and record bytes of one direction
+    return (_POSITION_ROWS * 4 * (num_reads + 1) + _aligned(num_reads) +
+            _aligned(_SCORE_BYTES * num_reads) + _aligned(size))
+
+
+def _slot_parts(buf, num_reads, sizes):
+    # (positions, keep, keys, bounds, data) views of every direction stored
+    # in a slot
+    parts = []
+    offset = 0
+    for size in sizes:
+        positions = np.ndarray((_POSITION_ROWS, num_reads + 1), dtype=np.int32, buffer=buf,
+                               offset=offset)
+        offset += positions.nbytes
+        keep = np.ndarray(num_reads, dtype=bool, buffer=buf, offset=offset)
+        offset += _aligned(num_reads)
+        keys = np.ndarray((num_reads, _KEY_COLUMNS), dtype=np.uint8, buffer=buf, offset=offset)
+        bounds = np.ndarray(num_reads, dtype=bool, buffer=buf, offset=offset + keys.nbytes)
+        offset += _aligned(_SCORE_BYTES * num_reads)
+        parts.append((positions, keep, keys, bounds, buf[offset:offset + size]))
+        offset += _aligned(size)
+    return parts
+
+
+def _pack(buf, slot_size, blocks):
+    """
+    Copy the first records of blocks (one per direction, as many records
+    each) to a slot, as many as fit.
+
+    Returns the number of records and the byte size of every direction.
+    """
+    counts = np.arange(len(blocks[0]) + 1)
+    needed = np.zeros(len(counts), dtype=np.int64)
+    for block in blocks:
+        needed += _slot_bytes(counts, block.bounds - block.bounds[0])
+    count = int(np.searchsorted(needed, slot_size, side='right')) - 1
+    if count < 1:
+        raise ValueError('FASTQ record too large for a pipeline slot of {} bytes'.format(
+            slot_size))
+    sizes = [int(block.bounds[count] - block.bounds[0]) for block in blocks]
+    for block, (positions, _, _, _, data) in zip(blocks, _slot_parts(buf, count, sizes)):
+        base = block.bounds[0]
+        positions[0] = block.bounds[:count + 1] - base
+        positions[1, :count] = block.seq_starts[:count] - base
+        positions[2, :count] = block.seq_ends[:count] - base
+        positions[3, :count] = block.qual_starts[:count] - base
+        data[:] = block.view[base:block.bounds[count]]
+    return count, sizes
+
+
+def _blocks(buf, num_reads, sizes):
+    """
+    The RecordBlocks stored in a slot, over its buffer, their keep masks
+    and the (keys, bounds) of their scores.
+    """
+    blocks = []
+    keeps = []
+    scores = []
+    for positions, keep, keys, bounds, data in _slot_parts(buf, num_reads, sizes):
+        positions = positions.astype(np.int64)
+        blocks.append(fastq.RecordBlock(data, positions[0], positions[1, :-1],
+                                        positions[2, :-1], positions[3, :-1]))
+        keeps.append(keep)
+        scores.append((keys, bounds))
+    return blocks, keeps, scores
+
+
+def _error(e):
+    # exceptions cross the queues pickled, a pickling failure in the
+    # feeder thread of a queue would be lost
+    try:
+        pickle.dumps(e)
+        return e
+    except Exception:
+        return Exception(traceback.format_exc())
+
+
+def _close(segment):
+    try:
+        segment.close()
+    except BufferError:
+        # blocks still use the slot, it goes away with them
+        pass
+
+
+def _read(slot_names, slot_size, sources, free, tasks, done, num_workers):
+    """
+    Reader process: packs the records of sources into free slots and queues
+    them for the workers.
+    """
+    segments = [shared_memory.SharedMemory(name) for name in slot_names]
+    sequence = 0
+    try:
+        if len(sources) == 2:
+            batches = pairing.synchronized_blocks(fastq.map_blocks(*sources[0]),
+                                                  fastq.map_blocks(*sources[1]))
+        else:
+            batches = ([block] for block in fastq.map_blocks(*sources[0]))
+        for blocks in batches:
+            while len(blocks[0]):
+                slot = free.get()
+                count, sizes = _pack(segments[slot].buf, slot_size, blocks)
+                tasks.put((sequence, slot, count, sizes))
+                sequence += 1
+                blocks = [block[count:] for block in blocks]
+        # no slot: the number of batches
+        done.put((sequence, None, None))
+    except Exception as e:
+        done.put((None, None, _error(e)))
+    finally:
+        for _ in range(num_workers):
+            tasks.put(None)
+        for segment in segments:
+            _close(segment)
+
+
+def _stored_keys(keys, lc_method):
+    # the key columns of a slot used by lc_method
+    return keys if lc_method == 'both' else keys[:, 0]
+
+
+def _filter_slot(buf, num_reads, sizes, memo, precheck, chain):
+    blocks, keeps, scores = _blocks(buf, num_reads, sizes)
+    block_keys = []
+    for block, (keys, bounds) in zip(blocks, scores):
+        computed, computed_bounds = memo.keys_and_bounds(block, precheck)
+        _stored_keys(keys, chain.lc_method)[:] = computed
+        bounds[:] = computed_bounds
+        block_keys.append(computed)
+    for keep, block_kept in zip(keeps, chain.keep_pairs(blocks, block_keys)):
+        keep[:] = block_kept
+
+
+def _score(slot_names, tasks, done, lc_method, lc_threshold, filters, memo_entries, precheck):
+    """
+    Worker process: filters the slots queued by the reader and writes their
+    keep masks and score keys back.
+    """
+    segments = [shared_memory.SharedMemory(name) for name in slot_names]
+    memo = ScoreMemo(lc_method, memo_entries)
+    try:
+        for sequence, slot, num_reads, sizes in iter(tasks.get, None):
+            try:
+                chain = FilterChain(lc_method, lc_threshold, filters)
+                before = [memo.lookups, memo.hits, memo.checked, memo.settled]
+                _filter_slot(segments[slot].buf, num_reads, sizes, memo, precheck, chain)
+                after = [memo.lookups, memo.hits, memo.checked, memo.settled]
+                done.put((sequence, slot,
+                          (num_reads, sizes, chain.removed,
+                           [now - then for now, then in zip(after, before)])))
+            except Exception as e:
+                done.put((sequence, slot, _error(e)))
+    finally:
+        for segment in segments:
+            _close(segment)
+
+
+def _receive(done, processes):
+    while True:
+        try:
+            return done.get(timeout=POLL_SECONDS)
+        except queue.Empty:
+            for process in processes:
+                if process.exitcode not in (None, 0):
+                    raise Exception('Pipeline process {} exited with code {}'.format(
+                        process.name, process.exitcode))
+
+
+class Pipeline(object):
+    """
+    Filters inputs on num_workers scoring processes, see kept().
+
+    slot_size bounds the records of one batch, slots_per_worker the
+    batches in flight per worker.
+    """
+
+    def __init__(self, num_workers, slot_size=SLOT_SIZE, slots_per_worker=SLOTS_PER_WORKER):
+        self.num_workers = num_workers
+        self.slot_size = slot_size
+        self.num_slots = num_workers * slots_per_worker + 2
+
+    def kept(self, sources, chain, scorer):
+        """
+        Yield the (blocks, keeps) of the records of sources, (path, start,
+        end) byte ranges of one file or of the two files of a paired end
+        library, in input order, as chain.keep_pairs() would with the keys
+        of scorer. chain must not dereplicate and scorer must not hold
+        cached keys.
+
+        The blocks live in shared memory and are only valid until the next
+        batch is asked for, they must be written out before. The removed
+        counts of the workers are added to chain, their memo counts to the
+        memo of scorer and their keys to the ones it records. Raises
+        pairing.OutOfSync as the lockstep walk does.
+        """
+        if chain.dereplicator is not None:
+            raise ValueError('derep needs all the reads in one process')
+        if scorer.cached is not None:
+            raise ValueError('cached scores are read in one process')
+        segments = []
+        processes = []
+        try:
+            for _ in range(self.num_slots):
+                segments.append(shared_memory.SharedMemory(create=True, size=self.slot_size))
+            slot_names = [segment.name for segment in segments]
+            free = multiprocessing.Queue()
+            tasks = multiprocessing.Queue()
+            done = multiprocessing.Queue()
+            for slot in range(self.num_slots):
+                free.put(slot)
+            processes.append(multiprocessing.Process(
+                target=_read, args=(slot_names, self.slot_size, sources, free, tasks, done,
+                                    self.num_workers)))
+            for _ in range(self.num_workers):
+                processes.append(multiprocessing.Process(
+                    target=_score, args=(slot_names, tasks, done, chain.lc_method,
+                                         chain.lc_threshold, dict(chain.filters),
+                                         scorer.memo.max_entries, scorer.precheck)))
+            for process in processes:
+                process.daemon = True
+                process.start()
+
+            memo = scorer.memo
+            ready = {}
+            sequence = 0
+            end = None
+            while end is None or sequence < end:
+                if sequence not in ready:
+                    batch, slot, result = _receive(done, processes)
+                    if isinstance(result, Exception):
+                        raise result
+                    if slot is None:
+                        end = batch
+                    else:
+                        ready[batch] = slot, result
+                    continue
+                slot, (num_reads, sizes, removed, memo_counts) = ready.pop(sequence)
+                for reason, count in removed.items():
+                    chain.removed[reason] += count
+                memo.lookups += memo_counts[0]
+                memo.hits += memo_counts[1]
+                memo.checked += memo_counts[2]
+                memo.settled += memo_counts[3]
+                blocks, keeps, scores = _blocks(segments[slot].buf, num_reads, sizes)
+                if scorer.record:
+                    for direction, (keys, bounds) in enumerate(scores):
+                        scorer.add_recorded(direction,
+                                            _stored_keys(keys, chain.lc_method).copy(),
+                                            bounds.copy())
+                yield blocks, keeps
+                del blocks, keeps, scores
+                free.put(slot)
+                sequence += 1
+            for process in processes:
+                process.join()
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+                process.join()
+            for segment in segments:
+                _close(segment)
+                segment.unlink()
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Staged execution of a filter run with the wall time of every stage.
+
+A run goes through download, filter, compress, upload and report. The
+reads can only be downloaded and uploaded as whole files through
+ReadsUtils, so the download has to end before filtering starts; within
+the filter stage the native engine already compresses its outputs on
+writer threads while it scores (fastq.BlockGzipWriter). The outputs then
+go on as separate items: run_stages() runs every stage on its own
+threads, connected by bounded queues, so that the first output object is
+uploaded while the next ones are still being compressed, and a slow stage
+holds the ones before it back instead of piling up work.
+
+StageTimes records the wall time of every stage, from its first item
+starting to its last one finishing. Stages that overlap are each charged
+their own time and the run total is kept apart, so that the stage on the
+critical path stands out.
+"""
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+# items waiting between two stages
+QUEUE_SIZE = 2
+
+# output objects uploaded at once, a paired end run makes at most 3
+UPLOAD_THREADS = 3
+
+_DONE = object()
+
+
+class StageTimes(object):
+    """
+    Wall time spent in every stage, in seconds, in the order the stages
+    first ran.
+    """
+
+    def __init__(self):
+        self.seconds = OrderedDict()
+        self.started = time.time()
+        self.current = None
+        self.lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    def begin(self, name):
+        """
+        End the sequential stage running, if any, and start name.
+        """
+        self.end()
+        self.current = name, time.time()
+
+    def end(self):
+        if self.current is not None:
+            name, start = self.current
+            self.current = None
+            self.add(name, time.time() - start)
+
+    def total(self):
+        return time.time() - self.started
+
+    def summary(self):
+        """
+        The seconds of every stage and of the whole run ('total').
+        """
+        summary = OrderedDict((name, round(seconds, 3)) for name, seconds in
+                              self.seconds.items())
+        summary['total'] = round(self.total(), 3)
+        return summary
+
+    def format(self):
+        return 'Stage wall times: {}'.format(', '.join(
+            '{} {:.1f}s'.format(name, seconds) for name, seconds in self.summary().items()))
+
+
+def run_stages(items, stages, times, queue_size=QUEUE_SIZE):
+    """
+    Pass items through stages, (name, function, num_threads) tuples, every
+    stage handing function(item) on to the next one.
+
+    Every stage runs on num_threads threads reading a queue holding at
+    most queue_size items, its wall time is added to times. Returns the
+    results of the last stage in the order of items. Once a stage raised,
+    the items left are dropped and the first exception is raised again
+    when all the threads stopped.
+    """
+    queues = [queue.Queue(queue_size) for _ in stages]
+    results = {}
+    errors = []
+    # first start and last end of every stage
+    spans = {}
+    lock = threading.Lock()
+
+    def work(name, function, inbox, outbox):
+        while True:
+            entry = inbox.get()
+            if entry is _DONE:
+                return
+            index, item = entry
+            if errors:
+                # an earlier item failed, drain the queue
+                continue
+            start = time.time()
+            try:
+                item = function(item)
+            except Exception as e:
+                errors.append(e)
+                continue
+            finally:
+                with lock:
+                    first, _ = spans.get(name, (start, None))
+                    spans[name] = (min(first, start), time.time())
+            if outbox is None:
+                results[index] = item
+            else:
+                outbox.put((index, item))
+
+    threads = []
+    for position, (name, function, num_threads) in enumerate(stages):
+        outbox = queues[position + 1] if position + 1 < len(stages) else None
+        stage_threads = [threading.Thread(target=work, name='{}-{}'.format(name, i),
+                                          args=(name, function, queues[position], outbox))
+                         for i in range(num_threads)]
+        for thread in stage_threads:
+            thread.daemon = True
+            thread.start()
+        threads.append(stage_threads)
+
+    for index, item in enumerate(items):
+        queues[0].put((index, item))
+    # every stage stops once the one before it has, then tells the next
+    for position, stage_threads in enumerate(threads):
+        for _ in stage_threads:
+            queues[position].put(_DONE)
+        for thread in stage_threads:
+            thread.join()
+
+    for name, (start, end) in spans.items():
+        times.add(name, end - start)
+    if errors:
+        raise errors[0]
+    return [results[index] for index in sorted(results)]
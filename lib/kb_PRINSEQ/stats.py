@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+The "Input and filter stats:" block printed by prinseq-lite.
+
+Used to render the stats of the native engine in the prinseq layout, to
+combine the stats of filter runs over several shards of the same input and
+to turn a stats block into the typed summary returned by the method.
+"""
+import re
+
+STATS_HEADER = 'Input and filter stats:'
+FILTERED_HEADER = 'Sequences filtered by specified parameters:'
+
+# lines the native engine adds about its score memo (see scorecache.ScoreMemo)
+MEMO_LOOKUPS = 'Score memo lookups'
+MEMO_HITS = 'Score memo hits'
+
+# and about the reads its precheck settled (see lowcomplexity.precheck_keys)
+PRECHECK_CHECKED = 'Score precheck reads'
+PRECHECK_SETTLED = 'Score precheck settled'
+
+_STAT_LINE = re.compile(r'^\s*(?P<label>[^:]+):\s*(?P<value>[\d,]+(?:\.\d+)?)'
+                        r'(?:\s*\((?P<percent>[\d.]+)%\))?\s*$')
+
+
+def _add_commas(number):
+    return '{:,}'.format(number)
+
+
+def _stat_lines(prefix, suffix, counter, total=None):
+    mean = '{:.2f}'.format(counter.bases / counter.sequences) if counter.sequences else '0.00'
+    sequences = _add_commas(counter.sequences)
+    if total:
+        sequences += ' ({:.2f}%)'.format(100.0 * counter.sequences / total)
+    return ['\t{} sequences{}: {}'.format(prefix, suffix, sequences),
+            '\t{} bases{}: {}'.format(prefix, suffix, _add_commas(counter.bases)),
+            '\t{} mean length{}: {}'.format(prefix, suffix, mean)]
+
+
+def format_stats(inputs, goods, bads, filtered, memo_counts=None, precheck_counts=None):
+    """
+    Render counts in the layout of the prinseq "Input and filter stats:" block.
+
+    inputs, goods and bads are lists of (label suffix, counter, total) tuples,
+    counters having sequences and bases attributes. memo_counts, the
+    (lookups, hits) of the score memo, and precheck_counts, the (checked,
+    settled) of the precheck, add two lines each after the bad reads.
+    """
+    lines = [STATS_HEADER]
+    for suffix, counter, total in inputs:
+        lines.extend(_stat_lines('Input', suffix, counter, total))
+    for suffix, counter, total in goods:
+        lines.extend(_stat_lines('Good', suffix, counter, total))
+    for suffix, counter, total in bads:
+        lines.extend(_stat_lines('Bad', suffix, counter, total))
+    if memo_counts is not None:
+        lines.append('\t{}: {}'.format(MEMO_LOOKUPS, _add_commas(memo_counts[0])))
+        lines.append('\t{}: {}'.format(MEMO_HITS, _add_commas(memo_counts[1])))
+    if precheck_counts is not None:
+        lines.append('\t{}: {}'.format(PRECHECK_CHECKED, _add_commas(precheck_counts[0])))
+        lines.append('\t{}: {}'.format(PRECHECK_SETTLED, _add_commas(precheck_counts[1])))
+    lines.append('\t' + FILTERED_HEADER)
+    for name, count in filtered:
+        lines.append('\t{}: {}'.format(name, count))
+    return '\n'.join(lines) + '\n'
+
+
+def parse_stats(text):
+    """
+    Parse a stats block into its counts and the per filter counts.
+
+    Returns (counts, filtered) in the order prinseq printed them. counts holds
+    (label, value, has_percentage) tuples and filtered (filter name, count)
+    pairs. Values are ints except for mean lengths.
+    """
+    if STATS_HEADER in text:
+        text = text.split(STATS_HEADER, 1)[1]
+    counts = []
+    filtered = []
+    target = counts
+    for line in text.splitlines():
+        if FILTERED_HEADER in line:
+            target = filtered
+            continue
+        match = _STAT_LINE.match(line)
+        if match is None:
+            continue
+        value = match.group('value').replace(',', '')
+        value = float(value) if '.' in value else int(value)
+        if target is counts:
+            counts.append((match.group('label').strip(), value,
+                           match.group('percent') is not None))
+        else:
+            filtered.append((match.group('label').strip(), value))
+    return counts, filtered
+
+
+def _percent_base(label, values):
+    for candidate in ('Input sequences ({})'.format('file 2' if 'file 2' in label else 'file 1'),
+                      'Input sequences'):
+        if candidate in values:
+            return values[candidate]
+    return None
+
+
+def merge_stats(texts):
+    """
+    Combine the stats blocks of filter runs over shards of the same input.
+
+    Counts and per filter counts are added up, mean lengths and
+    percentages are recomputed from the totals.
+    """
+    labels = []
+    values = {}
+    with_percent = {}
+    filtered = []
+    filtered_values = {}
+    for text in texts:
+        counts, shard_filtered = parse_stats(text)
+        for label, value, percent in counts:
+            if label not in values:
+                labels.append(label)
+                values[label] = 0
+                with_percent[label] = percent
+            values[label] += value
+        for name, value in shard_filtered:
+            if name not in filtered_values:
+                filtered.append(name)
+                filtered_values[name] = 0
+            filtered_values[name] += value
+
+    lines = [STATS_HEADER]
+    for label in labels:
+        if ' mean length' in label:
+            sequences = values.get(label.replace(' mean length', ' sequences'))
+            bases = values.get(label.replace(' mean length', ' bases'), 0)
+            lines.append('\t{}: {:.2f}'.format(label, bases / sequences if sequences else 0))
+            continue
+        line = '\t{}: {}'.format(label, _add_commas(values[label]))
+        total = _percent_base(label, values)
+        if with_percent[label] and total:
+            line += ' ({:.2f}%)'.format(100.0 * values[label] / total)
+        lines.append(line)
+    lines.append('\t' + FILTERED_HEADER)
+    for name in filtered:
+        lines.append('\t{}: {}'.format(name, filtered_values[name]))
+    return '\n'.join(lines) + '\n'
+
+
+def summarize_stats(text):
+    """
+    Typed summary of a stats block, single or paired end.
+
+    input_reads and input_bases add up both files of a pair. good_reads
+    counts every read kept, good_pairs the pairs where both mates were kept
+    and singletons_fwd / singletons_rev the reads kept without their mate.
+    lc_method_removed is the number of reads removed by the low complexity
+    filter and removed_by the number of reads removed per reason, as listed
+    under "Sequences filtered by specified parameters:". Stats of the native
+    engine add the lookups, hits and hit rate of its score memo and the
+    reads checked by its precheck with the fraction of them it settled.
+    """
+    counts, filtered = parse_stats(text)
+    values = dict((label, value) for label, value, _ in counts)
+
+    def total(prefix):
+        return sum(value for label, value in values.items()
+                   if label == prefix or label.startswith(prefix + ' ('))
+
+    good_pairs = values.get('Good sequences (pairs)', 0)
+    singletons_fwd = values.get('Good sequences (singletons file 1)', 0)
+    singletons_rev = values.get('Good sequences (singletons file 2)', 0)
+    if 'Good sequences' in values:
+        good_reads = values['Good sequences']
+    else:
+        good_reads = 2 * good_pairs + singletons_fwd + singletons_rev
+    summary = {'input_reads': total('Input sequences'),
+               'input_bases': total('Input bases'),
+               'good_reads': good_reads,
+               'good_pairs': good_pairs,
+               'singletons_fwd': singletons_fwd,
+               'singletons_rev': singletons_rev,
+               'lc_method_removed': sum(count for name, count in filtered
+                                        if name.startswith('lc_method')),
+               'removed_by': dict(filtered)}
+    if MEMO_LOOKUPS in values:
+        lookups = values[MEMO_LOOKUPS]
+        hits = values.get(MEMO_HITS, 0)
+        summary.update({'score_memo_lookups': lookups,
+                        'score_memo_hits': hits,
+                        'score_memo_hit_rate': float(hits) / lookups if lookups else 0.0})
+    if PRECHECK_CHECKED in values:
+        checked = values[PRECHECK_CHECKED]
+        settled = values.get(PRECHECK_SETTLED, 0)
+        summary.update({'precheck_reads': checked,
+                        'precheck_settled': settled,
+                        'precheck_settled_fraction':
+                            float(settled) / checked if checked else 0.0})
+    return summary
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Threshold sweep: how many reads every low complexity threshold would keep.
+
+Every read is scored once with the native engine. The integer part of the
+score (lowcomplexity.score_keys) decides, for every integer threshold,
+whether the read is kept: DUST keeps reads whose integer score is at most
+the threshold and entropy keeps reads whose integer score is at least the
+threshold. A histogram of the integer scores, summed up from the
+appropriate end, therefore gives the reads (and bases) kept at all
+thresholds in one pass.
+
+For paired end reads a pair is kept when both mates are, that is when the
+worse of the two scores passes, so pairs get a histogram of their own.
+"""
+import numpy as np
+
+from kb_PRINSEQ import fastq
+from kb_PRINSEQ import lowcomplexity
+from kb_PRINSEQ import pairing
+from kb_PRINSEQ.scorecache import Scorer
+
+THRESHOLDS = np.arange(lowcomplexity.MAX_SCORE + 1)
+
+
+class _Histogram(object):
+
+    def __init__(self):
+        self.reads = np.zeros(len(THRESHOLDS), dtype=np.int64)
+        self.bases = np.zeros(len(THRESHOLDS), dtype=np.int64)
+
+    def add(self, keys, lengths):
+        self.reads += np.bincount(keys, minlength=len(THRESHOLDS))
+        self.bases += np.bincount(keys, weights=lengths,
+                                  minlength=len(THRESHOLDS)).astype(np.int64)
+
+    def kept(self, lc_method):
+        """
+        Reads and bases kept at every threshold.
+        """
+        if lc_method == 'dust':
+            return np.cumsum(self.reads), np.cumsum(self.bases)
+        return np.cumsum(self.reads[::-1])[::-1], np.cumsum(self.bases[::-1])[::-1]
+
+
+def _worse(keys, lc_method):
+    # the key of a pair is the one of the mate that fails first
+    if lc_method == 'dust':
+        return np.maximum(*keys)
+    return np.minimum(*keys)
+
+
+def sweep_single_end(fastq_path, lc_method, scorer=None):
+    """
+    Reads and bases kept by every threshold from 0 to 100.
+
+    scorer (a scorecache.Scorer) can provide cached scores.
+    Returns one dict per threshold.
+    """
+    scorer = scorer or Scorer(lc_method)
+    histogram = _Histogram()
+    for block in fastq.map_blocks(fastq_path):
+        histogram.add(scorer.keys(0, block), block.seq_lengths())
+    reads, bases = histogram.kept(lc_method)
+    return [{'threshold': int(threshold), 'reads': int(reads[threshold]),
+             'bases': int(bases[threshold])}
+            for threshold in THRESHOLDS]
+
+
+def _sweep_pairs(scorer, paired_blocks, orphan_paths):
+    mates = [_Histogram(), _Histogram()]
+    pairs = _Histogram()
+    for blocks in paired_blocks:
+        keys = [scorer.keys(i, block) for i, block in enumerate(blocks)]
+        lengths = [block.seq_lengths() for block in blocks]
+        for i in range(2):
+            mates[i].add(keys[i], lengths[i])
+        pairs.add(_worse(keys, scorer.lc_method), lengths[0] + lengths[1])
+    # reads whose mate is missing can only be singletons
+    for i, orphan_path in enumerate(orphan_paths):
+        for block in fastq.map_blocks(orphan_path):
+            mates[i].add(scorer.keys(i, block), block.seq_lengths())
+    return mates, pairs
+
+
+def sweep_paired_end(fwd_path, rev_path, lc_method, scorer=None):
+    """
+    Reads, bases, pairs and singletons kept by every threshold from 0 to
+    100. reads and bases count both mates of the kept pairs and the
+    singletons.
+
+    scorer (a scorecache.Scorer) can provide cached scores.
+    Returns one dict per threshold.
+    """
+    scorer = scorer or Scorer(lc_method)
+
+    def process(walk, orphan_paths):
+        # only the lockstep walk sees the reads in file order
+        return _sweep_pairs(scorer.unordered() if orphan_paths else scorer, walk(),
+                            orphan_paths)
+
+    mates, pairs = pairing.process_pairs(fwd_path, rev_path, process)
+    fwd_reads, fwd_bases = mates[0].kept(lc_method)
+    rev_reads, rev_bases = mates[1].kept(lc_method)
+    pair_count, _ = pairs.kept(lc_method)
+    return [{'threshold': int(threshold),
+             'reads': int(fwd_reads[threshold] + rev_reads[threshold]),
+             'bases': int(fwd_bases[threshold] + rev_bases[threshold]),
+             'pairs': int(pair_count[threshold]),
+             'singletons_fwd': int(fwd_reads[threshold] - pair_count[threshold]),
+             'singletons_rev': int(rev_reads[threshold] - pair_count[threshold])}
+            for threshold in THRESHOLDS]
+
+
+def format_sweep(points):
+    """
+    Render the sweep as a tab separated table.
+    """
+    columns = [column for column in ('threshold', 'reads', 'bases', 'pairs',
+                                     'singletons_fwd', 'singletons_rev')
+               if column in points[0]]
+    lines = ['\t'.join(columns)]
+    for point in points:
+        lines.append('\t'.join(str(point[column]) for column in columns))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,540 @@
+# -*- coding: utf-8 -*-
+import glob
+import os
+import random
+import re
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from kb_PRINSEQ import derep
+from kb_PRINSEQ import fastq
+from kb_PRINSEQ import fastqindex
+from kb_PRINSEQ import filtering
+from kb_PRINSEQ import lowcomplexity
+from kb_PRINSEQ import packed
+from kb_PRINSEQ import pairing
+from kb_PRINSEQ import parallel
+from kb_PRINSEQ import shmpipe
+from kb_PRINSEQ import stages
+from kb_PRINSEQ.scorecache import ScoreCache, Scorer
+from kb_PRINSEQ.stats import summarize_stats
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+RECORDS = [(b'read1 length=4', b'ACGT', b'IIII'),
+           (b'read2', b'GGGGCCCCAAAATTTT' * 8, b'#' * 128),
+           (b'read3', b'NACGTN', b'!!!!!!')]
+
+
+COMPLEMENT = bytes.maketrans(b'ACGTacgt', b'TGCAtgca')
+
+
+def count_reads(path):
+    with open(path, 'rb') as handle:
+        return sum(1 for _ in handle) // 4
+
+
+class kb_PRINSEQNativeTest(unittest.TestCase):
+    """
+    Tests of the native engine that need no KBase services.
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def copy_data(self, name, dest_name=None):
+        path = os.path.join(self.work_dir, dest_name or name)
+        shutil.copy(os.path.join(DATA_DIR, name), path)
+        return path
+
+    def write_shuffled(self, name, dest_name, seed=1, keep=0):
+        # the same records in another order, past the first keep ones
+        records = []
+        for block in fastq.read_blocks(os.path.join(DATA_DIR, name)):
+            records.extend(block.record(i) for i in range(len(block)))
+        shuffled = records[keep:]
+        random.Random(seed).shuffle(shuffled)
+        path = os.path.join(self.work_dir, dest_name)
+        with open(path, 'wb') as handle:
+            handle.writelines(records[:keep] + shuffled)
+        return path
+
+    def write_duplicated(self, name, dest_name):
+        # the records, then copies of some of them as they are and reverse
+        # complemented
+        records = []
+        for block in fastq.read_blocks(os.path.join(DATA_DIR, name)):
+            records.extend(bytes(block.record(i)) for i in range(len(block)))
+        copies = records[:2000]
+        for record in records[2000:3000]:
+            header, seq, plus, qual = record.split(b'\n')[:4]
+            copies.append(b'\n'.join([header, seq[::-1].translate(COMPLEMENT), plus,
+                                      qual[::-1], b'']))
+        path = os.path.join(self.work_dir, dest_name)
+        with open(path, 'wb') as handle:
+            handle.writelines(records + copies)
+        return path
+
+    def outputs(self, path, kind):
+        name = re.compile(r'_prinseq_{}_[A-Za-z0-9]+\.fastq$'.format(kind))
+        return [output for output in glob.glob(path + '_prinseq_*') if name.search(output)]
+
+    def write_fastq(self, content):
+        path = os.path.join(self.work_dir, 'reads.fq')
+        with open(path, 'wb') as handle:
+            handle.write(content)
+        return path
+
+    def parsed(self, blocks):
+        # header, sequence and quality of every record of the blocks
+        records = []
+        for block in blocks:
+            for i in range(len(block)):
+                start = block.qual_starts[i]
+                length = block.seq_ends[i] - block.seq_starts[i]
+                records.append((bytes(block.header(i)), bytes(block.seq(i)),
+                                bytes(block.view[start:start + length])))
+        return records
+
+    def assert_parsed(self, content, expected=RECORDS):
+        path = self.write_fastq(content)
+        for block_size in (16, 64, fastq.BLOCK_SIZE):
+            self.assertEqual(self.parsed(fastq.read_blocks(path, block_size)), expected)
+            self.assertEqual(self.parsed(fastq.map_blocks(path, block_size=block_size)),
+                             expected)
+
+    def fastq_text(self, newline=b'\n'):
+        return b''.join(newline.join([b'@' + header, seq, b'+', qual]) + newline
+                        for header, seq, qual in RECORDS)
+
+    def test_read_blocks(self):
+        self.assert_parsed(self.fastq_text())
+
+    def test_read_blocks_crlf(self):
+        self.assert_parsed(self.fastq_text(b'\r\n'))
+
+    def test_read_blocks_no_final_newline(self):
+        self.assert_parsed(self.fastq_text()[:-1])
+        self.assert_parsed(self.fastq_text(b'\r\n')[:-2])
+
+    def test_read_blocks_trailing_blank_lines(self):
+        self.assert_parsed(self.fastq_text() + b'\n\n  \n')
+        self.assert_parsed(self.fastq_text(b'\r\n') + b'\r\n\r\n')
+
+    def test_read_blocks_record_larger_than_block(self):
+        # the second record alone is over 256 bytes
+        path = self.write_fastq(self.fastq_text())
+        for read in (fastq.read_blocks, fastq.map_blocks):
+            blocks = list(read(path, block_size=8))
+            self.assertEqual(self.parsed(blocks), RECORDS)
+            self.assertTrue(all(len(block) for block in blocks))
+
+    def test_read_blocks_empty(self):
+        self.assert_parsed(b'', [])
+        self.assert_parsed(b'\n\n', [])
+
+    def test_read_blocks_truncated(self):
+        lines = self.fastq_text().split(b'\n')
+        for cut in (1, 2, 3):
+            path = self.write_fastq(b'\n'.join(lines[:-1 - cut]) + b'\n')
+            for block_size in (16, fastq.BLOCK_SIZE):
+                with self.assertRaisesRegex(ValueError, 'Truncated FASTQ record'):
+                    list(fastq.read_blocks(path, block_size))
+                with self.assertRaisesRegex(ValueError, 'Truncated FASTQ record'):
+                    list(fastq.map_blocks(path, block_size=block_size))
+
+    def test_read_blocks_malformed(self):
+        path = self.write_fastq(self.fastq_text().replace(b'@read2', b'read2'))
+        for read in (fastq.read_blocks, fastq.map_blocks):
+            with self.assertRaisesRegex(ValueError, 'Malformed FASTQ record'):
+                list(read(path))
+
+    def expected_codes(self, seqs):
+        codes = {ord(base): code for code, bases in enumerate(['Aa', 'Cc', 'Gg', 'Tt'])
+                 for base in bases}
+        return np.array([codes.get(base, packed.N_CODE) for seq in seqs for base in seq],
+                        dtype=np.uint8)
+
+    def test_packed_reads(self):
+        seqs = [b'ACGT', b'acgtn', b'', b'NNRYKM', b'GATTACA' * 11, b'T']
+        reads = packed.PackedReads.from_seqs(seqs)
+        self.assertEqual(len(reads), len(seqs))
+        self.assertEqual(reads.num_bases(), sum(len(seq) for seq in seqs))
+        self.assertEqual(reads.lengths.tolist(), [len(seq) for seq in seqs])
+        self.assertEqual(reads.offsets.tolist(),
+                         np.cumsum([0] + [len(seq) for seq in seqs[:-1]]).tolist())
+        np.testing.assert_array_equal(reads.codes(), self.expected_codes(seqs))
+
+    def test_packed_reads_from_block(self):
+        path = os.path.join(DATA_DIR, 'small_forward.fq')
+        block = next(fastq.read_blocks(path))
+        seqs = [bytes(seq) for seq in block.seqs()]
+        bases, offsets, lengths = packed.gather(block)
+        self.assertEqual(bases.tobytes(), b''.join(seqs))
+        self.assertEqual(lengths.tolist(), [len(seq) for seq in seqs])
+        reads = packed.PackedReads.from_block(block)
+        np.testing.assert_array_equal(reads.codes(), self.expected_codes(seqs))
+        np.testing.assert_array_equal(reads.offsets, offsets)
+        indices = np.array([5, 0, 17, 17, len(block) - 1])
+        bases, offsets, lengths = packed.gather(block, indices)
+        self.assertEqual(bases.tobytes(), b''.join(seqs[i] for i in indices))
+        subset = packed.PackedReads.from_block(block, indices)
+        np.testing.assert_array_equal(subset.codes(),
+                                      self.expected_codes([seqs[i] for i in indices]))
+        self.assertEqual(subset.lengths.tolist(), [len(seqs[i]) for i in indices])
+
+    def random_seqs(self, lengths, seed=1):
+        rng = random.Random(seed)
+        seqs = []
+        for length in lengths:
+            # low complexity stretches next to random ones
+            repeat = rng.choice([b'A', b'CA', b'GAT', b''])
+            stretch = (repeat * length)[:rng.randrange(length + 1)] if repeat else b''
+            seqs.append(stretch + bytes(rng.choice(b'ACGTN') for _ in range(length - len(stretch))))
+        return seqs
+
+    def assert_matrix_counts(self, seqs):
+        codes, offsets, lengths = lowcomplexity.encode(seqs)
+        read_index, window_index, window_length, _ = lowcomplexity.window_layout(lengths)
+        per_read = lowcomplexity.word_counts(
+            codes, offsets[read_index] + window_index * lowcomplexity.WINDOW_STEP,
+            window_length)
+        np.testing.assert_array_equal(lowcomplexity.matrix_word_counts(codes, lengths),
+                                      per_read)
+        # the same scores with the matrix and with the per-read counts
+        scores = [lowcomplexity.dust_scores(seqs), lowcomplexity.entropy_scores(seqs)]
+        with mock.patch.object(lowcomplexity, 'MAX_PADDING_RATIO', 0):
+            np.testing.assert_array_equal(lowcomplexity.dust_scores(seqs), scores[0])
+            np.testing.assert_array_equal(lowcomplexity.entropy_scores(seqs), scores[1])
+
+    def test_matrix_word_counts_fixed_length(self):
+        for length in (150, 64, 96, 97, 20, 5):
+            self.assert_matrix_counts(self.random_seqs([length] * 200))
+
+    def test_matrix_word_counts_padded(self):
+        rng = random.Random(2)
+        lengths = [rng.randrange(2, 400) for _ in range(300)]
+        seqs = self.random_seqs(lengths)
+        self.assertLessEqual(len(seqs) * max(lengths),
+                             lowcomplexity.MAX_PADDING_RATIO * sum(lengths))
+        self.assert_matrix_counts(seqs)
+
+    def test_long_read_dust(self):
+        rng = random.Random(3)
+        seqs = self.random_seqs([rng.randrange(1000, 5001) for _ in range(20)], seed=3)
+        codes, offsets, lengths = lowcomplexity.encode(seqs)
+        read_index, window_index, window_length, is_last = \
+            lowcomplexity.window_layout(lengths)
+        full = np.flatnonzero(~is_last)
+        counts = lowcomplexity.word_counts(
+            codes, offsets[read_index[full]] + window_index[full] * lowcomplexity.WINDOW_STEP,
+            window_length[full])
+        pairs = (np.einsum('ij,ij->i', counts, counts) - counts.sum(axis=1)) // 2
+        np.testing.assert_array_equal(
+            lowcomplexity.sliding_window_pairs(codes, offsets, lengths), pairs)
+        # the long read path against the scores of every window counted
+        scores = lowcomplexity.dust_scores(seqs)
+        with mock.patch.object(lowcomplexity, 'LONG_READ_LENGTH', 10 ** 9):
+            np.testing.assert_array_equal(lowcomplexity.dust_scores(seqs), scores)
+
+    def test_map_blocks_shard_ranges(self):
+        with open(os.path.join(DATA_DIR, 'small_forward.fq'), 'rb') as handle:
+            content = handle.read()
+        for variant in (content, content.replace(b'\n', b'\r\n') + b'\r\n\n',
+                        content.rstrip(b'\n')):
+            path = self.write_fastq(variant)
+            whole = self.parsed(fastq.read_blocks(path))
+            index = fastqindex.build_index(path, interval=1000)
+            self.assertEqual(len(index), len(whole))
+            for num_shards in (1, 2, 3, 7, 13):
+                ranges = index.shard_ranges(num_shards)
+                self.assertEqual(ranges[0][0], 0)
+                self.assertEqual(ranges[-1][1], len(variant))
+                self.assertEqual([end for _, end in ranges[:-1]],
+                                 [start for start, _ in ranges[1:]])
+                records = []
+                for start, end in ranges:
+                    records.extend(self.parsed(fastq.map_blocks(path, start, end,
+                                                                block_size=64 * 1024)))
+                self.assertEqual(records, whole)
+
+    def test_iupac_letters_counted_apart(self):
+        # prinseq counts every letter apart: reads over A, C, G and R score
+        # as the same reads with T in place of R, not as with N
+        rng = random.Random(4)
+        seqs = []
+        for length in [rng.randrange(4, 400) for _ in range(100)] + [1500, 3000]:
+            unit = bytes(rng.choice(b'ACGR') for _ in range(rng.randrange(1, 5)))
+            seqs.append(((unit * length)[:rng.randrange(length + 1)] +
+                         bytes(rng.choice(b'ACGRr') for _ in range(length)))[:length])
+        seqs += [b'ACGT' * 30, b'ACGN' * 30]
+        mapped = [seq.upper().replace(b'R', b'T') for seq in seqs]
+        reads = packed.PackedReads.from_seqs(seqs)
+        self.assertEqual(sorted(reads.letters), [i for i, seq in enumerate(seqs)
+                                                 if b'R' in seq.upper()])
+        np.testing.assert_allclose(lowcomplexity.dust_scores(seqs),
+                                   lowcomplexity.dust_scores(mapped), rtol=0, atol=1e-9)
+        np.testing.assert_allclose(lowcomplexity.entropy_scores(seqs),
+                                   lowcomplexity.entropy_scores(mapped), rtol=0, atol=1e-9)
+        for threshold in (50, 70, 90):
+            keys, _ = lowcomplexity.precheck_keys(seqs, 'entropy', threshold)
+            np.testing.assert_array_equal(
+                lowcomplexity.keep_keys(keys, 'entropy', threshold),
+                lowcomplexity.entropy_scores(mapped) >= threshold)
+        self.assertLess(lowcomplexity.dust_scores([b'RY' * 50])[0],
+                        lowcomplexity.dust_scores([b'N' * 100])[0])
+
+    def test_pe_sharded_mates_out_of_order(self):
+        fwd_path = self.copy_data('small_forward.fq', 'small_forward')
+        rev_path = self.write_shuffled('small_reverse.fq', 'small_reverse')
+        self.assertEqual(count_reads(fwd_path), count_reads(rev_path))
+        parallel.filter_sharded('native', [fwd_path, rev_path], 'dust', 2, 3, self.work_dir)
+        fwd_good = self.outputs(fwd_path, 'good')
+        rev_good = self.outputs(rev_path, 'good')
+        self.assertEqual(len(fwd_good), 1)
+        self.assertEqual(count_reads(fwd_good[0]), 7475)
+        self.assertEqual(count_reads(rev_good[0]), 7475)
+        self.assertEqual(count_reads(self.outputs(fwd_path, 'good_singletons')[0]), 2069)
+        self.assertEqual(count_reads(self.outputs(rev_path, 'good_singletons')[0]), 2002)
+
+    def test_pe_shard_ranges_start_at_mates(self):
+        paths = [self.copy_data('small_forward.fq'), self.copy_data('small_reverse.fq')]
+        ranges = [fastqindex.build_index(path, interval=1000).shard_ranges(4)
+                  for path in paths]
+        self.assertEqual(len(ranges[0]), 4)
+        self.assertEqual(len(ranges[1]), 4)
+        ids = []
+        for path, path_ranges in zip(paths, ranges):
+            with open(path, 'rb') as handle:
+                path_ids = []
+                for start, _ in path_ranges:
+                    handle.seek(start)
+                    path_ids.append(pairing.pair_id(handle.readline()[1:]))
+                ids.append(path_ids)
+        self.assertEqual(ids[0], ids[1])
+
+    def test_pe_sharded_mates_shifted(self):
+        # every shard boundary falls between the mates of a pair
+        fwd_path = self.copy_data('small_forward.fq', 'small_forward')
+        records = []
+        for block in fastq.read_blocks(os.path.join(DATA_DIR, 'small_reverse.fq')):
+            records.extend(block.record(i) for i in range(len(block)))
+        rev_path = os.path.join(self.work_dir, 'small_reverse')
+        with open(rev_path, 'wb') as handle:
+            handle.writelines(records[1:] + records[:1])
+        parallel.filter_sharded('native', [fwd_path, rev_path], 'dust', 2, 3, self.work_dir)
+        self.assertEqual(count_reads(self.outputs(fwd_path, 'good')[0]), 7475)
+        self.assertEqual(count_reads(self.outputs(rev_path, 'good')[0]), 7475)
+
+    def test_entropy_precheck_records_scores(self):
+        blocks = list(fastq.read_blocks(os.path.join(DATA_DIR, 'small_forward.fq')))
+        scorer = Scorer('entropy', record=True, precheck=70)
+        for block in blocks:
+            scorer.keys(0, block)
+        # a first run still settles most reads in the first tier
+        checked, settled = scorer.precheck_counts()
+        self.assertGreater(settled, checked // 2)
+        recorded = scorer.recorded(1)
+        self.assertIsNotNone(recorded)
+        (keys,), (bounds,) = recorded
+        expected = np.concatenate([lowcomplexity.score_keys(block.seqs(), 'entropy')
+                                   for block in blocks])
+        self.assertGreaterEqual(int(bounds.sum()), settled)
+        np.testing.assert_array_equal(keys[~bounds], expected[~bounds])
+        self.assertTrue((keys[bounds] <= expected[bounds]).all())
+        self.assertTrue((keys[bounds] >= 70).all())
+
+        # later runs at any threshold take the same decisions as exact keys
+        cache = ScoreCache(os.path.join(self.work_dir, 'score_cache'))
+        cache.store('entry', *recorded)
+        cached, cached_bounds = cache.load('entry')
+        for threshold in (50, 70, 71, 80, None):
+            scorer = Scorer('entropy', cached=cached, cached_bounds=cached_bounds,
+                            precheck=threshold)
+            keys = np.concatenate([scorer.keys(0, block) for block in blocks])
+            if threshold is None:
+                np.testing.assert_array_equal(keys, expected)
+            else:
+                np.testing.assert_array_equal(
+                    lowcomplexity.keep_keys(keys, 'entropy', threshold),
+                    lowcomplexity.keep_keys(expected, 'entropy', threshold))
+
+    def test_pe_mates_out_of_order(self):
+        fwd_path = self.copy_data('small_forward.fq', 'small_forward')
+        rev_path = self.write_shuffled('small_reverse.fq', 'small_reverse')
+        filtering.filter_paired_end(fwd_path, rev_path, 'dust', 2)
+        self.assertEqual(count_reads(self.outputs(fwd_path, 'good')[0]), 7475)
+        self.assertEqual(count_reads(self.outputs(rev_path, 'good')[0]), 7475)
+        self.assertEqual(count_reads(self.outputs(fwd_path, 'good_singletons')[0]), 2069)
+        self.assertEqual(count_reads(self.outputs(rev_path, 'good_singletons')[0]), 2002)
+
+    def test_pe_mates_out_of_order_memo_counts(self):
+        fwd_path = self.copy_data('small_forward.fq', 'small_forward')
+        rev_path = self.write_shuffled('small_reverse.fq', 'small_reverse', keep=6000)
+        map_blocks = fastq.map_blocks
+
+        def small_blocks(path, start=0, end=None):
+            return map_blocks(path, start, end, 64 * 1024)
+
+        # the lockstep pass gets through several blocks before giving up
+        with mock.patch.object(fastq, 'map_blocks', small_blocks):
+            summary = summarize_stats(filtering.filter_paired_end(fwd_path, rev_path, 'dust', 2))
+        self.assertEqual(summary['good_pairs'], 7475)
+        self.assertEqual(summary['score_memo_lookups'], 25000)
+        self.assertLessEqual(summary['score_memo_hits'], 25000)
+
+    def test_pe_mates_out_of_order_precheck_counts(self):
+        fwd_path = self.copy_data('small_forward.fq', 'small_forward')
+        rev_path = self.write_shuffled('small_reverse.fq', 'small_reverse', keep=6000)
+        map_blocks = fastq.map_blocks
+
+        def small_blocks(path, start=0, end=None):
+            return map_blocks(path, start, end, 64 * 1024)
+
+        for pipeline in (None, shmpipe.Pipeline(1, slot_size=256 * 1024)):
+            with mock.patch.object(fastq, 'map_blocks', small_blocks):
+                summary = summarize_stats(filtering.filter_paired_end(
+                    fwd_path, rev_path, 'entropy', 70, pipeline=pipeline))
+            self.assertEqual(summary['good_pairs'], 12469)
+            self.assertLessEqual(summary['precheck_reads'], 25000)
+            self.assertLessEqual(summary['precheck_settled'], summary['precheck_reads'])
+            for output in glob.glob(fwd_path + '_prinseq_*') + glob.glob(rev_path + '_prinseq_*'):
+                os.remove(output)
+
+    def test_shm_pipeline(self):
+        fwd_path = self.copy_data('small_forward.fq', 'small_forward')
+        rev_path = self.copy_data('small_reverse.fq', 'small_reverse')
+        runs = []
+        for pipeline in (None, shmpipe.Pipeline(2, slot_size=256 * 1024)):
+            scorer = Scorer('entropy', record=True, precheck=70)
+            stats = filtering.filter_paired_end(fwd_path, rev_path, 'entropy', 70,
+                                                scorer=scorer, pipeline=pipeline)
+            outputs = {}
+            for output in glob.glob(fwd_path + '_prinseq_*') + glob.glob(rev_path + '_prinseq_*'):
+                with open(output, 'rb') as handle:
+                    outputs[re.sub(r'_[A-Za-z0-9]+\.fastq$', '', output)] = handle.read()
+                os.remove(output)
+            runs.append((summarize_stats(stats), outputs, scorer.recorded(2)))
+        (summary, outputs, recorded), (shm_summary, shm_outputs, shm_recorded) = runs
+        self.assertEqual(shm_summary['good_pairs'], 12469)
+        self.assertEqual(shm_summary['removed_by'], summary['removed_by'])
+        self.assertEqual(shm_summary['score_memo_lookups'], 25000)
+        self.assertEqual(shm_outputs, outputs)
+        # the keys computed by the workers are recorded for the score cache
+        for keys, shm_keys in zip(recorded[0] + recorded[1], shm_recorded[0] + shm_recorded[1]):
+            np.testing.assert_array_equal(shm_keys, keys)
+        cached = Scorer('entropy', cached=shm_recorded[0], cached_bounds=shm_recorded[1],
+                        precheck=70)
+        with self.assertRaisesRegex(ValueError, 'cached scores'):
+            next(shmpipe.Pipeline(2).kept([(fwd_path, 0, None)],
+                                          filtering.FilterChain('entropy', 70), cached))
+
+    def test_spilled_derep(self):
+        fwd_path = self.write_duplicated('small_forward.fq', 'small_forward')
+        rev_path = self.write_duplicated('small_reverse.fq', 'small_reverse')
+        map_blocks = fastq.map_blocks
+
+        def small_blocks(path, start=0, end=None):
+            return map_blocks(path, start, end, 64 * 1024)
+
+        def run(paths, derep_mode, derep_spill):
+            with mock.patch.object(fastq, 'map_blocks', small_blocks):
+                if len(paths) == 1:
+                    stats = filtering.filter_single_end(paths[0], 'dust', 2,
+                                                        derep_mode=derep_mode,
+                                                        derep_spill=derep_spill)
+                else:
+                    stats = filtering.filter_paired_end(paths[0], paths[1], 'dust', 2,
+                                                        derep_mode=derep_mode,
+                                                        derep_spill=derep_spill)
+            outputs = {}
+            for path in paths:
+                for output in glob.glob(path + '_prinseq_*'):
+                    with open(output, 'rb') as handle:
+                        outputs[re.sub(r'_[A-Za-z0-9]+\.fastq$', '', output)] = handle.read()
+                    os.remove(output)
+            return summarize_stats(stats), outputs
+
+        for paths in ([fwd_path], [fwd_path, rev_path]):
+            for derep_mode in derep.DEREP_MODES:
+                summary, outputs = run(paths, derep_mode, False)
+                spilled_summary, spilled_outputs = run(paths, derep_mode, True)
+                self.assertGreaterEqual(summary['removed_by']['derep'], 2000)
+                self.assertEqual(spilled_summary, summary)
+                self.assertEqual(spilled_outputs, outputs)
+        self.assertEqual(sorted(os.listdir(self.work_dir)), ['small_forward', 'small_reverse'])
+
+    def test_run_stages(self):
+        seen = []
+
+        def first(item):
+            # later items finish first
+            time.sleep(0.01 * (5 - item))
+            seen.append(('first', item))
+            return item, 'first'
+
+        def second(item):
+            seen.append(('second', item[0]))
+            return item + ('second',)
+
+        times = stages.StageTimes()
+        results = stages.run_stages(range(5), [('first', first, 3), ('second', second, 2)],
+                                    times)
+        self.assertEqual(results, [(item, 'first', 'second') for item in range(5)])
+        for item in range(5):
+            self.assertLess(seen.index(('first', item)), seen.index(('second', item)))
+        self.assertEqual(list(times.summary()), ['first', 'second', 'total'])
+
+        def failing(item):
+            if item == 1:
+                raise ValueError('item 1 failed')
+            return item
+
+        passed = []
+        with self.assertRaisesRegex(ValueError, 'item 1 failed'):
+            stages.run_stages(range(20), [('fail', failing, 1), ('next', passed.append, 1)],
+                              stages.StageTimes(), queue_size=1)
+        # the items after the failure are dropped, not handed on
+        self.assertEqual(passed, [0])
+
+    def test_pe_truncated_mate_file(self):
+        fwd_path = self.copy_data('small_forward.fq', 'small_forward')
+        rev_path = os.path.join(self.work_dir, 'small_reverse')
+        with open(os.path.join(DATA_DIR, 'small_reverse.fq'), 'rb') as handle:
+            lines = handle.readlines()
+        with open(rev_path, 'wb') as handle:
+            handle.writelines(lines[:-2])
+        with self.assertRaisesRegex(ValueError, 'Truncated FASTQ record') as context:
+            for _ in pairing.synchronized_blocks(fastq.map_blocks(fwd_path),
+                                                 fastq.map_blocks(rev_path)):
+                pass
+        self.assertNotIsInstance(context.exception, pairing.OutOfSync)
+
+    def test_keyed_index_reused_across_downloads(self):
+        index_dir = os.path.join(self.work_dir, 'fastq_index')
+        paths = []
+        for download in ('first', 'second'):
+            os.makedirs(os.path.join(self.work_dir, download))
+            paths.append(self.copy_data('small_forward.fq',
+                                        os.path.join(download, 'small_forward.fq')))
+        key = '1/2/3:fwd'
+        self.assertIsNone(fastqindex.load_index(paths[1], index_dir=index_dir, key=key))
+        built = fastqindex.fastq_index(paths[0], index_dir=index_dir, key=key)
+        reused = fastqindex.load_index(paths[1], index_dir=index_dir, key=key)
+        self.assertIsNotNone(reused)
+        self.assertEqual(len(reused), 12500)
+        np.testing.assert_array_equal(reused.offsets, built.offsets)
+        self.assertIsNone(fastqindex.load_index(paths[1], index_dir=index_dir, key='1/2/4:fwd'))
+
+
+if __name__ == '__main__':
+    unittest.main()
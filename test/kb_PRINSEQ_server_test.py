@@ -217,6 +217,206 @@ class kb_PRINSEQTest(unittest.TestCase):
         node = reads_object['lib']['file']['id']
         self.delete_shock_node(node)
 
+    def test_se_dust_partial_native(self):
+        # Same as test_se_dust_partial but scored in process instead of by prinseq-lite.pl
+        output_reads_name = "SE_dust_2_native"
+        lc_method = "dust"
+        lc_threshold = 2
+        self.getImpl().execReadLibraryPRINSEQ(self.ctx, {"input_reads_ref": self.se_reads_reference,
+                                                         "output_ws": self.getWsName(),
+                                                         "output_reads_name": output_reads_name,
+                                                         "lc_method": lc_method,
+                                                         "lc_dust_threshold": lc_threshold,
+                                                         "engine": "native"})
+        reads_object = self.dfu.get_objects(
+            {'object_refs': [self.getWsName() + '/' + output_reads_name]})['data'][0]['data']
+        self.assertEqual(reads_object['read_count'], 9544)
+        node = reads_object['lib']['file']['id']
+        self.delete_shock_node(node)
+
+    def test_se_dust_partial_native_compressed(self):
+        # Reads downloaded gzipped and filtered results uploaded gzipped
+        output_reads_name = "SE_dust_2_native_gz"
+        self.getImpl().execReadLibraryPRINSEQ(self.ctx, {"input_reads_ref": self.se_reads_reference,
+                                                         "output_ws": self.getWsName(),
+                                                         "output_reads_name": output_reads_name,
+                                                         "lc_method": "dust",
+                                                         "lc_dust_threshold": 2,
+                                                         "engine": "native",
+                                                         "compress_io": 1})
+        reads_object = self.dfu.get_objects(
+            {'object_refs': [self.getWsName() + '/' + output_reads_name]})['data'][0]['data']
+        self.assertEqual(reads_object['read_count'], 9544)
+        node = reads_object['lib']['file']['id']
+        self.delete_shock_node(node)
+
+    def test_se_dust_partial_keep_bad_reads(self):
+        # The removed reads are attached to the report
+        output_reads_name = "SE_dust_2_keep_bad"
+        output = self.getImpl().execReadLibraryPRINSEQ(self.ctx, {"input_reads_ref":
+                                                                  self.se_reads_reference,
+                                                                  "output_ws": self.getWsName(),
+                                                                  "output_reads_name":
+                                                                  output_reads_name,
+                                                                  "lc_method": "dust",
+                                                                  "lc_dust_threshold": 2,
+                                                                  "engine": "native",
+                                                                  "keep_bad_reads": 1})[0]
+        report = self.dfu.get_objects(
+            {'object_refs': [output['report_ref']]})['data'][0]['data']
+        self.assertEqual(len(report['file_links']), 1)
+        self.assertIn("_prinseq_bad_", report['file_links'][0]['name'])
+        reads_object = self.dfu.get_objects(
+            {'object_refs': [self.getWsName() + '/' + output_reads_name]})['data'][0]['data']
+        self.assertEqual(reads_object['read_count'], 9544)
+        node = reads_object['lib']['file']['id']
+        self.delete_shock_node(node)
+
+    def test_se_dust_cached_scores(self):
+        # The second run at another threshold reuses the scores of the first one
+        params = {"input_reads_ref": self.se_reads_reference,
+                  "output_ws": self.getWsName(),
+                  "lc_method": "dust",
+                  "engine": "native",
+                  "mode": "stats_only"}
+        params["lc_dust_threshold"] = 2
+        output = self.getImpl().execReadLibraryPRINSEQ(self.ctx, params)[0]
+        self.assertEqual(output['stats']['good_reads'], 9544)
+        self.assertTrue(os.listdir(self.getImpl().score_cache.directory))
+        params["lc_dust_threshold"] = 7
+        output = self.getImpl().execReadLibraryPRINSEQ(self.ctx, params)[0]
+        self.assertEqual(output['stats']['good_reads'], 12496)
+
+    def test_se_dust_shm_cached_scores(self):
+        # The workers fill the score cache, a run on cached scores needs no workers
+        score_cache_dir = self.getImpl().score_cache.directory
+        for name in os.listdir(score_cache_dir):
+            os.remove(os.path.join(score_cache_dir, name))
+        params = {"input_reads_ref": self.se_reads_reference,
+                  "output_ws": self.getWsName(),
+                  "lc_method": "dust",
+                  "engine": "native",
+                  "num_threads": 2,
+                  "mode": "stats_only"}
+        params["lc_dust_threshold"] = 2
+        output = self.getImpl().execReadLibraryPRINSEQ(self.ctx, params)[0]
+        self.assertEqual(output['stats']['good_reads'], 9544)
+        self.assertTrue(os.listdir(score_cache_dir))
+        params["lc_dust_threshold"] = 7
+        output = self.getImpl().execReadLibraryPRINSEQ(self.ctx, params)[0]
+        self.assertEqual(output['stats']['good_reads'], 12496)
+        self.assertNotIn('score_memo_lookups', output['stats'])
+
+    def test_se_dust_score_memo(self):
+        # Repeated sequences are only scored once, the 76 exact duplicates hit the memo
+        score_cache_dir = self.getImpl().score_cache.directory
+        for name in os.listdir(score_cache_dir):
+            os.remove(os.path.join(score_cache_dir, name))
+        output = self.getImpl().execReadLibraryPRINSEQ(self.ctx, {"input_reads_ref":
+                                                                  self.se_reads_reference,
+                                                                  "output_ws": self.getWsName(),
+                                                                  "lc_method": "dust",
+                                                                  "lc_dust_threshold": 2,
+                                                                  "engine": "native",
+                                                                  "mode": "stats_only"})[0]
+        self.assertEqual(output['stats']['good_reads'], 9544)
+        self.assertEqual(output['stats']['score_memo_lookups'], 12500)
+        self.assertEqual(output['stats']['score_memo_hits'], 76)
+        self.assertAlmostEqual(output['stats']['score_memo_hit_rate'], 76 / 12500.0)
+
+    def test_se_dust_stage_seconds(self):
+        # Every stage of a filter run is timed, compress and upload overlap
+        output_reads_name = "SE_dust_2_stages"
+        output = self.getImpl().execReadLibraryPRINSEQ(self.ctx, {"input_reads_ref":
+                                                                  self.se_reads_reference,
+                                                                  "output_ws": self.getWsName(),
+                                                                  "output_reads_name":
+                                                                  output_reads_name,
+                                                                  "lc_method": "dust",
+                                                                  "lc_dust_threshold": 2,
+                                                                  "engine": "native"})[0]
+        self.assertEqual(list(output['stage_seconds']),
+                         ['download', 'filter', 'compress', 'upload', 'report', 'total'])
+        self.assertTrue(all(seconds >= 0 for seconds in output['stage_seconds'].values()))
+        reads_object = self.dfu.get_objects(
+            {'object_refs': [self.getWsName() + '/' + output_reads_name]})['data'][0]['data']
+        self.assertEqual(reads_object['read_count'], 9544)
+        node = reads_object['lib']['file']['id']
+        self.delete_shock_node(node)
+
+    def test_se_dust_memoized(self):
+        # An identical request returns the objects made by the first one
+        params = {"input_reads_ref": self.se_reads_reference,
+                  "output_ws": self.getWsName(),
+                  "output_reads_name": "SE_dust_2_memoized",
+                  "lc_method": "dust",
+                  "lc_dust_threshold": 2,
+                  "engine": "native"}
+        first = self.getImpl().execReadLibraryPRINSEQ(self.ctx, params)[0]
+        second = self.getImpl().execReadLibraryPRINSEQ(self.ctx, params)[0]
+        self.assertEqual(first['output_filtered_ref'], second['output_filtered_ref'])
+        self.assertEqual(first['stats'], second['stats'])
+        self.assertTrue(second['report'].startswith(
+            'Reused the results of an identical earlier run (report {})'.format(
+                first['report_ref'])))
+        self.assertTrue(second['report'].endswith(first['report']))
+        # the reuse is recorded in a report of its own, listing the objects
+        self.assertNotEqual(first['report_ref'], second['report_ref'])
+        report = self.dfu.get_objects(
+            {'object_refs': [second['report_ref']]})['data'][0]['data']
+        self.assertEqual([created['ref'] for created in report['objects_created']],
+                         [first['output_filtered_ref']])
+        reads_object = self.dfu.get_objects(
+            {'object_refs': [first['output_filtered_ref']]})['data'][0]['data']
+        self.assertEqual(reads_object['read_count'], 9544)
+        node = reads_object['lib']['file']['id']
+        self.delete_shock_node(node)
+
+        # once the name is saved over, the earlier result is not reused
+        params["lc_dust_threshold"] = 7
+        self.getImpl().execReadLibraryPRINSEQ(self.ctx, params)
+        params["lc_dust_threshold"] = 2
+        third = self.getImpl().execReadLibraryPRINSEQ(self.ctx, params)[0]
+        self.assertNotEqual(third['output_filtered_ref'], first['output_filtered_ref'])
+        self.assertFalse(third['report'].startswith('Reused'))
+        reads_object = self.dfu.get_objects(
+            {'object_refs': [third['output_filtered_ref']]})['data'][0]['data']
+        self.assertEqual(reads_object['read_count'], 9544)
+        self.delete_shock_node(reads_object['lib']['file']['id'])
+
+    def test_se_both_and(self):
+        # A read has to pass the dust and the entropy threshold
+        output_reads_name = "SE_both_and"
+        output = self.getImpl().execReadLibraryPRINSEQ(self.ctx, {"input_reads_ref":
+                                                                  self.se_reads_reference,
+                                                                  "output_ws": self.getWsName(),
+                                                                  "output_reads_name":
+                                                                  output_reads_name,
+                                                                  "lc_method": "both",
+                                                                  "lc_dust_threshold": 2,
+                                                                  "lc_entropy_threshold": 70,
+                                                                  "lc_combine": "and"})[0]
+        self.assertEqual(output['stats']['removed_by'],
+                         {'lc_method (dust)': 2942,
+                          'lc_method (entropy)': 0,
+                          'lc_method (dust and entropy)': 14})
+        reads_object = self.dfu.get_objects(
+            {'object_refs': [output['output_filtered_ref']]})['data'][0]['data']
+        self.assertEqual(reads_object['read_count'], 9544)
+        node = reads_object['lib']['file']['id']
+        self.delete_shock_node(node)
+
+    def test_invalid_engine(self):
+        with self.assertRaises(ValueError) as context:
+            self.getImpl().execReadLibraryPRINSEQ(self.ctx, {"input_reads_ref":
+                                                             self.se_reads_reference,
+                                                             "output_ws": self.getWsName(),
+                                                             "output_reads_name": "SE_bad_engine",
+                                                             "lc_method": "dust",
+                                                             "lc_dust_threshold": 7,
+                                                             "engine": "java"})
+        self.assertIn("engine must be 'prinseq' or 'native'", str(context.exception))
+
     def test_se_dust_loose(self):
         # The original input reads file has 12500 reads. None of the reads get filtered.
         output_reads_name = "SE_dust_40"
@@ -249,6 +449,40 @@ class kb_PRINSEQTest(unittest.TestCase):
         node = reads_object['lib']['file']['id']
         self.delete_shock_node(node)
 
+    def test_se_entropy_partial_native(self):
+        # Same as test_se_entropy_partial but scored in process instead of by prinseq-lite.pl
+        output_reads_name = "SE_entropy_70_native"
+        lc_method = "entropy"
+        lc_threshold = 70
+        self.getImpl().execReadLibraryPRINSEQ(self.ctx, {"input_reads_ref": self.se_reads_reference,
+                                                         "output_ws": self.getWsName(),
+                                                         "output_reads_name": output_reads_name,
+                                                         "lc_method": lc_method,
+                                                         "lc_entropy_threshold": lc_threshold,
+                                                         "engine": "native"})
+        reads_object = self.dfu.get_objects(
+            {'object_refs': [self.getWsName() + '/' + output_reads_name]})['data'][0]['data']
+        self.assertEqual(reads_object['read_count'], 12486)
+        node = reads_object['lib']['file']['id']
+        self.delete_shock_node(node)
+
+    def test_se_entropy_precheck(self):
+        # Most reads are settled by the entropy bound, the kept reads stay the same
+        score_cache_dir = self.getImpl().score_cache.directory
+        for name in os.listdir(score_cache_dir):
+            os.remove(os.path.join(score_cache_dir, name))
+        output = self.getImpl().execReadLibraryPRINSEQ(self.ctx, {"input_reads_ref":
+                                                                  self.se_reads_reference,
+                                                                  "output_ws": self.getWsName(),
+                                                                  "lc_method": "entropy",
+                                                                  "lc_entropy_threshold": 70,
+                                                                  "engine": "native",
+                                                                  "mode": "stats_only"})[0]
+        self.assertEqual(output['stats']['good_reads'], 12486)
+        self.assertEqual(output['stats']['precheck_reads'], 12424)
+        self.assertEqual(output['stats']['precheck_settled'], 12124)
+        self.assertAlmostEqual(output['stats']['precheck_settled_fraction'], 12124 / 12424.0)
+
     def test_se_entropy_loose(self):
         # The original input reads file has 12500 reads. No reads get filtered.
         output_reads_name = "SE_entropy_50"
@@ -322,6 +556,177 @@ class kb_PRINSEQTest(unittest.TestCase):
         node = reads_object['lib']['file']['id']
         self.delete_shock_node(node)
 
+    def test_pe_dust_partial_native(self):
+        # Same as test_pe_dust_partial but scored in process instead of by prinseq-lite.pl
+        output_reads_name = "PE_dust_2_native"
+        lc_method = "dust"
+        lc_threshold = 2
+        self.getImpl().execReadLibraryPRINSEQ(self.ctx, {"input_reads_ref": self.pe_reads_reference,
+                                                         "output_ws": self.getWsName(),
+                                                         "output_reads_name": output_reads_name,
+                                                         "lc_method": lc_method,
+                                                         "lc_dust_threshold": lc_threshold,
+                                                         "engine": "native"})
+        reads_object = self.dfu.get_objects(
+            {'object_refs': [self.getWsName() + '/' + output_reads_name]})['data'][0]['data']
+        self.assertEqual(reads_object['read_count'], 14950)
+        node = reads_object['lib1']['file']['id']
+        self.delete_shock_node(node)
+        for direction, read_count in (("fwd", 2069), ("rev", 2002)):
+            reads_object = self.dfu.get_objects(
+                {'object_refs': [self.getWsName() + '/' + output_reads_name +
+                                 "_{}_singletons".format(direction)]})['data'][0]['data']
+            self.assertEqual(reads_object['read_count'], read_count)
+            node = reads_object['lib']['file']['id']
+            self.delete_shock_node(node)
+
+    def test_pe_dust_partial_output(self):
+        # The method output carries the parsed stats and the refs of the new objects
+        output_reads_name = "PE_dust_2_output"
+        output = self.getImpl().execReadLibraryPRINSEQ(self.ctx, {"input_reads_ref":
+                                                                  self.pe_reads_reference,
+                                                                  "output_ws": self.getWsName(),
+                                                                  "output_reads_name":
+                                                                  output_reads_name,
+                                                                  "lc_method": "dust",
+                                                                  "lc_dust_threshold": 2,
+                                                                  "engine": "native"})[0]
+        self.assertEqual(output['stats'], {'input_reads': 25000,
+                                           'input_bases': 2500000,
+                                           'good_reads': 19021,
+                                           'good_pairs': 7475,
+                                           'singletons_fwd': 2069,
+                                           'singletons_rev': 2002,
+                                           'lc_method_removed': 5979,
+                                           'removed_by': {'lc_method': 5979}})
+        self.assertIn("Input and filter stats:", output['report'])
+        for ref_key, read_count in (('output_filtered_ref', 14950),
+                                    ('output_unpaired_fwd_ref', 2069),
+                                    ('output_unpaired_rev_ref', 2002)):
+            reads_object = self.dfu.get_objects(
+                {'object_refs': [output[ref_key]]})['data'][0]['data']
+            self.assertEqual(reads_object['read_count'], read_count)
+            lib = reads_object['lib1'] if 'lib1' in reads_object else reads_object['lib']
+            self.delete_shock_node(lib['file']['id'])
+
+    def test_pe_dust_partial_stats_only(self):
+        # Only the counts come back, no reads object is saved
+        output_reads_name = "PE_dust_2_stats_only"
+        output = self.getImpl().execReadLibraryPRINSEQ(self.ctx, {"input_reads_ref":
+                                                                  self.pe_reads_reference,
+                                                                  "output_ws": self.getWsName(),
+                                                                  "output_reads_name":
+                                                                  output_reads_name,
+                                                                  "lc_method": "dust",
+                                                                  "lc_dust_threshold": 2,
+                                                                  "mode": "stats_only"})[0]
+        self.assertEqual(output['stats']['good_pairs'], 7475)
+        self.assertEqual(output['stats']['singletons_fwd'], 2069)
+        self.assertEqual(output['stats']['singletons_rev'], 2002)
+        self.assertNotIn('report_ref', output)
+        self.assertNotIn('output_filtered_ref', output)
+        objects = self.wsClient.list_objects({'workspaces': [self.getWsName()]})
+        self.assertNotIn(output_reads_name, [info[1] for info in objects])
+
+    def test_pe_dust_partial_filter_chain(self):
+        # min_qual_mean runs first, lc_method only counts the reads it left
+        output = self.getImpl().execReadLibraryPRINSEQ(self.ctx, {"input_reads_ref":
+                                                                  self.pe_reads_reference,
+                                                                  "output_ws": self.getWsName(),
+                                                                  "lc_method": "dust",
+                                                                  "lc_dust_threshold": 2,
+                                                                  "engine": "native",
+                                                                  "min_len": 100,
+                                                                  "min_qual_mean": 36,
+                                                                  "ns_max_p": 0,
+                                                                  "mode": "stats_only"})[0]
+        self.assertEqual(output['stats']['removed_by'], {'min_len': 0,
+                                                         'min_qual_mean': 304,
+                                                         'ns_max_p': 0,
+                                                         'lc_method': 5907})
+        self.assertEqual(output['stats']['good_pairs'], 7298)
+        self.assertEqual(output['stats']['singletons_fwd'], 2246)
+        self.assertEqual(output['stats']['singletons_rev'], 1947)
+
+    def test_se_dust_partial_derep(self):
+        # Duplicates are removed before lc_method, so it sees fewer reads
+        output = self.getImpl().execReadLibraryPRINSEQ(self.ctx, {"input_reads_ref":
+                                                                  self.se_reads_reference,
+                                                                  "output_ws": self.getWsName(),
+                                                                  "lc_method": "dust",
+                                                                  "lc_dust_threshold": 2,
+                                                                  "engine": "native",
+                                                                  "derep": "revcomp",
+                                                                  "mode": "stats_only"})[0]
+        self.assertEqual(output['stats']['removed_by'], {'derep': 143, 'lc_method': 2918})
+        self.assertEqual(output['stats']['good_reads'], 9439)
+
+    def test_dust_sweep(self):
+        # One pass gives the counts of test_se_dust_partial and test_pe_dust_partial
+        output = self.getImpl().execReadLibraryPRINSEQ(self.ctx, {"input_reads_ref":
+                                                                  self.se_reads_reference,
+                                                                  "output_ws": self.getWsName(),
+                                                                  "lc_method": "dust",
+                                                                  "mode": "sweep"})[0]
+        self.assertEqual(len(output['sweep']), 101)
+        self.assertEqual(output['sweep'][2]['reads'], 9544)
+        self.assertEqual(output['sweep'][40]['reads'], 12500)
+        output = self.getImpl().execReadLibraryPRINSEQ(self.ctx, {"input_reads_ref":
+                                                                  self.pe_reads_reference,
+                                                                  "output_ws": self.getWsName(),
+                                                                  "lc_method": "dust",
+                                                                  "mode": "sweep"})[0]
+        self.assertEqual(output['sweep'][2]['pairs'], 7475)
+        self.assertEqual(output['sweep'][2]['singletons_fwd'], 2069)
+        self.assertEqual(output['sweep'][2]['singletons_rev'], 2002)
+
+    def test_pe_dust_partial_sharded(self):
+        # Same as test_pe_dust_partial but split into 4 shards filtered in parallel
+        output_reads_name = "PE_dust_2_sharded"
+        lc_method = "dust"
+        lc_threshold = 2
+        self.getImpl().execReadLibraryPRINSEQ(self.ctx, {"input_reads_ref": self.pe_reads_reference,
+                                                         "output_ws": self.getWsName(),
+                                                         "output_reads_name": output_reads_name,
+                                                         "lc_method": lc_method,
+                                                         "lc_dust_threshold": lc_threshold,
+                                                         "num_threads": 4})
+        reads_object = self.dfu.get_objects(
+            {'object_refs': [self.getWsName() + '/' + output_reads_name]})['data'][0]['data']
+        self.assertEqual(reads_object['read_count'], 14950)
+        node = reads_object['lib1']['file']['id']
+        self.delete_shock_node(node)
+        for direction, read_count in (("fwd", 2069), ("rev", 2002)):
+            reads_object = self.dfu.get_objects(
+                {'object_refs': [self.getWsName() + '/' + output_reads_name +
+                                 "_{}_singletons".format(direction)]})['data'][0]['data']
+            self.assertEqual(reads_object['read_count'], read_count)
+            node = reads_object['lib']['file']['id']
+            self.delete_shock_node(node)
+
+    def test_pe_dust_partial_pipeline(self):
+        # Same as test_pe_dust_partial_native but scored on 3 workers fed through shared memory
+        output_reads_name = "PE_dust_2_pipeline"
+        self.getImpl().execReadLibraryPRINSEQ(self.ctx, {"input_reads_ref": self.pe_reads_reference,
+                                                         "output_ws": self.getWsName(),
+                                                         "output_reads_name": output_reads_name,
+                                                         "lc_method": "dust",
+                                                         "lc_dust_threshold": 2,
+                                                         "engine": "native",
+                                                         "num_threads": 3})
+        reads_object = self.dfu.get_objects(
+            {'object_refs': [self.getWsName() + '/' + output_reads_name]})['data'][0]['data']
+        self.assertEqual(reads_object['read_count'], 14950)
+        node = reads_object['lib1']['file']['id']
+        self.delete_shock_node(node)
+        for direction, read_count in (("fwd", 2069), ("rev", 2002)):
+            reads_object = self.dfu.get_objects(
+                {'object_refs': [self.getWsName() + '/' + output_reads_name +
+                                 "_{}_singletons".format(direction)]})['data'][0]['data']
+            self.assertEqual(reads_object['read_count'], read_count)
+            node = reads_object['lib']['file']['id']
+            self.delete_shock_node(node)
+
     def test_pe_dust_strict(self):
         # Two new objects made (NO PAIRED END MADE as no matching pairs)
         # 1&2) Filtered FWD and REV Reads without matching pair (singletons).